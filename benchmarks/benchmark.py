@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+""" Benchmarks of q2-aldex2 on simulated tables.
+
+Tables are simulated with `random_block_table` from the test suite at a few
+tiers of samples, features, Monte Carlo instances and sparsity. Every tier
+runs in a fresh process, so its peak RSS is its own, and every stage is
+timed separately:
+
+- simulate: building the table with `random_block_table`
+- aldex2: `_method.aldex2` with the chosen engine, and its own stages as
+  'aldex2.<stage>' as its instrumentation records them (for R: export,
+  R and its stages, import; for the native engine: filter, plan, native)
+- extract_differences and effect_plot: the downstream actions
+
+Usage:
+
+    python benchmarks/benchmark.py run --tier small --tier medium
+    python benchmarks/benchmark.py compare old.json new.json
+    python benchmarks/benchmark.py kernels
+    python benchmarks/benchmark.py sampling
+
+`run` writes one JSON file per invocation (by default under
+`benchmarks/results`), and `compare` reports the stages that got slower or
+used more memory than a threshold, exiting with status 1 if any did.
+`kernels` times the batched Welch and Wilcoxon kernels of the native engine
+against the SciPy calls they replaced, vectorised and one feature at a time;
+with `--r` it also compares the native engine with ALDEx2 in R.
+`sampling` compares the Monte Carlo error per second of the sampling modes.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from queue import Empty
+
+import numpy as np
+
+
+# reps (samples per group), features, Monte Carlo instances and library size;
+# smaller libraries give sparser tables
+TIERS = {
+    'small': dict(reps=10, n_species=200, mc_samples=16,
+                  library_size=10000),
+    'medium': dict(reps=50, n_species=2000, mc_samples=128,
+                   library_size=10000),
+    'large': dict(reps=250, n_species=20000, mc_samples=128,
+                  library_size=10000),
+    'sparse': dict(reps=50, n_species=2000, mc_samples=128,
+                   library_size=500),
+    'deep': dict(reps=50, n_species=2000, mc_samples=1024,
+                 library_size=10000),
+}
+
+# instances, samples (half per group) and features of the kernel timings
+KERNEL_SHAPES = {
+    'small': (128, 20, 200),
+    'medium': (128, 100, 2000),
+}
+
+# features timed one at a time; longer loops are extrapolated from these
+_PER_FEATURE = 100
+
+# Seconds to wait between checks that a tier's process is still alive
+_POLL_SECONDS = 5
+
+_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'results')
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, \
+        children.ru_utime + children.ru_stime
+
+
+class _Stages:
+    """ Wall time, CPU time (own and of child processes such as R) and the
+    peak RSS reached by the end of every stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        from q2_aldex2._instrument import _peak_rss_mb
+
+        cpu, child_cpu = _cpu_seconds()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        wall = time.perf_counter() - start
+        cpu_end, child_cpu_end = _cpu_seconds()
+        self.stages[name] = {
+            'wall': wall,
+            'cpu': cpu_end - cpu,
+            'child_cpu': child_cpu_end - child_cpu,
+            'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+            'child_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        }
+        return result
+
+
+def _simulate(reps, n_species, library_size, seed):
+    from q2_aldex2.tests.test_method import random_block_table, to_biom
+
+    _, rel_table, metadata, _ = random_block_table(
+        reps, n_species, microbe_kappa=0.7, microbe_tau=0.7,
+        library_size=library_size, seed=seed, sparse=True)
+    return to_biom(rel_table), metadata['labels'].astype(str)
+
+
+def _run_tier(tier, params, engine, seed, queue):
+    import qiime2
+    from q2_aldex2 import _instrument
+    from q2_aldex2._method import aldex2, extract_differences
+    from q2_aldex2._visualizer import effect_plot
+
+    stages = _Stages()
+    table, labels = stages.run('simulate', _simulate, params['reps'],
+                               params['n_species'], params['library_size'],
+                               seed)
+    metadata = qiime2.CategoricalMetadataColumn(labels)
+
+    # the stages aldex2 records itself, e.g. the export to and import from R
+    records = []
+    _instrument.set_sink(records.append)
+    try:
+        summary = stages.run('aldex2', aldex2, table, metadata,
+                             params['mc_samples'], engine=engine, seed=seed,
+                             use_cache=False)
+    finally:
+        _instrument.set_sink(None)
+    for stage in records[-1]['stages']:
+        stage = dict(stage)
+        stages.stages['aldex2.%s' % stage.pop('stage')] = stage
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        stages.run('extract_differences', extract_differences, summary,
+                   sig_threshold=1, effect_threshold=0,
+                   difference_threshold=0)
+        stages.run('effect_plot', effect_plot, dir_name, summary)
+
+    density = table.matrix_data.nnz / np.prod(table.shape)
+    queue.put({'params': dict(params, density=density),
+               'stages': stages.stages})
+
+
+def _result(process, queue):
+    """ What the tier's process put on `queue`, or None if it exited
+    without a result (e.g. killed for running out of memory).
+    """
+    while True:
+        try:
+            return queue.get(timeout=_POLL_SECONDS)
+        except Empty:
+            if not process.is_alive():
+                # it may have put its result just before exiting
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    return None
+
+
+def run(tiers, engine, seed, output):
+    """ Run every tier in a process of its own and write the results.
+
+    Tiers whose process dies are reported with its exit code under
+    'failed' and left out of 'tiers'.
+    """
+    from q2_aldex2._version import get_versions
+
+    version = get_versions()['version']
+    results = {
+        'version': version,
+        'engine': engine,
+        'transport': os.environ.get('Q2_ALDEX2_TRANSPORT') or 'text',
+        'seed': seed,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'cpus': os.cpu_count()},
+        'tiers': {},
+        'failed': {},
+    }
+    # a fresh process per tier keeps the peak RSS of every tier its own
+    context = multiprocessing.get_context('spawn')
+    for tier in tiers:
+        queue = context.Queue()
+        process = context.Process(target=_run_tier,
+                                  args=(tier, TIERS[tier], engine, seed,
+                                        queue))
+        process.start()
+        result = _result(process, queue)
+        process.join()
+        if result is None:
+            results['failed'][tier] = process.exitcode
+            print('%s: failed with exit code %s' % (tier, process.exitcode),
+                  file=sys.stderr)
+            continue
+        results['tiers'][tier] = result
+        print('%s: %s' % (tier, ', '.join(
+            '%s %.2fs' % (stage, values['wall'])
+            for stage, values in result['stages'].items())))
+
+    if output is None:
+        os.makedirs(_RESULTS_DIR, exist_ok=True)
+        output = os.path.join(_RESULTS_DIR, '%s-%s.json' % (version, engine))
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print('Wrote %s' % output)
+    return results
+
+
+def compare(old, new, threshold=0.1, min_seconds=0.05):
+    """ Stages of the tiers in both results that take (or use) more than
+    `threshold` more in `new`. Timings under `min_seconds` are too noisy to
+    compare.
+    """
+    regressions = []
+    for tier, result in new['tiers'].items():
+        if tier not in old['tiers']:
+            continue
+        for stage, values in result['stages'].items():
+            before = old['tiers'][tier]['stages'].get(stage)
+            if before is None:
+                continue
+            for metric in ['wall', 'peak_rss_mb', 'child_peak_rss_mb']:
+                # the stages R reports lack some of the measures
+                if not before.get(metric) or values.get(metric) is None:
+                    continue
+                if metric == 'wall' and before[metric] < min_seconds:
+                    continue
+                ratio = values[metric] / before[metric]
+                if ratio > 1 + threshold:
+                    regressions.append((tier, stage, metric, before[metric],
+                                        values[metric], ratio))
+    return regressions
+
+
+def _best_of(fn, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def kernels(shapes, seed=0):
+    """ Seconds taken by the Welch and Wilcoxon p-values of every instance
+    and feature: the batched kernels, the SciPy calls along the sample axis
+    that they replaced and SciPy one feature at a time (extrapolated from
+    the first features). Also reports the largest difference in p-value.
+    """
+    from scipy import stats
+    from q2_aldex2._stats import _welch, _wilcox
+
+    def welch(x, y, axis=0):
+        return stats.ttest_ind(x, y, axis=axis, equal_var=False).pvalue
+
+    def wilcox(x, y, axis=0):
+        # exact below 50 samples per group, as R's wilcox.test and _wilcox
+        method = 'exact' if x.shape[axis] < 50 else 'asymptotic'
+        return stats.mannwhitneyu(x, y, axis=axis, alternative='two-sided',
+                                  method=method).pvalue
+
+    scipy_calls = {'welch': (_welch, welch), 'wilcox': (_wilcox, wilcox)}
+    results = {}
+    rng = np.random.default_rng(seed)
+    for shape in shapes:
+        mc_samples, n_samples, n_features = KERNEL_SHAPES[shape]
+        x = rng.normal(size=(mc_samples, n_samples // 2, n_features))
+        y = rng.normal(0.2, size=(mc_samples, n_samples // 2, n_features))
+        for name, (kernel, scipy_call) in scipy_calls.items():
+            batched, p = _best_of(lambda: kernel(x, y))
+            vectorised, expected = _best_of(
+                lambda: scipy_call(x, y, axis=1))
+            timed = min(n_features, _PER_FEATURE)
+            per_feature, _ = _best_of(lambda: [
+                scipy_call(x[i, :, j], y[i, :, j])
+                for i in range(mc_samples) for j in range(timed)], 1)
+            results['%s/%s' % (shape, name)] = {
+                'batched': batched,
+                'scipy_vectorised': vectorised,
+                'scipy_per_feature': per_feature * n_features / timed,
+                'max_abs_diff': float(np.nanmax(np.abs(p - expected))),
+            }
+    print('%-14s %10s %12s %12s %9s %10s' % (
+        'kernel', 'batched', 'scipy (vec)', 'scipy (loop)', 'vs loop',
+        'max diff'))
+    for name, values in results.items():
+        print('%-14s %9.3fs %11.3fs %11.3fs %8.0fx %10.1e' % (
+            name, values['batched'], values['scipy_vectorised'],
+            values['scipy_per_feature'],
+            values['scipy_per_feature'] / values['batched'],
+            values['max_abs_diff']))
+    return results
+
+
+def r_agreement(shapes, seed=0):
+    """ Largest difference per column between ALDEx2 in R and the native
+    engine, run on the same simulated table with the kernel shapes'
+    instances, samples and features.
+
+    The engines draw different instances, so the differences include Monte
+    Carlo error; the native engine run with another seed gives its size.
+    Returns None when Rscript or run_aldex2.R is not on the PATH.
+    """
+    if shutil.which('Rscript') is None or \
+            shutil.which('run_aldex2.R') is None:
+        print('Skipping the R agreement check: Rscript or run_aldex2.R is '
+              'not on the PATH.')
+        return None
+    import qiime2
+    from q2_aldex2._method import aldex2
+
+    results = {}
+    for shape in shapes:
+        mc_samples, n_samples, n_features = KERNEL_SHAPES[shape]
+        table, labels = _simulate(n_samples // 2, n_features, 10000, seed)
+        metadata = qiime2.CategoricalMetadataColumn(labels)
+        r, native, other = [
+            aldex2(table, metadata, mc_samples, engine=engine, seed=seed_,
+                   use_cache=False)
+            for engine, seed_ in [('R', seed), ('native', seed),
+                                  ('native', seed + 1)]]
+        index = r.index.intersection(native.index)
+        for column in r.columns.intersection(native.columns):
+            results['%s/%s' % (shape, column)] = {
+                'vs_r': float(np.nanmax(np.abs(
+                    r.loc[index, column] - native.loc[index, column]))),
+                'vs_seed': float(np.nanmax(np.abs(
+                    other.loc[index, column] - native.loc[index, column]))),
+            }
+    print('%-20s %10s %10s' % ('column', 'vs R', 'vs seed'))
+    for name, values in results.items():
+        print('%-20s %10.1e %10.1e' % (name, values['vs_r'],
+                                       values['vs_seed']))
+    return results
+
+
+def sampling(tiers, modes=('mc', 'antithetic', 'fast'), n_seeds=8):
+    """ Monte Carlo error per second of every sampling mode.
+
+    Runs the native engine `n_seeds` times per mode on one simulated table
+    and takes the variance over seeds of the expected p-values and effects
+    of every feature. A mode's efficiency relative to 'mc' is
+    `var_mc * seconds_mc / (var * seconds)`: above 1 it reaches a given
+    Monte Carlo error sooner than independent draws.
+    """
+    from q2_aldex2._native import aldex2_native
+
+    columns = ['we.ep', 'wi.ep', 'we.eBH', 'effect']
+    results = {}
+    for tier in tiers:
+        params = TIERS[tier]
+        table, labels = _simulate(params['reps'], params['n_species'],
+                                  params['library_size'], 0)
+        counts = table.matrix_data.T.tocsr()
+        features = table.ids(axis='observation')
+        for mode in modes:
+            seconds = 0
+            runs = []
+            for seed in range(n_seeds):
+                start = time.perf_counter()
+                runs.append(aldex2_native(counts, features, labels,
+                                          params['mc_samples'], seed=seed,
+                                          sampling=mode)[columns].values)
+                seconds += time.perf_counter() - start
+            results['%s/%s' % (tier, mode)] = {
+                'seconds': seconds / n_seeds,
+                'variance': dict(zip(columns, np.var(
+                    runs, axis=0, ddof=1).mean(axis=0).tolist())),
+            }
+    print('%-18s %9s %s' % ('sampling', 'seconds', ' '.join(
+        '%14s' % ('%s eff.' % column) for column in columns)))
+    for name, values in results.items():
+        mc = results[name.split('/')[0] + '/mc']
+        print('%-18s %8.3fs %s' % (name, values['seconds'], ' '.join(
+            '%14.2f' % (mc['variance'][column] * mc['seconds'] /
+                        (values['variance'][column] * values['seconds']))
+            for column in columns)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('--tier', action='append', choices=list(TIERS),
+                            help='tier to run (repeatable; default: small '
+                                 'and medium)')
+    run_parser.add_argument('--engine', choices=['R', 'native'],
+                            default='native')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='JSON file to write')
+    compare_parser = commands.add_parser(
+        'compare', help='report regressions between two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative increase counted as a '
+                                     'regression (default: 0.1)')
+    kernels_parser = commands.add_parser(
+        'kernels', help='time the batched test kernels against SciPy')
+    kernels_parser.add_argument('--shape', action='append',
+                                choices=list(KERNEL_SHAPES),
+                                help='shape to time (repeatable; default: '
+                                     'all)')
+    kernels_parser.add_argument('--r', action='store_true',
+                                help='also report the largest difference '
+                                     'per column from ALDEx2 in R (skipped '
+                                     'when Rscript is missing)')
+    sampling_parser = commands.add_parser(
+        'sampling', help='compare the efficiency of the sampling modes')
+    sampling_parser.add_argument('--tier', action='append',
+                                 choices=list(TIERS),
+                                 help='tier to run (repeatable; default: '
+                                      'small and medium)')
+    sampling_parser.add_argument('--seeds', type=int, default=8,
+                                 help='runs per mode (default: 8)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(args.tier or ['small', 'medium'], args.engine,
+                      args.seed, args.output)
+        return 1 if results['failed'] else 0
+    if args.command == 'compare':
+        with open(args.old) as fh:
+            old = json.load(fh)
+        with open(args.new) as fh:
+            new = json.load(fh)
+        regressions = compare(old, new, args.threshold)
+        print('%s (%s) -> %s (%s)' % (old['version'], old['engine'],
+                                      new['version'], new['engine']))
+        for tier, stage, metric, before, after, ratio in regressions:
+            print('%-8s %-20s %-18s %10.3f -> %10.3f (x%.2f)'
+                  % (tier, stage, metric, before, after, ratio))
+        failed = new.get('failed', {})
+        for tier, exitcode in failed.items():
+            print('%-8s failed with exit code %s' % (tier, exitcode))
+        if not regressions and not failed:
+            print('No regressions above %d%%.' % (100 * args.threshold))
+        return 1 if regressions or failed else 0
+    if args.command == 'kernels':
+        kernels(args.shape or list(KERNEL_SHAPES))
+        if args.r:
+            r_agreement(args.shape or list(KERNEL_SHAPES))
+        return 0
+    if args.command == 'sampling':
+        sampling(args.tier or ['small', 'medium'], n_seeds=args.seeds)
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from ._method import aldex2
+from ._method import aldex2, aldex2_plan, scale_sweep_table
 
 
-__all__ = ['aldex2']
+__all__ = ['aldex2', 'aldex2_plan', 'scale_sweep_table']
@@ -0,0 +1,131 @@
+import os
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+# Where cached differentials live; defaults to $XDG_CACHE_HOME/q2-aldex2
+CACHE_DIR_ENV = 'Q2_ALDEX2_CACHE_DIR'
+# Upper bound on the total size of the cache in megabytes
+CACHE_SIZE_ENV = 'Q2_ALDEX2_CACHE_SIZE'
+
+_DEFAULT_SIZE_MB = 1024
+_SUFFIX = '.npz'
+
+
+def cache_dir():
+    path = os.environ.get(CACHE_DIR_ENV)
+    if not path:
+        root = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(root, 'q2-aldex2')
+    return path
+
+
+def _size_cap():
+    return int(float(os.environ.get(CACHE_SIZE_ENV) or _DEFAULT_SIZE_MB)
+               * 2 ** 20)
+
+
+def _update_ids(digest, ids):
+    digest.update('\n'.join(map(str, ids)).encode('utf-8'))
+    digest.update(b'\0')
+
+
+def key(table, conditions, **params):
+    """ Content hash of a run.
+
+    Covers the table's IDs and sparse counts, the condition of every sample
+    in table order (unless `conditions` is None), and `params`, which should
+    hold everything else that changes the result (e.g. mc_samples, test,
+    denom, seed and engine version) but nothing that does not (e.g. chunk
+    sizes or worker counts).
+    """
+    digest = hashlib.sha256()
+    _update_ids(digest, table.ids(axis='sample'))
+    _update_ids(digest, table.ids(axis='observation'))
+    matrix = sparse.csc_matrix(table.matrix_data, copy=True)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    digest.update(np.asarray(matrix.indptr, dtype='<i8').tobytes())
+    digest.update(np.asarray(matrix.indices, dtype='<i8').tobytes())
+    digest.update(np.asarray(matrix.data, dtype='<f8').tobytes())
+    if conditions is not None:
+        _update_ids(digest, conditions.astype(str))
+    _update_ids(digest, ('%s=%r' % item for item in sorted(params.items())))
+    return digest.hexdigest()
+
+
+def _path(key):
+    return os.path.join(cache_dir(), key + _SUFFIX)
+
+
+def load(key):
+    """ The cached differentials for `key`, or None on a miss. """
+    path = _path(key)
+    try:
+        with np.load(path, allow_pickle=False) as stored:
+            summary = pd.DataFrame(stored['values'],
+                                   index=pd.Index(stored['index'],
+                                                  name='featureid'),
+                                   columns=stored['columns'])
+    except (OSError, KeyError, ValueError):
+        return None
+    try:
+        _touch(path)
+    except OSError:
+        pass
+    return summary
+
+
+def _touch(path):
+    # the modification time records the last use for the LRU eviction; set
+    # it explicitly as some filesystems only keep coarse timestamps
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def store(key, summary):
+    directory = cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, values=summary.values.astype(np.float64),
+                     index=np.array(summary.index, dtype=str),
+                     columns=np.array(summary.columns, dtype=str))
+        os.replace(tmp, _path(key))
+        _touch(_path(key))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    evict()
+
+
+def evict(size_cap=None):
+    """ Drop least recently used entries until the cache fits `size_cap`. """
+    if size_cap is None:
+        size_cap = _size_cap()
+    directory = cache_dir()
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(_SUFFIX):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= size_cap:
+            break
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
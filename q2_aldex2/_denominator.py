@@ -0,0 +1,112 @@
+import numpy as np
+
+
+# The named denominators of `aldex.set.mode`
+DENOMINATORS = ('all', 'iqlr', 'zero', 'lvha')
+
+# The ones selected within every group, which depend on the grouping
+GROUPED = ('zero', 'lvha')
+
+
+def _log_means(count_blocks, n_samples, n_features, prior):
+    """ Per-sample mean of log2(counts + prior) over all features. """
+    mean = np.zeros((n_samples, 1))
+    for _, block in count_blocks():
+        mean += np.log2(block + prior).sum(axis=1, keepdims=True)
+    return mean / n_features
+
+
+def _clr_moments(count_blocks, n_samples, n_features, prior, rows):
+    """ Per-feature mean and variance of the prior-adjusted clr values of
+    the samples in `rows`.
+    """
+    mean = _log_means(count_blocks, n_samples, n_features, prior)
+    abundance = np.empty(n_features)
+    var = np.empty(n_features)
+    for cols, block in count_blocks():
+        clr = np.log2(block[rows] + prior) - mean[rows]
+        abundance[cols] = clr.mean(axis=0)
+        var[cols] = clr.var(axis=0, ddof=1)
+    return abundance, var
+
+
+def select(count_blocks, n_samples, n_features, labels, denom, prior):
+    """ Denominator features of every group, as a (groups, features) mask.
+
+    `count_blocks` is a callable yielding (columns, dense counts) for every
+    block of features, and `labels` the group of every sample. A mask with
+    a single row applies to every sample. `denom` is one of
+    `DENOMINATORS`, mirroring `aldex.set.mode`, or a sequence of feature
+    indices:
+
+    - 'all': every feature.
+    - 'iqlr': features whose clr variance over all samples lies strictly
+      inside its interquartile range.
+    - 'zero': for every group, the features without a zero count in any of
+      its samples.
+    - 'lvha': features in the lowest quartile of clr variance and the
+      highest quartile of mean clr abundance within every group.
+    """
+    n_groups = labels.max() + 1
+    if isinstance(denom, str):
+        if denom == 'all':
+            return np.ones((1, n_features), dtype=bool)
+        if denom == 'iqlr':
+            _, var = _clr_moments(count_blocks, n_samples, n_features, prior,
+                                  slice(None))
+            q1, q3 = np.quantile(var, [0.25, 0.75])
+            mask = ((var > q1) & (var < q3))[None]
+        elif denom == 'zero':
+            mask = np.ones((n_groups, n_features), dtype=bool)
+            for cols, block in count_blocks():
+                for g in range(n_groups):
+                    mask[g, cols] = (block[labels == g] > 0).all(axis=0)
+        elif denom == 'lvha':
+            mask = np.ones((1, n_features), dtype=bool)
+            for g in range(n_groups):
+                abundance, var = _clr_moments(count_blocks, n_samples,
+                                              n_features, prior, labels == g)
+                mask &= (var <= np.quantile(var, 0.25)) & \
+                    (abundance >= np.quantile(abundance, 0.75))
+        else:
+            raise ValueError('Unknown denominator %r.' % denom)
+    else:
+        mask = np.zeros((1, n_features), dtype=bool)
+        mask[0, np.asarray(denom, dtype=int)] = True
+    if not mask.any(axis=1).all():
+        raise ValueError('The %r denominator selects no features%s.' % (
+            denom if isinstance(denom, str) else 'feature list',
+            '' if len(mask) == 1 else ' in at least one group'))
+    return mask
+
+
+def weights(masks, n_groups):
+    """ Stack denominator masks into (denominators, groups, features)
+    weights that average a sample's log values over its group's
+    denominator.
+    """
+    masks = [np.broadcast_to(mask, (n_groups, mask.shape[1]))
+             for mask in masks]
+    return np.stack([mask / mask.sum(axis=1, keepdims=True)
+                     for mask in masks])
+
+
+def normalisers(log, weights, labels):
+    """ Partial denominator means of one block of logs.
+
+    `log` is an (instances, samples, features) block, `weights` the
+    matching columns of `weights` and `labels` the group of every sample.
+    Every sample is weighted by its own group's row, with a single matrix
+    product over all denominators and groups and no copy of `log`. With
+    several groupings of the samples, `labels` is (groupings, samples) and
+    the denominators are ordered by grouping; samples outside a grouping
+    (negative labels) get an arbitrary sum. Returns (denominators,
+    instances, samples, 1) sums.
+    """
+    n_denoms, n_groups, n_features = weights.shape
+    labels = np.maximum(np.atleast_2d(labels), 0)
+    labels = np.repeat(labels, n_denoms // len(labels), axis=0)
+    sums = log @ weights.reshape(-1, n_features).T
+    sums = sums.reshape(sums.shape[:2] + (n_denoms, n_groups))
+    sums = np.take_along_axis(sums, labels.T[None, :, :, None], axis=-1)
+    return np.moveaxis(sums, 2, 0)
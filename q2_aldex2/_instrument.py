@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import contextlib
+
+
+# Path of a JSON lines file that gets one record per instrumented call;
+# unset (and without a sink, see `set_sink`) disables the instrumentation
+INSTRUMENT_ENV = 'Q2_ALDEX2_INSTRUMENT'
+
+# File next to the ALDEx2 summary in which run_aldex2.R reports its stages
+_R_STAGES_SUFFIX = '.stages'
+
+_sink = None
+
+
+def set_sink(sink):
+    """ Send every record to `sink`, a callable taking the record dict,
+    instead of (or when it is unset) the $Q2_ALDEX2_INSTRUMENT file.
+    None restores the default.
+    """
+    global _sink
+    _sink = sink
+
+
+def enabled():
+    return _sink is not None or bool(os.environ.get(INSTRUMENT_ENV))
+
+
+def r_stages_path(summary_path):
+    return summary_path + _R_STAGES_SUFFIX
+
+
+def _peak_rss_mb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.perf_counter(), own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime)
+
+
+class Recorder:
+    """ Wall time, CPU time and peak RSS of the stages of one call.
+
+    CPU time is split into this process and its (waited for) child
+    processes, such as Rscript, as `getrusage` reports them. The peak RSS
+    of either is the high-water mark reached by the end of a stage, so it
+    only grows from one stage to the next. Stages are timed as `with`
+    blocks (`stage`) or, in straight-line code, from one `checkpoint` to
+    the next. Stages reported by R itself are added with `add_r_stages`.
+    """
+
+    def __init__(self, action, **params):
+        self.action = action
+        self.params = params
+        self.stages = []
+        self._start = self._last = _usage()
+        self._timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = _usage()
+        try:
+            yield
+        finally:
+            self.stages.append(self._measure(name, start))
+
+    def checkpoint(self, name):
+        """ Record the stage since the previous stage or checkpoint. """
+        self.stages.append(self._measure(name, self._last))
+
+    def _measure(self, name, start):
+        end = self._last = _usage()
+        return {
+            'stage': name,
+            'wall': end[0] - start[0],
+            'cpu': end[1] - start[1],
+            'child_cpu': end[2] - start[2],
+            'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+            'child_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        }
+
+    def add_r_stages(self, summary_path, outer='R'):
+        """ Add the stages run_aldex2.R wrote next to `summary_path`, as
+        '<outer>.<stage>'.
+
+        R measures its stages with `proc.time` and its peak RSS from
+        /proc/self/status where there is one. A warm R worker reports the
+        peak RSS of its whole life. The wall time of the last `outer` stage
+        that R did not account for, mostly starting R, is added as
+        '<outer>.startup'.
+        """
+        path = r_stages_path(summary_path)
+        if not os.path.exists(path):
+            return
+        stages = []
+        with open(path) as fh:
+            header = fh.readline().rstrip('\n').split('\t')
+            for line in fh:
+                values = dict(zip(header, line.rstrip('\n').split('\t')))
+                stage = {'stage': '%s.%s' % (outer, values.pop('stage'))}
+                for key, value in values.items():
+                    stage[key] = None if value == 'NA' else float(value)
+                stages.append(stage)
+        for stage in reversed(self.stages):
+            if stage['stage'] == outer:
+                startup = stage['wall'] - sum(s['wall'] for s in stages)
+                stages.insert(0, {'stage': '%s.startup' % outer,
+                                  'wall': max(startup, 0.), 'cpu': None,
+                                  'child_cpu': None, 'peak_rss_mb': None})
+                break
+        self.stages.extend(stages)
+
+    def summary(self):
+        """ A line per stage for printing. """
+        lines = []
+        for stage in self.stages:
+            rss = stage.get('peak_rss_mb')
+            line = '  %-20s %9.3fs wall' % (stage['stage'], stage['wall'])
+            if stage.get('cpu') is not None:
+                line += ' %9.3fs cpu' % stage['cpu']
+            if rss is not None:
+                line += ' %8.1f MB peak' % rss
+            if stage.get('child_cpu'):
+                line += ' (children: %.3fs cpu, %.1f MB peak)' % (
+                    stage['child_cpu'], stage.get('child_peak_rss_mb') or 0)
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def record(self):
+        total = self._measure('total', self._start)
+        del total['stage']
+        return {
+            'action': self.action,
+            'timestamp': self._timestamp,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'params': self.params,
+            'total': total,
+            'stages': self.stages,
+        }
+
+    def emit(self):
+        """ Hand the record to the sink, or append it to the
+        $Q2_ALDEX2_INSTRUMENT file.
+        """
+        record = self.record()
+        if _sink is not None:
+            _sink(record)
+            return record
+        path = os.environ.get(INSTRUMENT_ENV)
+        if path:
+            with open(path, 'a') as fh:
+                fh.write(json.dumps(record, default=str) + '\n')
+        return record
+
+
+class _NullRecorder:
+    """ Stand-in when the instrumentation is disabled. """
+
+    stages = ()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def checkpoint(self, name):
+        pass
+
+    def add_r_stages(self, summary_path, outer='R'):
+        pass
+
+    def summary(self):
+        return ''
+
+    def emit(self):
+        return None
+
+
+def recorder(action, **params):
+    """ A `Recorder` for one call of `action`, or a no-op one when the
+    instrumentation is disabled.
+    """
+    if not enabled():
+        return _NullRecorder()
+    return Recorder(action, **params)
@@ -1,31 +1,69 @@
 import os
+import biom
+import functools
 import qiime2
 import pandas as pd
 import tempfile
+import warnings
 import subprocess
 
-from q2_aldex2._visualizer import _effect_statistic_functions
+from q2_aldex2._visualizer import (_check_columns, _effect_columns,
+                                   _effect_statistic_functions)
+from q2_aldex2._native import aldex2_native, ENGINE_VERSION
+from q2_aldex2._version import get_versions
+from q2_aldex2 import (_cache, _denominator, _instrument, _plan,
+                       _posterior, _profile, _rworker, _transport)
 
 
-def run_commands(cmds, verbose=True):
+def run_commands(cmds, verbose=True, recorder=None):
     if verbose:
         print("Running external command line application(s). This may print "
               "messages to stdout and/or stderr.")
         print("The command(s) being run are below. These commands cannot "
               "be manually re-run as they will depend on temporary files that "
               "no longer exist.")
+    own = recorder is None
+    if own:
+        recorder = _instrument.recorder('run_commands')
     for cmd in cmds:
         if verbose:
             print("\nCommand:", end=' ')
             print(" ".join(cmd), end='\n\n')
-        subprocess.run(cmd, check=True)
+        with recorder.stage('R'):
+            subprocess.run(cmd, check=True)
+    if verbose and recorder.stages:
+        print("\nResource usage (child CPU and peak RSS from getrusage):")
+        print(recorder.summary())
+    if own:
+        recorder.emit()
 
 
-def aldex2(table: pd.DataFrame,
+@_profile.profiled('aldex2')
+def aldex2(table: biom.Table,
            metadata: qiime2.CategoricalMetadataColumn,
            mc_samples: int = 128,
            test: str = 't',
-           denom: str = 'all') -> pd.DataFrame:
+           denom: str = 'all',
+           engine: str = 'R',
+           seed: int = None,
+           chunk_size: int = None,
+           n_jobs: int = None,
+           use_cache: bool = False,
+           reuse_posterior: bool = False,
+           mc_batch_size: int = None,
+           effect_ci: bool = False,
+           effect_sketch: int = None,
+           mc_min_samples: int = 32,
+           mc_max_samples: int = 1024,
+           mc_tolerance: float = 0.02,
+           sampling: str = 'mc',
+           fast_threshold: float = 100,
+           denom_features: list = None) -> pd.DataFrame:
+
+    recorder = _instrument.recorder(
+        'aldex2', engine=engine, mc_samples=mc_samples, test=test,
+        denom=denom if isinstance(denom, str) else 'custom',
+        n_samples=table.shape[1], n_features=table.shape[0])
 
     # create series from the metadata column
     meta = metadata.to_series()
@@ -36,33 +74,368 @@ def aldex2(table: pd.DataFrame,
     # filter the metadata so only the samples present in the table are used
     # this also reorders it for the correct condition selection
     # it has to be re ordered for aldex to correctly input the conditions
-    meta = meta.loc[list(table.index)]
+    meta = meta.loc[list(table.ids(axis='sample'))]
+
+    if mc_samples == 'auto' and engine != 'native':
+        raise ValueError('mc_samples=\'auto\' requires the native engine.')
+    if engine != 'native':
+        native_only = [name for name, given in [
+            ('chunk_size', chunk_size is not None),
+            ('n_jobs', n_jobs not in (None, 1)),
+            ('reuse_posterior', reuse_posterior),
+            ('mc_batch_size', mc_batch_size is not None),
+            ('effect_ci', effect_ci),
+            ('effect_sketch', effect_sketch is not None),
+            ('sampling', sampling != 'mc')] if given]
+        if native_only:
+            raise ValueError('%s require%s the native engine.' % (
+                ', '.join(native_only), 's' if len(native_only) == 1 else ''))
+
+    # ALDEx2 drops features without a single read; doing it here keeps the
+    # table sparse and shrinks what is handed to either engine
+    with recorder.stage('filter'):
+        table = table.remove_empty(axis='observation', inplace=False)
+
+    if denom_features:
+        denom = _denom_features(table, denom_features)
+
+    # unseeded runs are not reproducible, so there is nothing to reuse
+    key = None
+    if use_cache and seed is not None:
+        # the batches set where sampling stops under mc_samples='auto', what
+        # the effect sketches hold and which antithetic draws are accepted;
+        # otherwise they only bound memory
+        batched = mc_samples == 'auto' or effect_sketch is not None or \
+            sampling == 'antithetic'
+        with recorder.stage('cache.load'):
+            key = _cache.key(table, meta, mc_samples=mc_samples, test=test,
+                             denom=denom, seed=seed, engine=engine,
+                             effect_ci=effect_ci,
+                             effect_sketch=effect_sketch,
+                             mc_batch_size=mc_batch_size if batched else None,
+                             mc_min_samples=mc_min_samples,
+                             mc_max_samples=mc_max_samples,
+                             mc_tolerance=mc_tolerance, sampling=sampling,
+                             fast_threshold=fast_threshold,
+                             version=_engine_version(engine))
+            summary = _cache.load(key)
+        if summary is not None:
+            recorder.emit()
+            return summary
+
+    # fail before drawing anything if the run cannot fit in memory
+    with recorder.stage('plan'):
+        plan = _plan_run(table, mc_samples, test, engine, chunk_size, n_jobs,
+                         mc_batch_size, sampling, mc_max_samples)
+    plan.check()
+    chunk_size, n_jobs = plan.chunk_size, plan.n_jobs
+
+    if engine == 'native':
+        posterior = None
+        if reuse_posterior:
+            # the clr instances do not depend on the test, nor on the
+            # grouping unless the denominator is chosen within every group
+            grouped = isinstance(denom, str) and \
+                denom in _denominator.GROUPED
+            posterior = _posterior.path_for(_cache.key(
+                table, meta if grouped else None, mc_samples=mc_samples,
+                denom=denom, seed=seed, sampling=sampling,
+                fast_threshold=fast_threshold,
+                version=_engine_version(engine)))
+        counts = table.matrix_data.T
+        with recorder.stage('native'):
+            summary = aldex2_native(counts, table.ids(axis='observation'),
+                                    meta, mc_samples, test, denom, seed,
+                                    chunk_size, n_jobs, posterior,
+                                    mc_batch_size, effect_ci, effect_sketch,
+                                    mc_min_samples, mc_max_samples,
+                                    mc_tolerance, sampling, fast_threshold)
+    else:
+        summary = _aldex2_r(table, meta, condition, mc_samples, test, denom,
+                            seed, recorder)
+
+    if key is not None:
+        with recorder.stage('cache.store'):
+            _cache.store(key, summary)
+    recorder.emit()
+    return summary
+
+
+def aldex2_plan(table: biom.Table,
+                mc_samples: int = 128,
+                test: str = 't',
+                engine: str = 'R',
+                chunk_size: int = None,
+                n_jobs: int = None,
+                mc_batch_size: int = None,
+                sampling: str = 'mc',
+                mc_max_samples: int = 1024) -> _plan.Plan:
+    """ Dry run of `aldex2`: the chunk size and worker count it would use
+    and its predicted peak memory and runtime, without running it.
+
+    The plan's `problem` explains why `aldex2` would refuse to run, if it
+    would; printing the plan gives a summary.
+    """
+    table = table.remove_empty(axis='observation', inplace=False)
+    return _plan_run(table, mc_samples, test, engine, chunk_size, n_jobs,
+                     mc_batch_size, sampling, mc_max_samples, quick=False)
+
+
+def _plan_run(table, mc_samples, test, engine, chunk_size, n_jobs,
+              mc_batch_size, sampling='mc', mc_max_samples=1024,
+              n_variants=1, quick=True):
+    n_features, n_samples = table.shape
+    return _plan.plan(n_samples, n_features, table.matrix_data.nnz,
+                      mc_samples, test, engine, chunk_size, n_jobs,
+                      mc_batch_size, sampling, mc_max_samples, n_variants,
+                      quick=quick)
+
+
+def aldex2_denominators(table: biom.Table,
+                        metadata: qiime2.CategoricalMetadataColumn,
+                        denoms: list = None,
+                        mc_samples: int = 128,
+                        test: str = 't',
+                        seed: int = None,
+                        chunk_size: int = None,
+                        n_jobs: int = 1,
+                        mc_batch_size: int = None) -> dict:
+    """ Native ALDEx2 with several denominators on one set of instances.
+
+    Returns the differentials of every denominator, keyed by its name.
+    """
+    if not denoms:
+        denoms = ['all', 'iqlr']
+    meta = metadata.to_series().loc[list(table.ids(axis='sample'))]
+    table = table.remove_empty(axis='observation', inplace=False)
+    plan = _plan_run(table, mc_samples, test, 'native', chunk_size, n_jobs,
+                     mc_batch_size, n_variants=len(denoms)).check()
+    summary = aldex2_native(table.matrix_data.T,
+                            table.ids(axis='observation'), meta, mc_samples,
+                            test, {denom: denom for denom in denoms}, seed,
+                            plan.chunk_size, plan.n_jobs,
+                            mc_batch_size=mc_batch_size)
+    return _collection(summary)
+
+
+def aldex2_batch(table: biom.Table,
+                 metadata: qiime2.Metadata,
+                 columns: list = None,
+                 mc_samples: int = 128,
+                 test: str = 't',
+                 denom: str = 'all',
+                 seed: int = None,
+                 chunk_size: int = None,
+                 n_jobs: int = 1,
+                 mc_batch_size: int = None) -> dict:
+    """ Native ALDEx2 of several conditions on one set of instances.
+
+    The table is drawn and clr transformed once and every metadata column
+    is tested on the same instances, leaving out the samples it has no
+    value for. Returns the differentials of every column, keyed by its
+    name. By default every categorical column is tested, except those the
+    test cannot group: columns with a single level and, for test='t', with
+    more than two.
+    """
+    categorical = [name for name, props in metadata.columns.items()
+                   if props.type == 'categorical']
+    meta = metadata.to_dataframe().loc[list(table.ids(axis='sample'))]
+    if not columns:
+        columns = []
+        for name in categorical:
+            levels = meta[name].nunique()
+            if levels < 2 or (test == 't' and levels > 2):
+                warnings.warn('Skipping metadata column %s: %d level%s.%s' % (
+                    name, levels, '' if levels == 1 else 's',
+                    ' Use test=\'glm\' to test it.' if levels > 2 else ''))
+            else:
+                columns.append(name)
+    unknown = [name for name in columns if name not in categorical]
+    if unknown:
+        raise ValueError('Not categorical metadata columns: %s'
+                         % ', '.join(unknown))
+    if not columns:
+        raise ValueError('The metadata has no categorical columns the %r '
+                         'test can group the samples by.' % test)
+    meta = meta[list(columns)]
+    table = table.remove_empty(axis='observation', inplace=False)
+    plan = _plan_run(table, mc_samples, test, 'native', chunk_size, n_jobs,
+                     mc_batch_size, n_variants=len(columns)).check()
+    summary = aldex2_native(table.matrix_data.T,
+                            table.ids(axis='observation'), meta, mc_samples,
+                            test, denom, seed, plan.chunk_size, plan.n_jobs,
+                            mc_batch_size=mc_batch_size)
+    return _collection(summary)
+
+
+def aldex2_contrasts(table: biom.Table,
+                     metadata: qiime2.CategoricalMetadataColumn,
+                     contrasts: str = 'pairwise',
+                     mc_samples: int = 128,
+                     test: str = 't',
+                     denom: str = 'all',
+                     seed: int = None,
+                     chunk_size: int = None,
+                     n_jobs: int = 1,
+                     mc_batch_size: int = None) -> dict:
+    """ Native ALDEx2 of two-group contrasts of a multi-level condition.
 
+    Every pair of groups, or every group against the rest, is tested on one
+    set of instances. Returns the differentials of every contrast, keyed
+    'a-vs-b' or 'a-vs-rest'.
+    """
+    meta = metadata.to_series().loc[list(table.ids(axis='sample'))]
+    table = table.remove_empty(axis='observation', inplace=False)
+    levels = meta.dropna().astype(str).nunique()
+    n_variants = levels * (levels - 1) // 2 if contrasts == 'pairwise' \
+        else levels
+    plan = _plan_run(table, mc_samples, test, 'native', chunk_size, n_jobs,
+                     mc_batch_size, n_variants=n_variants).check()
+    summary = aldex2_native(table.matrix_data.T,
+                            table.ids(axis='observation'), meta, mc_samples,
+                            test, denom, seed, plan.chunk_size, plan.n_jobs,
+                            mc_batch_size=mc_batch_size, contrasts=contrasts)
+    return _collection(summary)
+
+
+# the gammas of the ALDEx2 scale sensitivity vignette
+_GAMMAS = [1e-3, 0.1, 0.25, 0.5, 0.75, 1, 2, 3, 4, 5]
+
+
+def aldex2_scale_sweep(table: biom.Table,
+                       metadata: qiime2.CategoricalMetadataColumn,
+                       gammas: list = None,
+                       mc_samples: int = 128,
+                       test: str = 't',
+                       denom: str = 'all',
+                       seed: int = None,
+                       chunk_size: int = None,
+                       n_jobs: int = 1,
+                       mc_batch_size: int = None) -> dict:
+    """ Native ALDEx2 under a range of scale uncertainties.
+
+    The Dirichlet instances and the scale noise are drawn once and every
+    gamma only changes how far the noise moves the clr values, so the
+    sweep costs one set of draws plus one round of tests per gamma.
+    Returns the differentials of every gamma, keyed by its value;
+    `scale_sweep_table` turns them into one long table.
+    """
+    if not gammas:
+        gammas = _GAMMAS
+    meta = metadata.to_series().loc[list(table.ids(axis='sample'))]
+    table = table.remove_empty(axis='observation', inplace=False)
+    plan = _plan_run(table, mc_samples, test, 'native', chunk_size, n_jobs,
+                     mc_batch_size, n_variants=len(gammas)).check()
+    summary = aldex2_native(table.matrix_data.T,
+                            table.ids(axis='observation'), meta, mc_samples,
+                            test, denom, seed, plan.chunk_size, plan.n_jobs,
+                            mc_batch_size=mc_batch_size, gamma=list(gammas))
+    return _collection(summary)
+
+
+def scale_sweep_table(differentials: dict,
+                      columns: list = ('we.eBH', 'effect')) -> pd.DataFrame:
+    """ The differentials of `aldex2_scale_sweep` as one tidy table, with
+    a row per feature and gamma and the given columns.
+    """
+    frames = {}
+    for gamma, frame in differentials.items():
+        _check_columns(frame, columns, 'the scale sweep table')
+        frames[float(gamma)] = frame.loc[:, list(columns)]
+    return pd.concat(frames, names=['gamma', 'featureid']).reset_index()
+
+
+def _collection(summary):
+    """ Split a (key, featureid) indexed result into one set of
+    differentials per key, keyed by its string.
+
+    Columns a key does not have, such as the group abundances of another
+    condition's levels, are left out.
+    """
+    collection = {}
+    for key in summary.index.get_level_values(0).unique():
+        frame = summary.loc[key].dropna(axis=1, how='all')
+        # the abundances lead, as in a single run
+        rab = frame.columns.str.startswith('rab.')
+        frame = pd.concat([frame.loc[:, rab], frame.loc[:, ~rab]], axis=1)
+        frame.index.name = 'featureid'
+        collection[str(key)] = frame
+    return collection
+
+
+def _denom_features(table, feature_ids):
+    """ Check a user supplied denominator against the (filtered) table. """
+    ids = table.ids(axis='observation')
+    missing = sorted(set(feature_ids) - set(ids))
+    if missing:
+        raise ValueError('Denominator features not found in the table (or '
+                         'without any reads): %s' % ', '.join(missing[:10]))
+    return list(feature_ids)
+
+
+def _engine_version(engine):
+    version = get_versions()['version']
+    if engine == 'native':
+        version += '/native-%d' % ENGINE_VERSION
+    else:
+        version += '/ALDEx2-%s' % _aldex2_version()
+    return version
+
+
+@functools.lru_cache()
+def _aldex2_version():
+    """ Version of the ALDEx2 package `run_aldex2.R` would load. """
+    result = subprocess.run(['run_aldex2.R', '--version'], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    return result.stdout.split()[-1]
+
+
+def _aldex2_r(table, meta, condition, mc_samples, test, denom, seed,
+              recorder=None):
     # force reorder based on the data to ensure conds are selected correctly
 
+    transport = _transport.get_transport()
+    if recorder is None:
+        recorder = _instrument.recorder('aldex2', engine='R')
+
     with tempfile.TemporaryDirectory() as temp_dir_name:
-        biom_fp = os.path.join(temp_dir_name, 'input.tsv.biom')
         map_fp = os.path.join(temp_dir_name, 'input.map.txt')
-        summary_fp = os.path.join(temp_dir_name, 'output.summary.txt')
+        summary_fp = _transport.summary_path(temp_dir_name, transport)
 
-        # Need to manually specify header=True for Series (i.e. "meta"). It's
-        # already the default for DataFrames (i.e. "table"), but we manually
-        # specify it here anyway to alleviate any potential confusion.
-        table.to_csv(biom_fp, sep='\t', header=True)
-        meta.to_csv(map_fp, sep='\t', header=True)
+        with recorder.stage('export'):
+            biom_fp = _transport.write_table(table, temp_dir_name,
+                                             transport)
+            # Need to manually specify header=True for Series (i.e. "meta").
+            meta.to_csv(map_fp, sep='\t', header=True)
+
+        if not isinstance(denom, str):
+            # ALDEx2 takes a custom denominator as row indices
+            position = {id_: i + 1 for i, id_ in
+                        enumerate(table.ids(axis='observation'))}
+            denom = ','.join(str(position[id_]) for id_ in denom)
 
         cmd = ['run_aldex2.R', biom_fp, map_fp, condition, mc_samples,
                test, denom, summary_fp]
+        if seed is not None:
+            cmd.append(seed)
+        if _profile.r_profile_path() is not None:
+            cmd.append('--profile=%s' % _profile.r_profile_path())
         cmd = list(map(str, cmd))
 
+        pool = _rworker.get_pool()
         try:
-            run_commands([cmd])
+            if pool is None:
+                run_commands([cmd], recorder=recorder)
+            else:
+                _rworker.run_commands(pool, [cmd], recorder=recorder)
         except subprocess.CalledProcessError as e:
             raise Exception("An error was encountered while running ALDEx2"
                             " in R (return code %d), please inspect stdout"
                             " and stderr to learn more." % e.returncode)
+        recorder.add_r_stages(summary_fp)
 
-        summary = pd.read_csv(summary_fp, index_col=0)
+        with recorder.stage('import'):
+            summary = _transport.read_summary(summary_fp, transport)
         #differentials = summary[['effect']]
 	# hack to fix column name for features because aldex removes
 	#it in R because of row.names = 1
@@ -76,12 +449,19 @@ def extract_differences(table: pd.DataFrame, sig_threshold: float = 0.1, effect_
     # ensure max or min, depending on case
 
     effect_statistic_function = _effect_statistic_functions[test]
+    _check_columns(table, [effect_statistic_function], 'the %s test' % test)
+    # the Kruskal-Wallis and glm results of `--p-test glm` come without
+    # effect sizes, so only their q scores are thresholded
+    has_effects = all(column in table.columns for column in _effect_columns)
 
     if sig_threshold < table[effect_statistic_function].min():
         raise ValueError("You have selected a significance threshold that "
         "is lower than minimum Q score (-p--sig-threshold). Select a "
         "higher threshold.")
 
+    if not has_effects:
+        return table[table[effect_statistic_function] <= sig_threshold]
+
     # absolute values needed for effect or difference to see change in either
     # condition
     if effect_threshold > abs(table['effect']).max():
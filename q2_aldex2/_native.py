@@ -0,0 +1,947 @@
+import os
+import pickle
+import tempfile
+import collections
+import functools
+import itertools
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, special
+
+from q2_aldex2 import _denominator, _posterior
+from q2_aldex2._sketch import QuantileSketch
+from q2_aldex2._stats import (
+    _bh, _design, _glm, _kruskal, _welch, _wilcox
+)
+
+
+# Bumped whenever a change alters the numbers the native engine produces for
+# a given seed, which invalidates cached results
+ENGINE_VERSION = 6
+
+# ALDEx2 adds this uniform prior to every count before the Dirichlet draws
+_PRIOR = 0.5
+
+# Features per random number stream. Every block of features draws its
+# Dirichlet instances from its own stream, so results do not depend on how
+# blocks are grouped into chunks. Tables are only densified a block at a time.
+_BLOCK_SIZE = 32
+
+# mc_samples='auto': instances drawn per batch unless mc_batch_size is given,
+# and the BH and effect thresholds whose calls must be settled
+_AUTO_BATCH = 16
+_AUTO_ALPHA = 0.05
+_AUTO_EFFECT = 1
+
+# Smallest uniform fed to the inverse Gamma CDF by antithetic sampling, so
+# that no draw underflows to zero (and its log to -inf)
+_U_MIN = 1e-150
+
+# sampling='fast': counts above this use the normal approximation of the
+# log Gamma draw by default
+_FAST_THRESHOLD = 100
+
+
+def _feature_blocks(n_features, size=_BLOCK_SIZE):
+    for start in range(0, n_features, size):
+        yield slice(start, min(start + size, n_features))
+
+
+def _dense(block):
+    """ Dense float64 copy of a (possibly sparse) block of counts. """
+    if sparse.issparse(block):
+        block = block.toarray()
+    return np.asarray(block, dtype=np.float64)
+
+
+def _log_gamma(counts, mc_samples, seed, sampling='mc',
+               fast_threshold=_FAST_THRESHOLD):
+    """ log2 Gamma(counts + prior) draws for one block of features.
+
+    `seed` is the block's SeedSequence, or its Generator when drawing a batch
+    at a time. Returns an (instances, samples, features) array.
+    """
+    alpha = _dense(counts) + _PRIOR
+    rng = _streams(seed, sampling)
+    if sampling == 'fast':
+        return _fast_log_gamma(alpha, mc_samples, rng, fast_threshold)
+    if sampling == 'antithetic':
+        draws = _antithetic_gamma(alpha, mc_samples, rng)
+    else:
+        draws = rng.standard_gamma(alpha, size=(mc_samples,) + alpha.shape)
+    return np.log2(draws, out=draws)
+
+
+def _streams(seed, sampling='mc'):
+    """ The generator(s) a block draws from, given its SeedSequence.
+
+    'fast' sampling uses one stream per kind of cell; Generators are returned
+    unchanged.
+    """
+    if sampling != 'fast':
+        return np.random.default_rng(seed)
+    if not isinstance(seed, np.random.SeedSequence):
+        return seed
+    return tuple(np.random.default_rng(np.random.SeedSequence(
+        seed.entropy, spawn_key=seed.spawn_key + (i,))) for i in range(3))
+
+
+def _fast_log_gamma(alpha, mc_samples, streams, threshold):
+    """ log2 Gamma(alpha) draws, specialised by the count of every cell.
+
+    Zero counts take one normal draw (Gamma(1/2) is Z^2 / 2), counts above
+    `threshold` a normal approximation of log Gamma and the rest exact draws.
+    """
+    zero_rng, gamma_rng, normal_rng = streams
+    log = np.empty((mc_samples,) + alpha.shape)
+    zero = alpha == _PRIOR
+    large = alpha > threshold + _PRIOR
+    small = ~(zero | large)
+
+    z = zero_rng.standard_normal((mc_samples, zero.sum()))
+    log[:, zero] = 2 * np.log2(np.abs(z)) - 1
+    draws = gamma_rng.standard_gamma(alpha[small],
+                                     size=(mc_samples, small.sum()))
+    log[:, small] = np.log2(draws)
+    shape = alpha[large]
+    z = normal_rng.standard_normal((mc_samples, large.sum()))
+    log[:, large] = (special.digamma(shape) +
+                     np.sqrt(special.polygamma(1, shape)) * z) / np.log(2)
+    return log
+
+
+def _antithetic_gamma(alpha, mc_samples, rng):
+    """ Gamma(alpha) draws in antithetic pairs.
+
+    Instances 2k and 2k + 1 are negatively correlated partners; an odd
+    `mc_samples` drops the last partner.
+    """
+    n_pairs = (mc_samples + 1) // 2
+    draws = np.empty((n_pairs, 2) + alpha.shape)
+    half = alpha == _PRIOR
+    u = rng.random((n_pairs, half.sum()))
+    u = np.clip(np.stack([u, 1 - u], axis=1), _U_MIN,
+                1 - np.finfo(np.float64).epsneg)
+    draws[:, :, half] = special.erfinv(u) ** 2
+
+    shape = alpha[~half]
+    # fractional counts below one: Gamma(a) is Gamma(a + 1) U^(1 / a)
+    boost = shape < 1
+    paired = _paired_gamma(np.where(boost, shape + 1, shape), n_pairs, rng)
+    if boost.any():
+        u = rng.random((n_pairs, boost.sum()))
+        u = np.clip(np.stack([u, 1 - u], axis=1), _U_MIN, 1)
+        paired[:, :, boost] *= u ** (1 / shape[boost])
+    draws[:, :, ~half] = paired
+    return draws.reshape((-1,) + alpha.shape)[:mc_samples]
+
+
+def _paired_gamma(shape, n_pairs, rng):
+    """ (n_pairs, 2, len(shape)) antithetic Gamma(shape) draws, shape >= 1.
+
+    The partners of a pair run Marsaglia-Tsang from the proposals z and -z.
+    """
+    d = np.broadcast_to(shape - 1 / 3, (n_pairs, len(shape))).ravel()
+    c = 1 / np.sqrt(9 * d)
+    draws = np.empty((2, d.size))
+    pending = np.ones((2, d.size), dtype=bool)
+    cells = np.arange(d.size)
+    while cells.size:
+        z = rng.standard_normal(cells.size)
+        for partner, sign in enumerate((1, -1)):
+            proposing = pending[partner, cells]
+            i = cells[proposing]
+            zi = sign * z[proposing]
+            v = (1 + c[i] * zi) ** 3
+            log_u = np.log(rng.random(i.size))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                accept = (v > 0) & (log_u < zi ** 2 / 2 + d[i] -
+                                    d[i] * v + d[i] * np.log(v))
+            draws[partner, i[accept]] = d[i[accept]] * v[accept]
+            pending[partner, i[accept]] = False
+        cells = cells[pending[:, cells].any(axis=0)]
+    return draws.reshape(2, n_pairs, len(shape)).swapaxes(0, 1)
+
+
+def _denominator_sum(task, mc_samples, sampling='mc',
+                     fast_threshold=_FAST_THRESHOLD):
+    """ Sum of the log2 draws of one block's denominator features. """
+    counts, weights, seed, labels = task
+    log = _log_gamma(counts, mc_samples, seed, sampling, fast_threshold)
+    return _denominator.normalisers(log, weights, labels)
+
+
+def _ordered_map(executor, fn, tasks, window):
+    """ `map` over an executor with at most `window` tasks in flight.
+
+    Results are yielded in task order, so reductions do not depend on the
+    number of workers.
+    """
+    if executor is None:
+        yield from map(fn, tasks)
+        return
+    with tempfile.TemporaryDirectory() as dir_name:
+        fn = _share(fn, dir_name)
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(fn, task))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# The function a worker process last loaded in `_call_shared`, and its path
+_loaded = [None, None]
+
+
+def _share(fn, dir_name):
+    """ `fn` pickled to a file in `dir_name`, as a small picklable callable
+    that loads it once per process.
+    """
+    path = os.path.join(dir_name, 'fn.pickle')
+    with open(path, 'wb') as fh:
+        pickle.dump(fn, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return functools.partial(_call_shared, path)
+
+
+def _call_shared(path, task):
+    if _loaded[0] != path:
+        with open(path, 'rb') as fh:
+            _loaded[:] = [path, pickle.load(fh)]
+    return _loaded[1](task)
+
+
+def _normalisers(counts, mc_samples, weights, labels, blocks, seeds,
+                 executor, window, sampling='mc',
+                 fast_threshold=_FAST_THRESHOLD):
+    """ Per-instance, per-sample mean log2 Gamma draw of every denominator.
+
+    Returns a (denominators, instances, samples, 1) array.
+    """
+    tasks = ((counts[:, cols], weights[..., cols], seed, labels)
+             for cols, seed in zip(blocks, seeds)
+             if weights[..., cols].any())
+    total = np.zeros((len(weights), mc_samples, counts.shape[0], 1))
+    fn = functools.partial(_denominator_sum, mc_samples=mc_samples,
+                           sampling=sampling, fast_threshold=fast_threshold)
+    for block_sum in _ordered_map(executor, fn, tasks, window):
+        total += block_sum
+    return total
+
+
+def _chunk(task, mc_samples, norm, labels, test, pairing, stored=None,
+           store=None, ci=False, sampling='mc',
+           fast_threshold=_FAST_THRESHOLD, scale=None):
+    """ clr transform and test one chunk of features.
+
+    Returns the per-instance p-values and the effect summaries (None unless
+    there are two groups) of every variant: grouping, denominator and gamma.
+    """
+    counts, weights, seeds, table_cols = task
+    if stored is not None:
+        clr = _posterior.read(stored, table_cols)
+        norm = np.zeros((1, 1, 1, 1))
+    else:
+        clr, norm = _draw_chunk(counts, weights, labels, seeds, mc_samples,
+                                norm, sampling, fast_threshold)
+        if store is not None:
+            _posterior.write(store, table_cols, clr)
+
+    shifts = _shifts(norm, scale)
+    clr -= shifts[0] - norm[0]
+    per_grouping = len(shifts) // len(labels)
+    results = []
+    for k in _recentred(clr, shifts):
+        grouped, labels_ = _grouping(clr, labels[k // per_grouping])
+        pvalues = None if test is None else _tests(grouped, labels_, test)
+        effect = None
+        if labels_.max() == 1:
+            effect = _effect(grouped[:, labels_ == 0],
+                             grouped[:, labels_ == 1],
+                             pairing[k // per_grouping], ci)
+        results.append((pvalues, effect))
+    return results
+
+
+def _grouping(clr, labels):
+    """ The instances and labels of the samples in one grouping.
+
+    Samples outside the grouping are labelled -1.
+    """
+    if labels.min() < 0:
+        inside = labels >= 0
+        return clr[:, inside], labels[inside]
+    return clr, labels
+
+
+def _recentred(clr, shifts):
+    """ Move `clr`, the log draws less `shifts[0]`, to the log draws less
+    every shift in turn, in place, yielding each one's index.
+    """
+    for k in range(len(shifts)):
+        if k:
+            clr -= shifts[k] - shifts[k - 1]
+        yield k
+
+
+def _shifts(norm, scale):
+    """ What is subtracted from the log draws for every variant of a run.
+
+    `scale` is None or the gammas and the (instances, samples, 1) normal
+    draws of a scale model. Variants are ordered by grouping, denominator and
+    gamma.
+    """
+    if scale is None:
+        return norm
+    gammas, noise = scale
+    shifts = norm[:, None] - np.multiply.outer(gammas, noise)[None]
+    return shifts.reshape((-1,) + shifts.shape[2:])
+
+
+def _tests(clr, labels, test):
+    """ Per-instance p-values of `test`, keyed by ALDEx2 column prefix. """
+    n_groups = labels.max() + 1
+    if test == 't':
+        x, y = clr[:, labels == 0], clr[:, labels == 1]
+        return {'we': _welch(x, y), 'wi': _wilcox(x, y)}
+    return {'kw': _kruskal(clr, labels, n_groups),
+            'glm': _glm(clr, _design(labels, n_groups))}
+
+
+def _streamed_tests(counts, weights, blocks, seeds, mc_samples, batch_size,
+                    labels, test, effect=None, convergence=None,
+                    sampling='mc', ess=None,
+                    fast_threshold=_FAST_THRESHOLD, scale=None):
+    """ Expected p-values and BH values, drawing `batch_size` instances of
+    every feature at a time.
+
+    Returns the expected values of every variant, keyed by ALDEx2 column
+    prefix, and the number of instances drawn.
+    """
+    n_samples, n_features = counts.shape
+    rngs = [_streams(seed, sampling) for seed in seeds]
+    sums = None
+    drawn = 0
+    while drawn < mc_samples:
+        size = min(batch_size, mc_samples - drawn)
+        clr = np.empty((size, n_samples, n_features))
+        norm = np.zeros((len(weights), size, n_samples, 1))
+        for cols, rng in zip(blocks, rngs):
+            clr[..., cols] = _log_gamma(counts[:, cols], size, rng, sampling,
+                                        fast_threshold)
+            if weights[..., cols].any():
+                norm += _denominator.normalisers(
+                    clr[..., cols], weights[..., cols], labels)
+        if scale is not None:
+            gammas, noise = scale
+            shifts = _shifts(norm, (gammas, noise[drawn:drawn + size]))
+        else:
+            shifts = norm
+        clr -= shifts[0]
+        drawn += size
+
+        if sums is None:
+            sums = [{} for _ in shifts]
+        per_grouping = len(shifts) // len(labels)
+        for k in _recentred(clr, shifts):
+            grouped, labels_ = _grouping(clr, labels[k // per_grouping])
+            bh = {}
+            for key, value in _tests(grouped, labels_, test).items():
+                p_sum, bh_sum = sums[k].setdefault(
+                    key, (np.zeros(n_features), np.zeros(n_features)))
+                bh[key] = _bh(value)
+                p_sum += value.sum(axis=0)
+                bh_sum += bh[key].sum(axis=0)
+            if effect is not None and effect[k] is not None:
+                effect[k].update(grouped[:, labels_ == 0],
+                                 grouped[:, labels_ == 1])
+            if convergence is not None:
+                convergence[k].update(bh, grouped, labels_)
+            if ess is not None:
+                ess[k].update(bh)
+        del clr
+        if convergence is not None and \
+                all(tracker.converged() for tracker in convergence):
+            break
+    return [{key: (p_sum / drawn, bh_sum / drawn)
+             for key, (p_sum, bh_sum) in sums_.items()}
+            for sums_ in sums], drawn
+
+
+class _Convergence:
+    """ Stopping rule for `mc_samples='auto'`.
+
+    A feature is settled when the Monte Carlo standard error of its BH values
+    and effect is within `tolerance`, or its estimates are three standard
+    errors from the decision threshold.
+    """
+
+    def __init__(self, min_samples, tolerance, rng):
+        self.min_samples = min_samples
+        self.tolerance = tolerance
+        self.rng = rng
+        self.n = 0
+        self.bh = {}
+        self.effects = []
+
+    def update(self, bh, clr, labels):
+        for key, value in bh.items():
+            moments = self.bh.setdefault(key, [0., 0.])
+            moments[0] = moments[0] + value.sum(axis=0)
+            moments[1] = moments[1] + (value ** 2).sum(axis=0)
+        self.n += len(clr)
+        if labels.max() == 1:
+            x, y = clr[:, labels == 0], clr[:, labels == 1]
+            pairing = _pairing(x.shape[1], y.shape[1], x.shape[0], self.rng)
+            self.effects.append(
+                np.median(_effect_values(x, y, pairing)[-1], axis=0))
+
+    def _settled(self, mean, se, threshold):
+        return (se <= self.tolerance) | \
+            (np.abs(mean - threshold) > 3 * se)
+
+    def converged(self):
+        if self.n < self.min_samples:
+            return False
+        for total, squares in self.bh.values():
+            mean = total / self.n
+            var = np.maximum(squares / self.n - mean ** 2, 0) * \
+                self.n / (self.n - 1)
+            if not self._settled(mean, np.sqrt(var / self.n),
+                                 _AUTO_ALPHA).all():
+                return False
+        if len(self.effects) > 1:
+            effects = np.abs(self.effects)
+            se = effects.std(axis=0, ddof=1) / np.sqrt(len(effects))
+            if not self._settled(effects.mean(axis=0), se,
+                                 _AUTO_EFFECT).all():
+                return False
+        return True
+
+
+class _AntitheticEss:
+    """ Effective sample size of the expected BH values under antithetic
+    sampling, from the variance of the pair means.
+    """
+
+    def __init__(self):
+        self.moments = {}
+        self.n = 0
+        self.pairs = 0
+
+    def update(self, bh):
+        for key, value in bh.items():
+            even = len(value) // 2 * 2
+            pairs = (value[0:even:2] + value[1:even:2]) / 2
+            moments = self.moments.setdefault(
+                key, np.zeros((4, value.shape[-1])))
+            moments += [value.sum(axis=0), (value ** 2).sum(axis=0),
+                        pairs.sum(axis=0), (pairs ** 2).sum(axis=0)]
+        self.n += len(value)
+        self.pairs += len(pairs)
+
+    def ess(self):
+        """ The smallest effective sample size of any test, per feature. """
+        n, pairs = self.n, self.pairs
+        result = None
+        for total, squares, pair_total, pair_squares in self.moments.values():
+            var = np.maximum(squares - total ** 2 / n, 0) / (n - 1)
+            pair_var = np.maximum(pair_squares - pair_total ** 2 / pairs,
+                                  0) / (pairs - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ess = var * pairs / pair_var
+            # constant BH values are exact with any number of instances
+            ess[var == 0] = n
+            result = ess if result is None else np.minimum(result, ess)
+        return result
+
+
+def _draw_chunk(counts, weights, labels, seeds, mc_samples, norm,
+                sampling='mc', fast_threshold=_FAST_THRESHOLD):
+    """ clr instances of one chunk, centred on the first denominator, and
+    the normalisers of every denominator.
+    """
+    n_samples, n_features = counts.shape
+    clr = np.empty((mc_samples, n_samples, n_features))
+    total = None
+    if norm is None:
+        total = np.zeros((len(weights), mc_samples, n_samples, 1))
+    for cols, seed in zip(_feature_blocks(n_features), seeds):
+        clr[..., cols] = _log_gamma(counts[:, cols], mc_samples, seed,
+                                    sampling, fast_threshold)
+        if total is not None and weights[..., cols].any():
+            total += _denominator.normalisers(
+                clr[..., cols], weights[..., cols], labels)
+    if total is not None:
+        norm = total
+    clr -= norm[0]
+    return clr, norm
+
+
+def _pairing(n_x, n_y, mc_samples, rng):
+    """ Random pairings of pooled instances used by `_effect`.
+
+    They are drawn once and shared by all features (and chunks).
+    """
+    n_x *= mc_samples
+    n_y *= mc_samples
+    n = min(n_x, n_y)
+    return {
+        'btw': (rng.permutation(n_x)[:n], rng.permutation(n_y)[:n]),
+        'win_x': _within(n_x, n, rng),
+        'win_y': _within(n_y, n, rng),
+    }
+
+
+def _within(size, n, rng):
+    """ `n` pairs of distinct instances out of `size`. """
+    order = rng.permutation(size)
+    return order[:n], np.roll(order, -1)[:n]
+
+
+def _effect_values(x, y, pairing):
+    """ Pooled instances and paired differences behind the effect sizes,
+    as in `aldex.effect`.
+    """
+    n_features = x.shape[-1]
+    x = x.reshape(-1, n_features)
+    y = y.reshape(-1, n_features)
+
+    # ALDEx2 reports the second group minus the first
+    i, j = pairing['btw']
+    btw = y[j] - x[i]
+    i, j = pairing['win_x']
+    win = np.abs(x[i] - x[j])
+    i, j = pairing['win_y']
+    np.maximum(win, np.abs(y[i] - y[j]), out=win)
+    return x, y, btw, win, btw / win
+
+
+def _effect(x, y, pairing, ci=False):
+    """ ALDEx2 effect size summaries, with the effect interval if `ci`. """
+    x, y, btw, win, ratio = _effect_values(x, y, pairing)
+    effect = {
+        'rab.all': np.median(np.concatenate([x, y]), axis=0),
+        'rab.x': np.median(x, axis=0),
+        'rab.y': np.median(y, axis=0),
+        'diff.btw': np.median(btw, axis=0),
+        'diff.win': np.median(win, axis=0),
+        'effect': np.median(ratio, axis=0),
+        'overlap': np.minimum((ratio < 0).mean(axis=0),
+                              (ratio > 0).mean(axis=0)),
+    }
+    if ci:
+        effect['effect.low'], effect['effect.high'] = np.quantile(
+            ratio, [0.025, 0.975], axis=0)
+    return effect
+
+
+class _SketchedEffect:
+    """ Effect size summaries accumulated a batch of instances at a time.
+
+    Medians and the effect interval come from `QuantileSketch`es of `size`
+    points, so memory does not grow with the instances and each compression
+    moves them by at most about `1 / size` in rank.
+    """
+
+    _KEYS = ('rab.all', 'rab.x', 'rab.y', 'diff.btw', 'diff.win', 'effect')
+
+    def __init__(self, n_features, size, rng, ci=False):
+        self.sketches = {key: QuantileSketch(n_features, size)
+                         for key in self._KEYS}
+        self.rng = rng
+        self.ci = ci
+        self.below = np.zeros(n_features)
+        self.above = np.zeros(n_features)
+        self.n = 0
+
+    def update(self, x, y):
+        pairing = _pairing(x.shape[1], y.shape[1], x.shape[0], self.rng)
+        x, y, btw, win, ratio = _effect_values(x, y, pairing)
+        for key, value in zip(self._KEYS, (np.concatenate([x, y]), x, y,
+                                           btw, win, ratio)):
+            self.sketches[key].update(value)
+        self.below += (ratio < 0).sum(axis=0)
+        self.above += (ratio > 0).sum(axis=0)
+        self.n += len(ratio)
+
+    def summary(self):
+        effect = {key: sketch.quantile(0.5)
+                  for key, sketch in self.sketches.items()}
+        effect['overlap'] = np.minimum(self.below, self.above) / self.n
+        if self.ci:
+            effect['effect.low'], effect['effect.high'] = \
+                self.sketches['effect'].quantile([0.025, 0.975])
+        return effect
+
+
+def aldex2_native(counts,
+                  feature_ids,
+                  conditions: pd.Series,
+                  mc_samples: int = 128,
+                  test: str = 't',
+                  denom: str = 'all',
+                  seed: int = None,
+                  chunk_size: int = None,
+                  n_jobs: int = 1,
+                  posterior: str = None,
+                  mc_batch_size: int = None,
+                  effect_ci: bool = False,
+                  effect_sketch: int = None,
+                  mc_min_samples: int = 32,
+                  mc_max_samples: int = 1024,
+                  mc_tolerance: float = 0.02,
+                  sampling: str = 'mc',
+                  fast_threshold: float = _FAST_THRESHOLD,
+                  gamma=None,
+                  contrasts: str = None) -> pd.DataFrame:
+    """ Run the ALDEx2 pipeline in NumPy.
+
+    Parameters
+    ----------
+    counts : np.ndarray or scipy.sparse matrix
+        Samples x features counts, without all-zero features.
+    feature_ids : sequence of str
+        IDs of the columns of `counts`.
+    conditions : pd.Series or pd.DataFrame
+        Group label per sample; a DataFrame tests every column.
+    mc_samples : int or 'auto'
+        Number of Monte Carlo Dirichlet instances, or 'auto' to draw until
+        the results settle.
+    test : str
+        't' (two groups) or 'glm' (two or more groups).
+    denom : str, sequence of str or dict
+        'all', 'iqlr', 'zero', 'lvha' or feature IDs; a dict tests several.
+    seed : int, optional
+        Seed for the random number generator.
+    chunk_size : int, optional
+        Number of features held in memory at once.
+    n_jobs : int
+        Number of worker processes.
+    posterior : str, optional
+        Path of a posterior store to read the instances from or write them to.
+    mc_batch_size : int, optional
+        Test all features this many instances at a time.
+    effect_ci : bool
+        Also report `effect.low` and `effect.high`.
+    effect_sketch : int, optional
+        Points per feature of the effect quantile sketches.
+    mc_min_samples, mc_max_samples : int
+        Range of the number of instances drawn with mc_samples='auto'.
+    mc_tolerance : float
+        Standard error at which a value settles with mc_samples='auto'.
+    sampling : str
+        'mc', 'antithetic' or 'fast'.
+    fast_threshold : float
+        Count above which 'fast' sampling approximates the log Gamma draw.
+    gamma : float or sequence of float, optional
+        Scale uncertainty, as `aldex(..., gamma=)`.
+    contrasts : str, optional
+        'pairwise' or 'one-vs-rest' comparisons of the groups.
+
+    Returns
+    -------
+    pd.DataFrame
+        The columns `aldex(..., effect=TRUE)` reports, one row per feature,
+        indexed by variant ahead of featureid when there are several.
+    """
+    if contrasts is not None:
+        if isinstance(conditions, pd.DataFrame):
+            raise ValueError('Contrasts are drawn between the groups of a '
+                             'single condition.')
+        conditions = _contrasts(conditions, contrasts)
+
+    auto = mc_samples == 'auto'
+    if auto:
+        if posterior is not None:
+            raise ValueError('mc_samples=\'auto\' cannot be combined with a '
+                             'posterior store, which holds a fixed number '
+                             'of instances.')
+        if not 1 < mc_min_samples <= mc_max_samples:
+            raise ValueError('mc_min_samples must be at least 2 and at most '
+                             'mc_max_samples.')
+        if mc_batch_size is None:
+            mc_batch_size = _AUTO_BATCH
+        mc_samples = mc_max_samples
+
+    several = isinstance(conditions, pd.DataFrame)
+    frame = conditions if several else conditions.to_frame()
+    # the groups of every condition, with -1 for missing labels
+    levels = []
+    labels = np.full(frame.shape[::-1], -1)
+    for i, (name, column) in enumerate(frame.items()):
+        inside = column.notna().values
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # the groups in the order of the categories
+            column = column[inside].cat.remove_unused_categories()
+            levels_ = column.cat.categories.astype(str).values
+            labels_ = column.cat.codes.values
+        else:
+            levels_, labels_ = np.unique(column[inside].astype(str).values,
+                                         return_inverse=True)
+        labels[i, inside] = labels_.ravel()
+        levels.append(levels_)
+        where = ' %r' % name if several else ''
+        if test == 't' and len(levels_) != 2:
+            raise ValueError('The t test requires exactly two groups in the '
+                             'condition%s, found %d. Use test=\'glm\' for '
+                             'more groups.' % (where, len(levels_)))
+        if len(levels_) < 2:
+            raise ValueError('The condition%s needs at least two groups.'
+                             % where)
+    if sampling not in ('mc', 'antithetic', 'fast'):
+        raise ValueError('Unknown sampling %r.' % sampling)
+    if test not in ('t', 'glm'):
+        raise ValueError('Unknown test %r for the native engine.' % test)
+
+    if mc_batch_size is not None and posterior is not None:
+        raise ValueError('Streaming the Monte Carlo instances in batches '
+                         'cannot be combined with a posterior store.')
+    if effect_sketch is not None and mc_batch_size is None:
+        raise ValueError('Sketched effect sizes are computed while streaming '
+                         'the instances and require mc_batch_size.')
+
+    if sparse.issparse(counts):
+        counts = sparse.csc_matrix(counts)
+
+    n_samples, n_features = counts.shape
+    blocks = list(_feature_blocks(n_features))
+    denoms = denom if isinstance(denom, dict) else {None: denom}
+    if posterior is not None and len(denoms) > 1:
+        raise ValueError('A posterior store holds the instances of a single '
+                         'denominator.')
+    if posterior is not None and several:
+        raise ValueError('A posterior store holds the instances centred for '
+                         'a single condition.')
+    gammas = None
+    if gamma is not None:
+        gammas = np.atleast_1d(np.asarray(gamma, dtype=np.float64))
+        if gammas.ndim != 1 or not len(gammas) or (gammas < 0).any():
+            raise ValueError('gamma must be a non-negative number or a '
+                             'non-empty sequence of them.')
+    # every condition, denominator and gamma of a scale model is a variant
+    variants = [(name, label, g) for name in frame for label in denoms
+                for g in (gammas if gammas is not None else [None])]
+    per_grouping = len(variants) // len(frame.columns)
+    # one row of weights per group, padded to the most groups of any
+    # condition
+    n_groups = max(len(levels_) for levels_ in levels)
+    weights = []
+    for levels_, labels_ in zip(levels, labels):
+        inside = labels_ >= 0
+        rows = counts if inside.all() else counts[inside]
+        weights_ = _denominator.weights(
+            [_denominator_mask(rows, feature_ids, labels_[inside], blocks,
+                               spec)
+             for spec in denoms.values()], len(levels_))
+        weights.append(np.pad(weights_, ((0, 0),
+                                         (0, n_groups - len(levels_)),
+                                         (0, 0))))
+    weights = np.concatenate(weights)
+    two = [len(levels_) == 2 for levels_ in levels]
+    # one stream per feature block, plus one for the effect pairings
+    root = np.random.SeedSequence(seed)
+    seeds = root.spawn(len(blocks) + 1)
+    scale = None
+    if gammas is not None:
+        # one normal draw per instance and sample, shared by every feature
+        # and every gamma, from a stream of its own
+        noise = np.random.default_rng(root.spawn(1)[0]).standard_normal(
+            (mc_samples, n_samples, 1))
+        scale = (gammas, noise)
+
+    if n_jobs > 1 and chunk_size is None:
+        # give every worker something to do
+        chunk_size = -(-n_features // n_jobs)
+    if chunk_size is None or chunk_size >= n_features:
+        per_chunk = len(blocks)
+    else:
+        per_chunk = max(1, -(-chunk_size // _BLOCK_SIZE))
+
+    chunks = []
+    for first in range(0, len(blocks), per_chunk):
+        chunk = blocks[first:first + per_chunk]
+        chunks.append(slice(chunk[0].start, chunk[-1].stop))
+
+    stored = store = None
+    if posterior is not None:
+        if _posterior.exists(posterior):
+            stored = posterior
+        else:
+            store = _posterior.create(posterior, mc_samples, n_samples,
+                                      n_features)
+
+    executor = None
+    if n_jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(n_jobs)
+    try:
+        expected = None
+        sketched = None
+        ess = None
+        if sampling == 'antithetic' and mc_samples > 3:
+            ess = [_AntitheticEss() for _ in variants]
+        if mc_batch_size is not None:
+            if effect_sketch is not None and any(two):
+                sketched = [_SketchedEffect(
+                    n_features, effect_sketch,
+                    np.random.default_rng(seeds[-1]), effect_ci)
+                    if two[k // per_grouping] else None
+                    for k in range(len(variants))]
+            convergence = None
+            if auto:
+                convergence = [_Convergence(
+                    mc_min_samples, mc_tolerance,
+                    np.random.default_rng(seeds[-1].spawn(1)[0]))
+                    for _ in variants]
+            expected, mc_samples = _streamed_tests(
+                counts, weights, blocks, seeds[:len(blocks)], mc_samples,
+                mc_batch_size, labels, test, sketched, convergence,
+                sampling, ess, fast_threshold, scale)
+            if not any(two) or sketched is not None:
+                # the effect summaries are either done or not needed
+                chunks = []
+
+        norm = None
+        if per_chunk < len(blocks) and stored is None and chunks:
+            norm = _normalisers(counts, mc_samples, weights, labels, blocks,
+                                seeds, executor, 2 * n_jobs, sampling,
+                                fast_threshold)
+
+        # drawn after streaming, which may settle on fewer instances
+        pairing = []
+        for labels_ in labels:
+            sizes = np.bincount(labels_[labels_ >= 0])
+            pairing.append(_pairing(sizes[0], sizes[-1], mc_samples,
+                                    np.random.default_rng(seeds[-1])))
+        tasks = ((counts[:, cols], weights[..., cols],
+                  seeds[i * per_chunk:(i + 1) * per_chunk], cols)
+                 for i, cols in enumerate(chunks))
+        fn = functools.partial(_chunk, mc_samples=mc_samples, norm=norm,
+                               labels=labels,
+                               test=test if expected is None else None,
+                               pairing=pairing, stored=stored, store=store,
+                               ci=effect_ci, sampling=sampling,
+                               fast_threshold=fast_threshold, scale=scale)
+
+        pvalues = [{} for _ in variants]
+        effect = [{} for _ in variants]
+        results = _ordered_map(executor, fn, tasks, 2 * n_jobs)
+        for cols, chunk_results in zip(chunks, results):
+            for k, (pvalues_, effect_) in enumerate(chunk_results):
+                for key, value in (pvalues_ or {}).items():
+                    pvalues[k].setdefault(
+                        key, np.empty((mc_samples, n_features)))[:, cols] = \
+                        value
+                for key, value in (effect_ or {}).items():
+                    effect[k].setdefault(
+                        key, np.empty(n_features))[cols] = value
+    except BaseException:
+        if store is not None:
+            _posterior.discard(store)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if store is not None:
+        _posterior.commit(store, posterior)
+
+    if expected is None:
+        # BH is applied per instance over all features, after every chunk
+        expected = []
+        for k, pvalues_ in enumerate(pvalues):
+            bh = {key: _bh(value) for key, value in pvalues_.items()}
+            expected.append({key: (value.mean(axis=0), bh[key].mean(axis=0))
+                             for key, value in pvalues_.items()})
+            if ess is not None:
+                ess[k].update(bh)
+
+    if sketched is not None:
+        effect = [{} if sketched_ is None else sketched_.summary()
+                  for sketched_ in sketched]
+
+    summaries = {}
+    for k, variant in enumerate(variants):
+        levels_ = levels[k // per_grouping]
+        summary = {}
+        if effect[k]:
+            summary = {
+                'rab.all': effect[k]['rab.all'],
+                'rab.win.%s' % levels_[0]: effect[k]['rab.x'],
+                'rab.win.%s' % levels_[1]: effect[k]['rab.y'],
+                'diff.btw': effect[k]['diff.btw'],
+                'diff.win': effect[k]['diff.win'],
+                'effect': effect[k]['effect'],
+            }
+            if effect_ci:
+                summary['effect.low'] = effect[k]['effect.low']
+                summary['effect.high'] = effect[k]['effect.high']
+            summary['overlap'] = effect[k]['overlap']
+        for key, (ep, ebh) in expected[k].items():
+            summary['%s.ep' % key] = ep
+            summary['%s.eBH' % key] = ebh
+        if ess is not None:
+            summary['mc.ess'] = ess[k].ess()
+        if auto:
+            summary['mc.samples'] = np.full(n_features, mc_samples)
+        summaries[variant] = pd.DataFrame(
+            summary, index=pd.Index(feature_ids, name='featureid'))
+
+    # drop the parts of the variant keys that do not vary
+    keep = [several, isinstance(denom, dict),
+            gammas is not None and np.ndim(gamma) > 0]
+    names = [name for name, kept in zip(
+        ['condition' if contrasts is None else 'contrast', 'denom', 'gamma'],
+        keep) if kept]
+    if not names:
+        return summaries[variants[0]]
+    summaries = {tuple(part for part, kept in zip(variant, keep) if kept):
+                 summary for variant, summary in summaries.items()}
+    if len(names) == 1:
+        summaries = {key[0]: value for key, value in summaries.items()}
+    return pd.concat(summaries, names=names)
+
+
+def _contrasts(conditions, kind):
+    """ Two-group conditions comparing the groups of `conditions`.
+
+    'pairwise' gives an 'a-vs-b' condition for every pair of groups and
+    'one-vs-rest' an 'a-vs-rest' condition for every group.
+    """
+    values = conditions.astype(str).where(conditions.notna())
+    levels = np.unique(values.dropna())
+    frame = {}
+    if kind == 'pairwise':
+        for a, b in itertools.combinations(levels, 2):
+            frame['%s-vs-%s' % (a, b)] = pd.Categorical(
+                values.where(values.isin([a, b])), categories=[a, b])
+    elif kind == 'one-vs-rest':
+        for a in levels:
+            rest = 'rest' if a != 'rest' else 'others'
+            frame['%s-vs-%s' % (a, rest)] = pd.Categorical(
+                values.where(values.isna() | (values == a), rest),
+                categories=[a, rest])
+    else:
+        raise ValueError('Unknown contrasts %r.' % kind)
+    return pd.DataFrame(frame, index=conditions.index)
+
+
+def _denominator_mask(counts, feature_ids, labels, blocks, spec):
+    """ The `_denominator.select` mask of a denominator name or a sequence
+    of feature IDs.
+    """
+    if not isinstance(spec, str):
+        index = pd.Index(feature_ids)
+        missing = pd.Index(spec).difference(index)
+        if len(missing):
+            raise ValueError('Denominator features not found in the table: '
+                             '%s' % ', '.join(map(str, missing[:10])))
+        spec = index.get_indexer(list(spec))
+
+    def count_blocks():
+        return ((cols, _dense(counts[:, cols])) for cols in blocks)
+    return _denominator.select(count_blocks, counts.shape[0],
+                               counts.shape[1], labels, spec, _PRIOR)
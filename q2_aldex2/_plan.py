@@ -0,0 +1,403 @@
+import os
+import time
+import warnings
+import functools
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+# Memory (in MB) a run may use, instead of what is detected as available
+# (see `available_memory`), e.g. the allowance of a queue slot
+MEMORY_ENV = 'Q2_ALDEX2_MEMORY'
+
+# Share of the available memory a plan may take
+_HEADROOM = 0.8
+
+# Memory of a worker process before it does anything, in bytes
+_WORKER_BYTES = 100 * 2 ** 20
+
+# Starting the worker processes, in seconds
+_WORKER_SECONDS = 0.5
+
+# Runs predicted to take less than this many seconds stay in one process
+_PARALLEL_SECONDS = 10.
+
+# The R engine keeps about this many float64 values per instance, sample
+# and feature: the Dirichlet instances, their log and clr and the per
+# instance test results. It is not calibrated, as R may not be there.
+_R_COPIES = 4
+
+# Upper bounds on the bytes and seconds per instance, sample and feature of
+# the native engine, well above what `calibrate` measures (about 60 bytes
+# and 2e-7 seconds), so that small runs can be planned without calibrating
+_BOUND_BYTES = 256
+_BOUND_SECONDS = 2e-6
+
+# Share of the memory budget below which the bounds need no calibration
+_QUICK_SHARE = 0.25
+
+# Shape of the table of the calibration run
+_PROBE = dict(n_samples=64, n_features=128, mc_samples=16)
+
+# p-value columns per variant kept for every instance ('we' and 'wi', or
+# 'kw' and 'glm')
+_TEST_KEYS = 2
+
+
+def available_memory():
+    """ Bytes this process may still allocate, or None if unknown.
+
+    $Q2_ALDEX2_MEMORY (in MB) takes precedence. Otherwise this is the least
+    of the memory the system reports as available and what is left of the
+    limit of the cgroup the process runs in, as under most job schedulers
+    and containers.
+    """
+    limit = os.environ.get(MEMORY_ENV)
+    if limit:
+        return float(limit) * 2 ** 20
+    available = []
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    for limit_path, usage_path in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_path) as fh:
+                limit = fh.read().strip()
+            with open(usage_path) as fh:
+                usage = int(fh.read().strip())
+        except (OSError, ValueError):
+            continue
+        # cgroup v1 reports no limit as a huge number
+        if limit != 'max' and int(limit) < 2 ** 60:
+            available.append(max(int(limit) - usage, 0))
+    return min(available) if available else None
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=None)
+def calibrate(test='t', sampling='mc'):
+    """ Cost of the native engine on this machine, from a small run.
+
+    Returns the seconds per instance, sample and feature of the whole run
+    and of the Dirichlet draws alone, and the peak bytes the run allocates
+    per instance, sample and feature beyond the p-values it keeps.
+    """
+    from q2_aldex2._native import (aldex2_native, _feature_blocks,
+                                   _log_gamma)
+
+    n_samples, n_features, mc_samples = (
+        _PROBE['n_samples'], _PROBE['n_features'], _PROBE['mc_samples'])
+    rng = np.random.default_rng(0)
+    means = rng.lognormal(2, 2, size=n_features)
+    counts = rng.poisson(means, size=(n_samples, n_features)).astype(float)
+    counts[:, counts.sum(axis=0) == 0] = 1
+    ids = ['F%d' % i for i in range(n_features)]
+    conditions = pd.Series(np.arange(n_samples) % 2).astype(str)
+
+    def run():
+        return aldex2_native(counts, ids, conditions, mc_samples, test,
+                             seed=0, sampling=sampling)
+
+    def draw():
+        seeds = np.random.SeedSequence(0).spawn(n_features)
+        for cols, seed in zip(_feature_blocks(n_features), seeds):
+            _log_gamma(counts[:, cols], mc_samples, seed, sampling)
+
+    elements = n_samples * n_features * mc_samples
+    run()
+    seconds = []
+    for fn in (run, draw):
+        start = time.perf_counter()
+        fn()
+        seconds.append((time.perf_counter() - start) / elements)
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    run()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    if started:
+        tracemalloc.stop()
+    pvalues = _TEST_KEYS * mc_samples * n_features * 8
+    # at least the clr instances themselves
+    per_element = max((peak - pvalues) / elements, 8.)
+    return seconds[0], seconds[1], per_element
+
+
+class Plan:
+    """ Predicted peak memory and runtime of one run, and the chunk size
+    and worker count it is to use.
+
+    `problem` explains why the run would not fit in the available memory,
+    and is None if it does.
+    """
+
+    def __init__(self, engine, n_samples, n_features, density, mc_samples,
+                 test, chunk_size, n_jobs, mc_batch_size, peak, seconds,
+                 memory, cpus, problem=None):
+        self.engine = engine
+        self.n_samples = n_samples
+        self.n_features = n_features
+        self.density = density
+        self.mc_samples = mc_samples
+        self.test = test
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.mc_batch_size = mc_batch_size
+        self.peak = peak
+        self.seconds = seconds
+        self.memory = memory
+        self.cpus = cpus
+        self.problem = problem
+
+    @property
+    def feasible(self):
+        return self.problem is None
+
+    def check(self):
+        """ Raise a MemoryError explaining the problem, if there is one.
+
+        The R engine is not calibrated, so its problem is only a warning.
+        """
+        if self.problem is not None:
+            if self.engine != 'native':
+                warnings.warn(self.problem)
+            else:
+                raise MemoryError(self.problem)
+        return self
+
+    def __str__(self):
+        lines = [
+            'engine:          %s' % self.engine,
+            'table:           %d samples x %d features, %.1f%% non-zero'
+            % (self.n_samples, self.n_features, 100 * self.density),
+            'mc_samples:      %s' % self.mc_samples,
+            'test:            %s' % self.test,
+        ]
+        if self.engine == 'native':
+            lines += [
+                'chunk_size:      %s' % (self.chunk_size or 'all features'),
+                'n_jobs:          %d of %d CPUs' % (self.n_jobs, self.cpus),
+            ]
+            if self.mc_batch_size is not None:
+                lines.append('mc_batch_size:   %d' % self.mc_batch_size)
+        lines.append('peak memory:     %s of %s available'
+                     % (_mb(self.peak), _mb(self.memory)))
+        if self.seconds is not None:
+            lines.append('runtime:         %.1fs' % self.seconds)
+        if self.problem is not None:
+            lines.append(self.problem)
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<Plan chunk_size=%r n_jobs=%r peak=%s>' % (
+            self.chunk_size, self.n_jobs, _mb(self.peak))
+
+
+def _mb(value):
+    if value is None:
+        return 'unknown'
+    if value >= 2 ** 30:
+        return '%.1f GB' % (value / 2 ** 30)
+    return '%.0f MB' % (value / 2 ** 20)
+
+
+def estimate(n_samples, n_features, nnz, mc_samples, test='t',
+             chunk_size=None, n_jobs=1, mc_batch_size=None, sampling='mc',
+             n_variants=1, cpus=None):
+    """ Predicted peak memory (bytes) and runtime (seconds) of the native
+    engine.
+
+    The peak is that of the most demanding phase: drawing and testing the
+    chunks, of which `n_jobs` are held at once and which keep the
+    instances of every feature of the chunk; with `mc_batch_size`, the
+    streamed tests, which hold a batch of instances of every feature; and
+    the BH adjustment of the p-values of every instance and feature that
+    runs without `mc_batch_size`. Every phase also holds the counts.
+    """
+    from q2_aldex2._native import _BLOCK_SIZE
+
+    seconds, draw_seconds, per_element = calibrate(test, sampling)
+    if n_jobs > 1 and chunk_size is None:
+        chunk_size = -(-n_features // n_jobs)
+    if chunk_size is None or chunk_size >= n_features:
+        chunk_features = n_features
+    else:
+        chunk_features = min(-(-chunk_size // _BLOCK_SIZE) * _BLOCK_SIZE,
+                             n_features)
+    chunks = -(-n_features // chunk_features)
+    workers = min(n_jobs, chunks)
+    chunked = chunks > 1
+
+    # the biom table and its column-major copy
+    counts = 2 * (12 * nnz + 4 * n_features)
+    pvalues = 0
+    if mc_batch_size is None:
+        pvalues = n_variants * _TEST_KEYS * mc_samples * n_features * 8
+    chunk = per_element * mc_samples * n_samples * chunk_features
+    normalisers = mc_samples * n_samples * 8 if chunked else 0
+    phases = [pvalues + normalisers + workers * (chunk + normalisers)]
+    if workers > 1:
+        # the results in flight and the workers themselves
+        phases[0] += 2 * workers * (
+            n_variants * _TEST_KEYS * mc_samples * chunk_features * 8)
+        phases[0] += workers * _WORKER_BYTES
+    if mc_batch_size is None:
+        # sorting for BH takes about three more (instances, features)
+        # arrays
+        phases.append(pvalues + 3 * mc_samples * n_features * 8)
+    else:
+        batch = min(mc_batch_size, mc_samples)
+        phases.append(per_element * batch * n_samples * n_features +
+                      n_variants * 4 * n_features * 8)
+    peak = counts + max(phases)
+
+    elements = mc_samples * n_samples * n_features
+    runtime = seconds * elements * n_variants
+    if chunked:
+        # the normalisers are drawn in a pass of their own
+        runtime += draw_seconds * elements
+    if mc_batch_size is not None:
+        # the effect summaries draw every instance again
+        runtime += draw_seconds * elements
+    if workers > 1:
+        # workers beyond the CPUs only take turns
+        cpus = available_cpus() if cpus is None else cpus
+        runtime = runtime / max(min(workers, cpus), 1) + _WORKER_SECONDS
+    return peak, runtime
+
+
+def plan(n_samples, n_features, nnz, mc_samples, test='t', engine='native',
+         chunk_size=None, n_jobs=None, mc_batch_size=None, sampling='mc',
+         mc_max_samples=1024, n_variants=1, memory=None, cpus=None,
+         quick=False):
+    """ Plan a run: predict its peak memory and runtime and, for the native
+    engine, choose the chunk size and worker count it needs.
+
+    A `chunk_size` or `n_jobs` that is given is kept; with None the
+    planner picks the largest chunks that fit `memory` (the available
+    memory by default) with as many workers as help, up to `cpus`. Runs
+    predicted to be short stay in one process. If nothing fits, the plan's
+    `problem` says why and what to change. With `quick`, runs well within
+    the budget by the uncalibrated bounds are planned from those, with no
+    runtime.
+    """
+    if memory is None:
+        memory = available_memory()
+    if cpus is None:
+        cpus = available_cpus()
+    density = nnz / (n_samples * n_features) if n_samples * n_features \
+        else 0.
+    budget = None if memory is None else memory * _HEADROOM
+    mc = mc_max_samples if mc_samples == 'auto' else mc_samples
+    if mc_samples == 'auto' and mc_batch_size is None and engine == 'native':
+        from q2_aldex2._native import _AUTO_BATCH
+        mc_batch_size = _AUTO_BATCH
+
+    def fits(peak):
+        return budget is None or peak <= budget
+
+    if engine != 'native':
+        peak = 2 * 12 * nnz + _R_COPIES * mc * n_samples * n_features * 8
+        problem = None
+        if not fits(peak):
+            problem = (
+                'ALDEx2 in R may need about %s for %d samples x %d '
+                'features x %d Monte Carlo instances, but only %s is '
+                'available. The native engine can process the features in '
+                'chunks (engine=\'native\'); otherwise lower mc_samples or '
+                'set %s (in MB) if more memory is available than detected.'
+                % (_mb(peak), n_samples, n_features, mc, _mb(memory),
+                   MEMORY_ENV))
+        return Plan(engine, n_samples, n_features, density, mc_samples, test,
+                    chunk_size, n_jobs or 1, mc_batch_size, peak, None,
+                    memory, cpus, problem)
+
+    if quick and chunk_size is None and n_jobs in (None, 1):
+        elements = mc * n_samples * n_features
+        peak = 2 * 12 * nnz + _BOUND_BYTES * elements + \
+            (n_variants * _TEST_KEYS + 3) * mc * n_features * 8
+        # the extra passes of chunked and streamed runs
+        seconds = _BOUND_SECONDS * elements * (n_variants + 2)
+        if (budget is None or peak <= budget * _QUICK_SHARE) and \
+                seconds <= _PARALLEL_SECONDS:
+            return Plan(engine, n_samples, n_features, density, mc_samples,
+                        test, None, 1, mc_batch_size, peak, None, memory,
+                        cpus)
+
+    from q2_aldex2._native import _BLOCK_SIZE
+
+    def estimate_(chunk_size_, n_jobs_):
+        return estimate(n_samples, n_features, nnz, mc, test, chunk_size_,
+                        n_jobs_, mc_batch_size, sampling, n_variants, cpus)
+
+    def make(chunk_size_, n_jobs_, problem=None):
+        peak, seconds = estimate_(chunk_size_, n_jobs_)
+        return Plan(engine, n_samples, n_features, density, mc_samples,
+                    test, chunk_size_, n_jobs_, mc_batch_size, peak, seconds,
+                    memory, cpus, problem)
+
+    blocks = max(-(-n_features // _BLOCK_SIZE), 1)
+    if n_jobs is None:
+        _, serial = estimate_(None, 1)
+        n_jobs = 1
+        if serial > _PARALLEL_SECONDS:
+            n_jobs = max(min(cpus, blocks), 1)
+        candidates = list(range(n_jobs, 0, -1))
+    else:
+        candidates = [n_jobs]
+
+    if chunk_size is not None:
+        sizes = [chunk_size]
+    else:
+        # whole chunks of the largest size each worker count allows, then
+        # ever smaller ones down to a single block
+        sizes = [None]
+        per_chunk = blocks
+        while per_chunk > 1:
+            per_chunk = -(-per_chunk // 2)
+            sizes.append(per_chunk * _BLOCK_SIZE)
+    for n_jobs_ in candidates:
+        for size in sizes:
+            if size is None and n_jobs_ > 1:
+                continue
+            if chunk_size is None and size is not None and n_jobs_ > 1 \
+                    and -(-n_features // size) < n_jobs_:
+                # fewer chunks than workers leaves some idle
+                continue
+            if fits(estimate_(size, n_jobs_)[0]):
+                return make(size, n_jobs_)
+
+    # nothing fits: report the smallest configuration tried
+    smallest = make(sizes[-1], candidates[-1])
+    if mc_batch_size is None:
+        hint = ('set mc_batch_size to test the instances a batch at a '
+                'time, lower mc_samples')
+    else:
+        hint = 'lower mc_batch_size or mc_samples'
+    smallest.problem = (
+        'aldex2 would need about %s (%d samples x %d features x %d Monte '
+        'Carlo instances, chunk_size %s, n_jobs %d), but only %s is '
+        'available. To fit, %s, or set %s (in MB) if more memory is '
+        'available than detected.'
+        % (_mb(smallest.peak), n_samples, n_features, mc,
+           smallest.chunk_size or 'all features', smallest.n_jobs,
+           _mb(memory), hint, MEMORY_ENV))
+    return smallest
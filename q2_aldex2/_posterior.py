@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from q2_aldex2 import _cache
+
+
+# Where stored Monte Carlo clr instances live; defaults to a `posterior`
+# directory inside the result cache. Stores are large and are not evicted
+# automatically.
+POSTERIOR_DIR_ENV = 'Q2_ALDEX2_POSTERIOR_DIR'
+
+_FILE = 'clr.npy'
+
+
+def posterior_dir():
+    return os.environ.get(POSTERIOR_DIR_ENV) or \
+        os.path.join(_cache.cache_dir(), 'posterior')
+
+
+def path_for(key):
+    """ The clr array of the store for `key` (which may not exist yet). """
+    return os.path.join(posterior_dir(), key, _FILE)
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def create(path, mc_samples, n_samples, n_features):
+    """ Allocate a store for `path` in a scratch directory next to it.
+
+    The array is laid out as (features, instances, samples) so that a chunk
+    of features is a contiguous read. Returns the scratch file, which is
+    filled with `write` and published with `commit`.
+    """
+    parent = os.path.dirname(os.path.dirname(path))
+    os.makedirs(parent, exist_ok=True)
+    scratch = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    scratch_path = os.path.join(scratch, _FILE)
+    array = np.lib.format.open_memmap(scratch_path, mode='w+',
+                                      dtype=np.float32,
+                                      shape=(n_features, mc_samples,
+                                             n_samples))
+    del array
+    return scratch_path
+
+
+def write(path, cols, clr):
+    """ Store an (instances, samples, features) clr chunk at `cols`. """
+    array = np.load(path, mmap_mode='r+')
+    array[cols] = np.moveaxis(clr, -1, 0)
+    array.flush()
+
+
+def read(path, cols):
+    """ The (instances, samples, features) clr chunk at `cols`, as float64. """
+    array = np.load(path, mmap_mode='r')
+    return np.moveaxis(array[cols], 0, -1).astype(np.float64)
+
+
+def commit(scratch_path, path):
+    """ Publish a filled scratch store under its final name. """
+    scratch = os.path.dirname(scratch_path)
+    try:
+        os.rename(scratch, os.path.dirname(path))
+    except OSError:
+        # another run stored the same instances first
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def discard(scratch_path):
+    shutil.rmtree(os.path.dirname(scratch_path), ignore_errors=True)
@@ -0,0 +1,146 @@
+import os
+import re
+import time
+import pstats
+import cProfile
+import functools
+import itertools
+import threading
+
+
+# Directory for the profiles of every aldex2 call; unset disables profiling.
+# Each call writes <action>-<time>-<pid>-<n>.prof (cProfile), .Rprof (Rprof of
+# run_aldex2.R, with the R engine) and .collapsed (both as collapsed stacks,
+# in microseconds, for flamegraph.pl, speedscope and the like).
+PROFILE_ENV = 'Q2_ALDEX2_PROFILE'
+
+# Python calls under this share of a microsecond are left out of the stacks
+_MIN_MICROSECONDS = 1
+
+_current = threading.local()
+
+# Numbers the profiled calls of this process, so that calls within the same
+# second do not overwrite each other's files
+_calls = itertools.count()
+
+
+def profile_dir():
+    return os.environ.get(PROFILE_ENV) or None
+
+
+def r_profile_path():
+    """ Where run_aldex2.R should write its Rprof output during the current
+    profiled call, or None.
+    """
+    prefix = getattr(_current, 'prefix', None)
+    return None if prefix is None else prefix + '.Rprof'
+
+
+def profiled(action):
+    """ Decorator profiling every call of the function when
+    $Q2_ALDEX2_PROFILE is set.
+
+    Only the calling process is profiled with cProfile; worker processes of
+    the native engine are not.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            directory = profile_dir()
+            if directory is None or getattr(_current, 'prefix', None):
+                return fn(*args, **kwargs)
+            os.makedirs(directory, exist_ok=True)
+            prefix = os.path.join(directory, '%s-%s-%d-%d' % (
+                action, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                next(_calls)))
+            profiler = cProfile.Profile()
+            _current.prefix = prefix
+            profiler.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                _current.prefix = None
+                profiler.dump_stats(prefix + '.prof')
+                write_collapsed(prefix)
+        return wrapper
+    return decorator
+
+
+def _frame(func):
+    filename, line, name = func
+    if filename == '~':
+        # built-ins
+        label = name
+    else:
+        label = '%s:%d(%s)' % (os.path.basename(filename), line, name)
+    return label.replace(';', ':').replace(' ', '_')
+
+
+def python_stacks(stats):
+    """ Collapsed stacks of a cProfile run, as {stack: microseconds}.
+
+    cProfile only keeps caller/callee pairs, so the time of a function is
+    split over the paths leading to it in proportion to the time spent in
+    every call edge, as other call graph flame graph tools do.
+    """
+    stats = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3]
+
+    stacks = {}
+
+    def walk(func, path, cumulative):
+        _, _, own, total, _ = stats[func]
+        scale = cumulative / total if total else 0.
+        micro = int(round(own * scale * 1e6))
+        if micro >= _MIN_MICROSECONDS:
+            key = ';'.join(path)
+            stacks[key] = stacks.get(key, 0) + micro
+        for callee, edge in callees.get(func, {}).items():
+            if callee not in stats or _frame(callee) in path:
+                # recursion is folded into its first frame
+                continue
+            if edge * scale * 1e6 >= _MIN_MICROSECONDS:
+                walk(callee, path + [_frame(callee)], edge * scale)
+
+    for func, (_, _, _, total, callers) in stats.items():
+        if not callers:
+            walk(func, [_frame(func)], total)
+    return stacks
+
+
+def r_stacks(path):
+    """ Collapsed stacks of an Rprof file, as {stack: microseconds}. """
+    stacks = {}
+    with open(path) as fh:
+        header = fh.readline()
+        match = re.search(r'sample\.interval=(\d+)', header)
+        interval = int(match.group(1)) if match else 20000
+        for line in fh:
+            # innermost call first
+            frames = re.findall(r'"([^"]*)"', line)
+            if not frames:
+                continue
+            key = ';'.join(frame.replace(';', ':').replace(' ', '_')
+                           for frame in reversed(frames))
+            stacks[key] = stacks.get(key, 0) + interval
+    return stacks
+
+
+def write_collapsed(prefix):
+    """ Merge `<prefix>.prof` and, if there is one, `<prefix>.Rprof` into
+    `<prefix>.collapsed`, under 'python' and 'R' root frames.
+    """
+    merged = {}
+    for key, value in python_stacks(pstats.Stats(prefix + '.prof')).items():
+        merged['python;' + key] = value
+    if os.path.exists(prefix + '.Rprof'):
+        for key, value in r_stacks(prefix + '.Rprof').items():
+            merged['R;' + key] = value
+    with open(prefix + '.collapsed', 'w') as fh:
+        for key, value in sorted(merged.items()):
+            fh.write('%s %d\n' % (key, value))
+    return prefix + '.collapsed'
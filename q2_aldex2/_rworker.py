@@ -0,0 +1,170 @@
+import os
+import sys
+import queue
+import atexit
+import select
+import threading
+import subprocess
+
+
+# Number of warm R processes to keep around. Unset or 0 disables the pool and
+# every aldex2 call starts its own Rscript.
+WORKERS_ENV = 'Q2_ALDEX2_R_WORKERS'
+
+# Prefix of the acknowledgement lines `run_aldex2.R --worker` writes to stderr
+_SENTINEL = '__q2_aldex2__ '
+
+_PING_TIMEOUT = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class RWorker:
+    """ A long-lived `run_aldex2.R --worker` process with ALDEx2 loaded. """
+
+    def __init__(self, script='run_aldex2.R'):
+        self.script = script
+        self.process = None
+        self.start()
+
+    def start(self):
+        # stdout is inherited so ALDEx2's progress messages reach the user as
+        # they would for a regular Rscript call; stderr carries the protocol
+        self.process = subprocess.Popen([self.script, '--worker'],
+                                        stdin=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        universal_newlines=True,
+                                        bufsize=1)
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def _send(self, line):
+        try:
+            self.process.stdin.write(line + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            raise WorkerDied()
+
+    def _receive(self):
+        for line in self.process.stderr:
+            if line.startswith(_SENTINEL):
+                return line[len(_SENTINEL):].rstrip('\n')
+            sys.stderr.write(line)
+        raise WorkerDied()
+
+    def healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self._send('ping')
+        except WorkerDied:
+            return False
+        ready, _, _ = select.select([self.process.stderr], [], [],
+                                    _PING_TIMEOUT)
+        if not ready:
+            return False
+        try:
+            return self._receive() == 'pong'
+        except WorkerDied:
+            return False
+
+    def run(self, args):
+        """ Run one job; `args` are the `run_aldex2.R` positional arguments.
+
+        Raises `subprocess.CalledProcessError` if R reported an error and
+        `WorkerDied` if the process went away while running the job.
+        """
+        self._send('\t'.join(args))
+        status = self._receive()
+        if status != 'ok':
+            sys.stderr.write(status + '\n')
+            raise subprocess.CalledProcessError(1, [self.script] + args)
+
+
+class RWorkerPool:
+    """ A fixed number of warm R workers shared between threads. """
+
+    def __init__(self, size, script='run_aldex2.R'):
+        self._idle = queue.Queue()
+        self._workers = [RWorker(script) for _ in range(size)]
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def run(self, args):
+        worker = self._idle.get()
+        try:
+            if not worker.healthy():
+                worker.restart()
+            try:
+                worker.run(args)
+            except WorkerDied:
+                # R crashed in the middle of the job: bring up a fresh
+                # process and give the job one more chance
+                worker.restart()
+                try:
+                    worker.run(args)
+                except WorkerDied:
+                    worker.restart()
+                    raise subprocess.CalledProcessError(
+                        -1, [worker.script] + args)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+def get_pool():
+    """ The process-wide worker pool, or None when it is not enabled. """
+    global _pool
+    size = int(os.environ.get(WORKERS_ENV) or 0)
+    if size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = RWorkerPool(size)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def run_commands(pool, cmds, verbose=True, recorder=None):
+    """ Drop-in for `_method.run_commands` that dispatches to `pool`.
+
+    The workers are not child processes that have been waited for, so a
+    `recorder` only gets the wall time of every job here; R reports its
+    own usage.
+    """
+    if verbose:
+        print("Running ALDEx2 in a warm R worker. R may print messages to "
+              "stdout and/or stderr.")
+    for cmd in cmds:
+        if verbose:
+            print("\nJob:", end=' ')
+            print(" ".join(cmd), end='\n\n')
+        # the first element is the script name, which the worker already is
+        if recorder is None:
+            pool.run(cmd[1:])
+        else:
+            with recorder.stage('R'):
+                pool.run(cmd[1:])
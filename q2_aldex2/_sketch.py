@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class QuantileSketch:
+    """ Bounded-memory quantile sketch for many features at once.
+
+    Every feature keeps at most `3 * size` weighted points, and each
+    compression moves a quantile by at most about `1 / size` in rank.
+    """
+
+    def __init__(self, n_features, size=256):
+        self.size = size
+        self._values = np.empty((n_features, 0))
+        self._weights = np.empty((n_features, 0))
+
+    def update(self, values):
+        """ Add an (observations, features) block of values. """
+        values = np.asarray(values, dtype=np.float64).T
+        # merging in slices keeps a large block within the bound
+        for start in range(0, values.shape[1], self.size):
+            block = values[:, start:start + self.size]
+            self._values = np.concatenate([self._values, block], axis=1)
+            self._weights = np.concatenate([self._weights,
+                                            np.ones(block.shape)], axis=1)
+            if self._values.shape[1] > 2 * self.size:
+                self._compress()
+
+    def _total(self):
+        # every feature sees the same number of observations
+        return self._weights[0].sum()
+
+    def _at(self, ranks):
+        """ (features, len(ranks)) values at the given weighted ranks. """
+        order = np.argsort(self._values, axis=1)
+        values = np.take_along_axis(self._values, order, axis=1)
+        weights = np.take_along_axis(self._weights, order, axis=1)
+        # rank of the centre of every point
+        centres = np.cumsum(weights, axis=1) - weights / 2
+
+        n_features, n_points = values.shape
+        if n_points == 1:
+            return np.repeat(values, len(ranks), axis=1)
+        # one searchsorted for all features: shift every feature's ranks
+        # into its own disjoint interval
+        shift = (2 * self._total() + 1) * np.arange(n_features)[:, None]
+        hi = np.searchsorted((centres + shift).ravel(),
+                             (ranks[None, :] + shift).ravel())
+        hi = hi.reshape(n_features, len(ranks)) \
+            - n_points * np.arange(n_features)[:, None]
+        hi = np.clip(hi, 1, n_points - 1)
+        lo = hi - 1
+
+        c_lo = np.take_along_axis(centres, lo, axis=1)
+        c_hi = np.take_along_axis(centres, hi, axis=1)
+        v_lo = np.take_along_axis(values, lo, axis=1)
+        v_hi = np.take_along_axis(values, hi, axis=1)
+        frac = np.clip((ranks[None, :] - c_lo) / (c_hi - c_lo), 0, 1)
+        return v_lo + frac * (v_hi - v_lo)
+
+    def _compress(self):
+        total = self._total()
+        ranks = (np.arange(self.size) + 0.5) / self.size * total
+        self._values = self._at(ranks)
+        self._weights = np.full(self._values.shape, total / self.size)
+
+    def quantile(self, q):
+        """ Estimated quantile(s) `q` of every feature.
+
+        Returns a (features,) array for a scalar `q`, otherwise
+        (len(q), features).
+        """
+        ranks = np.atleast_1d(np.asarray(q, dtype=np.float64)) * \
+            self._total()
+        result = self._at(ranks).T
+        return result[0] if np.ndim(q) == 0 else result
@@ -0,0 +1,185 @@
+import functools
+
+import numpy as np
+from scipy import special
+
+
+# R's wilcox.test uses exact p-values below this group size when there are
+# no ties
+_EXACT_WILCOX = 50
+
+
+def _bh(pvalues, axis=-1):
+    """ Benjamini-Hochberg adjustment along `axis`.
+
+    Equivalent to R's `p.adjust(p, method='BH')` applied independently to
+    every 1-D slice of `pvalues` along `axis`.
+    """
+    p = np.moveaxis(np.asarray(pvalues, dtype=np.float64), axis, -1)
+    n = p.shape[-1]
+    order = np.argsort(p, axis=-1)
+    ranked = np.take_along_axis(p, order, axis=-1)
+    ranked = ranked * n / np.arange(1, n + 1)
+    # enforce monotonicity from the largest p-value downwards
+    ranked = np.minimum.accumulate(ranked[..., ::-1], axis=-1)[..., ::-1]
+    np.minimum(ranked, 1, out=ranked)
+    adjusted = np.empty_like(ranked)
+    np.put_along_axis(adjusted, order, ranked, axis=-1)
+    return np.moveaxis(adjusted, -1, axis)
+
+
+def _welch(x, y):
+    """ Two-sided Welch t-test p-values along the sample axis.
+
+    `x` and `y` are (instances, samples, features) blocks of clr values for
+    the two groups; the result is an (instances, features) array. All
+    instances and features are tested at once with broadcasting, using the
+    Welch-Satterthwaite degrees of freedom and Student's t CDF, as R's
+    `t.test(x, y)` does.
+    """
+    n_x, n_y = x.shape[1], y.shape[1]
+    se_x = x.var(axis=1, ddof=1) / n_x
+    se_y = y.var(axis=1, ddof=1) / n_y
+    se = se_x + se_y
+    t = (x.mean(axis=1) - y.mean(axis=1)) / np.sqrt(se)
+    df = se ** 2 / (se_x ** 2 / (n_x - 1) + se_y ** 2 / (n_y - 1))
+    return 2 * special.stdtr(df, -np.abs(t))
+
+
+def _rank_sums(z, labels, n_groups):
+    """ Per-group sums of average ranks along the last axis, and the tie
+    term sum(t^3 - t).
+
+    `labels` gives the group (0 to n_groups - 1) of every position along the
+    last axis; the sums are returned for the first `n_groups` groups only,
+    stacked on a new last axis. Ties are found on the sorted values in one
+    batched pass: every position learns the start and end of its run of
+    equal values from running maxima/minima, which gives both the average
+    rank and the run length. clr values are continuous, so the common
+    tie-free case skips that.
+    """
+    n = z.shape[-1]
+    order = np.argsort(z, axis=-1)
+    ordered = np.take_along_axis(z, order, axis=-1)
+    group = np.asarray(labels)[order]
+    position = np.arange(n)
+
+    starts = np.ones(z.shape, dtype=bool)
+    np.not_equal(ordered[..., 1:], ordered[..., :-1], out=starts[..., 1:])
+    if starts.all():
+        ranks = position + 1.
+        ties = np.zeros(z.shape[:-1])
+    else:
+        ends = np.ones(z.shape, dtype=bool)
+        ends[..., :-1] = starts[..., 1:]
+        start = np.maximum.accumulate(np.where(starts, position, 0),
+                                      axis=-1)
+        end = np.flip(np.minimum.accumulate(
+            np.flip(np.where(ends, position, n - 1), axis=-1), axis=-1),
+            axis=-1)
+        ranks = (start + end) / 2 + 1
+        # each member of a run of length t contributes t^2 - 1
+        ties = ((end - start + 1) ** 2 - 1).sum(axis=-1)
+
+    sums = np.stack([np.where(group == g, ranks, 0).sum(axis=-1)
+                     for g in range(n_groups)], axis=-1)
+    return sums, ties
+
+
+@functools.lru_cache(maxsize=None)
+def _wilcox_cdf(n_x, n_y):
+    """ Null CDF of the rank-sum statistic W for groups of n_x and n_y.
+
+    The counts of W are the coefficients of the Gaussian binomial
+    [n_x + n_y choose n_x]_q, built up one factor (1 - q^(n_y + i)) /
+    (1 - q^i) at a time.
+    """
+    size = n_x * n_y + 1
+    f = np.zeros(size)
+    f[0] = 1
+    for i in range(1, n_x + 1):
+        f[n_y + i:] -= f[:size - n_y - i].copy()
+        for r in range(i):
+            f[r::i] = np.cumsum(f[r::i])
+    return np.cumsum(f / f.sum())
+
+
+def _wilcox(x, y):
+    """ Two-sided Wilcoxon rank-sum p-values along the sample axis.
+
+    Matches R's `wilcox.test(x, y)`: exact p-values when both groups have
+    fewer than 50 samples and there are no ties, otherwise the normal
+    approximation with tie and continuity corrections. All instances and
+    features are ranked at once.
+    """
+    n_x, n_y = x.shape[1], y.shape[1]
+    n = n_x + n_y
+    # rank along a contiguous last axis: (instances, features, samples)
+    z = np.concatenate([np.moveaxis(x, 1, -1), np.moveaxis(y, 1, -1)],
+                       axis=-1)
+    labels = np.repeat([0, 1], [n_x, n_y])
+    rank_sums, ties = _rank_sums(z, labels, 1)
+    w = rank_sums[..., 0] - n_x * (n_x + 1) / 2
+
+    z = w - n_x * n_y / 2
+    sigma = np.sqrt(n_x * n_y / 12 * ((n + 1) - ties / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (z - 0.5 * np.sign(z)) / sigma
+    p = np.minimum(2 * special.ndtr(-np.abs(z)), 1)
+
+    if n_x < _EXACT_WILCOX and n_y < _EXACT_WILCOX:
+        exact = ties == 0
+        if exact.any():
+            cdf = _wilcox_cdf(n_x, n_y)
+            w_exact = np.rint(w[exact]).astype(int)
+            upper = w_exact > n_x * n_y / 2
+            tail = np.where(upper,
+                            1 - cdf[np.maximum(w_exact - 1, 0)],
+                            cdf[w_exact])
+            p[exact] = np.minimum(2 * tail, 1)
+    return p
+
+
+def _design(labels, n_groups):
+    """ Orthonormal basis of the one-way design matrix.
+
+    The intercept plus one indicator per non-reference group, QR-factored
+    once so that every feature and instance can be fitted by projection.
+    """
+    labels = np.asarray(labels)
+    design = np.column_stack([np.ones(len(labels))] +
+                             [labels == g for g in range(1, n_groups)])
+    q, _ = np.linalg.qr(design.astype(np.float64))
+    return q
+
+
+def _glm(z, q):
+    """ p-values of the condition term of a Gaussian glm along axis 1.
+
+    `z` is an (instances, samples, features) block and `q` the output of
+    `_design`. As `drop1(glm(x ~ conditions), test='Chisq')` in
+    `aldex.glm`, the likelihood ratio of the full and intercept-only fits,
+    `n * log(rss0 / rss1)`, is compared to a chi-squared distribution with
+    one degree of freedom per non-reference group. All fits are a single
+    pair of matrix products against `q`.
+    """
+    n, k = q.shape
+    fitted = q @ (q.T @ z)
+    rss = ((z - fitted) ** 2).sum(axis=1)
+    tss = ((z - z.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return special.chdtrc(k - 1, n * np.log(tss / rss))
+
+
+def _kruskal(z, labels, n_groups):
+    """ Kruskal-Wallis p-values along axis 1 of an (instances, samples,
+    features) block, with the tie correction of R's `kruskal.test`.
+    """
+    n = z.shape[1]
+    sizes = np.bincount(labels, minlength=n_groups)
+    rank_sums, ties = _rank_sums(np.moveaxis(z, 1, -1), labels, n_groups)
+    h = 12 / (n * (n + 1)) * (rank_sums ** 2 / sizes).sum(axis=-1) \
+        - 3 * (n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h /= 1 - ties / (n ** 3 - n)
+        return special.chdtrc(n_groups - 1, h)
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+# How the table and the ALDEx2 summary are handed between Python and R:
+# 'text' (tab/comma separated files, the default) or 'binary' (raw
+# little-endian matrices with separate ID lists).
+TRANSPORT_ENV = 'Q2_ALDEX2_TRANSPORT'
+
+# run_aldex2.R picks the format from these file extensions
+_TABLE_NAMES = {'text': 'input.tsv.biom', 'binary': 'input.counts'}
+_SUMMARY_NAMES = {'text': 'output.summary.txt', 'binary': 'output.summary.bin'}
+
+# Number of samples densified at a time while writing the table
+_CHUNK_SIZE = 256
+
+
+def get_transport():
+    transport = os.environ.get(TRANSPORT_ENV) or 'text'
+    if transport not in _TABLE_NAMES:
+        raise ValueError('Unknown transport %r in $%s. The available options '
+                         'are %s.' % (transport, TRANSPORT_ENV,
+                                      ', '.join(_TABLE_NAMES)))
+    return transport
+
+
+def summary_path(dir_name, transport):
+    return os.path.join(dir_name, _SUMMARY_NAMES[transport])
+
+
+def _write_ids(ids, path):
+    with open(path, 'w', encoding='utf-8') as fh:
+        for id_ in ids:
+            fh.write('%s\n' % id_)
+
+
+def _read_ids(path):
+    with open(path, encoding='utf-8') as fh:
+        return [line.rstrip('\n') for line in fh]
+
+
+def write_table(table, dir_name, transport, chunk_size=_CHUNK_SIZE):
+    """ Write the biom `table` for run_aldex2.R.
+
+    The table stays sparse; only `chunk_size` samples at a time are
+    densified on their way to disk. The text layout is a samples x features
+    TSV. The binary layout is the count matrix as features x samples in R's
+    column-major order, i.e. the C-order samples x features buffer, stored as
+    int32 when the counts allow it and as float64 otherwise. Feature and
+    sample IDs go to `<path>.features` and `<path>.samples`.
+    """
+    path = os.path.join(dir_name, _TABLE_NAMES[transport])
+    sample_ids = table.ids(axis='sample')
+    feature_ids = table.ids(axis='observation')
+    # features x samples, sliced by sample below
+    matrix = sparse.csc_matrix(table.matrix_data)
+
+    if transport == 'text':
+        dtype = None
+    else:
+        values = matrix.data
+        if np.array_equal(values, np.round(values)) \
+                and (not values.size or values.max() < 2 ** 31):
+            dtype = '<i4'
+        else:
+            dtype = '<f8'
+
+    with open(path, 'w' if transport == 'text' else 'wb') as fh:
+        for start in range(0, len(sample_ids), chunk_size):
+            stop = start + chunk_size
+            block = matrix[:, start:stop].T.toarray()
+            if transport == 'text':
+                pd.DataFrame(block, index=sample_ids[start:stop],
+                             columns=feature_ids).to_csv(
+                    fh, sep='\t', header=start == 0,
+                    index_label='sampleid')
+            else:
+                np.ascontiguousarray(block, dtype=dtype).tofile(fh)
+
+    if transport == 'binary':
+        _write_ids(feature_ids, path + '.features')
+        _write_ids(sample_ids, path + '.samples')
+    return path
+
+
+def read_summary(path, transport):
+    if transport == 'text':
+        return pd.read_csv(path, index_col=0)
+
+    rows = _read_ids(path + '.rows')
+    columns = _read_ids(path + '.columns')
+    # R wrote the summary column by column
+    values = np.fromfile(path, dtype='<f8').reshape(len(columns), len(rows))
+    return pd.DataFrame(values.T, index=rows, columns=columns)
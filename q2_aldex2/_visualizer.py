@@ -4,12 +4,29 @@ import q2templates
 import pkg_resources
 import matplotlib.pyplot as plt
 
+from q2_aldex2 import _instrument
+
 
 TEMPLATES = pkg_resources.resource_filename('q2_aldex2', 'assets')
 
-# TODO add glm and kw to this list when added
 # this is used for 'test' parameters
-_effect_statistic_functions = {'welch': 'we.eBH', 'wilcox': 'wi.eBH'}
+_effect_statistic_functions = {'welch': 'we.eBH', 'wilcox': 'wi.eBH',
+                               'kruskal': 'kw.eBH', 'glm': 'glm.eBH'}
+
+# the effect size columns aldex.effect adds; outputs of `--p-test glm` only
+# carry the Kruskal-Wallis and glm statistics
+_effect_columns = ['rab.all', 'diff.btw', 'diff.win', 'effect']
+
+
+def _check_columns(table, columns, needed_by):
+    missing = [column for column in columns if column not in table.columns]
+    if missing:
+        raise ValueError('The differentials lack the column%s %s, which %s '
+                         'needs. Results of aldex2 with --p-test glm carry '
+                         'no effect sizes and only the kruskal and glm '
+                         'q scores.' % ('s' if len(missing) > 1 else '',
+                                        ', '.join(missing), needed_by))
+
 
 def effect_plot(output_dir: str,
                 table: pd.DataFrame,
@@ -22,7 +39,13 @@ def effect_plot(output_dir: str,
         except KeyError:
             raise ValueError('Unknown effect statistic method %s. '
             'The available options are %s.' %
-                    (method, ', '.join(_effect_statistic_functions.keys())))
+                    (test, ', '.join(_effect_statistic_functions.keys())))
+        # every plot is drawn against the effect sizes
+        _check_columns(table, _effect_columns + [effect_statistic_function],
+                       'the effect plot')
+
+        recorder = _instrument.recorder('effect_plot', test=test,
+                                        n_features=len(table))
 
         # base effect plot to build on
         plt.scatter(x="diff.win", y="diff.btw", data=table, color="grey", s = 6)
@@ -53,6 +76,7 @@ def effect_plot(output_dir: str,
 
         img_ep = os.path.join(output_dir, "effect_plot.png")
         plt.savefig(img_ep)
+        recorder.checkpoint('effect_plot')
 
         ########################################################################
         # close current plot, start one for MA
@@ -72,16 +96,19 @@ def effect_plot(output_dir: str,
 
         img_ma = os.path.join(output_dir, "ma_plot.png")
         plt.savefig(img_ma)
+        recorder.checkpoint('ma_plot')
 
         ########################################################################
         # close current plot, start one for volcano
         plt.close()
 
         # base effect plot to build on
-        plt.scatter(x="diff.btw", y="we.eBH", data=table, color="grey", s = 6)
+        plt.scatter(x="diff.btw", y=effect_statistic_function, data=table,
+                    color="grey", s = 6)
 
         # colour for significant points
-        plt.scatter(x="diff.btw", y="we.eBH", data=table[called],
+        plt.scatter(x="diff.btw", y=effect_statistic_function,
+                    data=table[called],
                     color="red", s = 6)
 
         # change titles and labels
@@ -94,8 +121,8 @@ def effect_plot(output_dir: str,
         # change p values to log scale
         plt.yscale('log')
         # get min and max to plot for p values
-        minimum = table["we.eBH"].min()
-        maximum = table["we.eBH"].max()
+        minimum = table[effect_statistic_function].min()
+        maximum = table[effect_statistic_function].max()
         plt.ylim([minimum, maximum])
 
         # plot line where cutoff is located
@@ -104,17 +131,19 @@ def effect_plot(output_dir: str,
                 linewidth=1)
 
         plt.savefig(img_volcano)
+        recorder.checkpoint('volcano_plot')
 
         ########################################################################
         # close current plot, start one for effect vs q score
         plt.close()
 
         # base effect plot to build on
-        plt.scatter(x="effect", y="we.eBH", data=table,
+        plt.scatter(x="effect", y=effect_statistic_function, data=table,
                     color="grey", s = 6)
 
         # colour for significant points
-        plt.scatter(x="effect", y="we.eBH", data=table[called],
+        plt.scatter(x="effect", y=effect_statistic_function,
+                    data=table[called],
                     color="red", s = 6)
 
         # change titles and labels
@@ -125,8 +154,8 @@ def effect_plot(output_dir: str,
         # change p values to log scale
         plt.yscale('log')
         # get min and max to plot for p values
-        minimum = table["we.eBH"].min()
-        maximum = table["we.eBH"].max()
+        minimum = table[effect_statistic_function].min()
+        maximum = table[effect_statistic_function].max()
         plt.ylim([minimum, maximum])
 
         # plot line where cutoff is located
@@ -137,9 +166,12 @@ def effect_plot(output_dir: str,
         img_effect = os.path.join(output_dir, "effect_q_plot.png")
 
         plt.savefig(img_effect)
+        recorder.checkpoint('effect_q_plot')
 
         # get path of index file
         index = os.path.join(TEMPLATES, 'index.html')
 
         # plot_name displays whether effect or MA
         q2templates.render(index, output_dir, context={'plot_name': test})
+        recorder.checkpoint('render')
+        recorder.emit()
@@ -1,11 +1,14 @@
 from qiime2.plugin import (
-    Str, Int, Float, Choices, Citations, Plugin, MetadataColumn, Categorical
+    Str, Int, Float, Bool, Range, Choices, Citations, Plugin, Metadata,
+    MetadataColumn, Categorical, List, Collection
 )
 from q2_types.feature_table import FeatureTable, Frequency
 from q2_types.feature_data import FeatureData, Differential
 
 import q2_aldex2
-from q2_aldex2._method import aldex2, extract_differences
+from q2_aldex2._method import (aldex2, aldex2_batch, aldex2_contrasts,
+                               aldex2_denominators, aldex2_scale_sweep,
+                               extract_differences)
 from q2_aldex2._visualizer import effect_plot
 
 
@@ -23,15 +26,32 @@ plugin = Plugin(
     citations=Citations.load('citations.bib', package='q2_aldex2')
 )
 
+_denominators = ['all', 'iqlr', 'zero', 'lvha']
+
 plugin.methods.register_function(
     function=aldex2,
     name=('Analysis Of Differential Abundance'),
     description=('Performs log-ratio transformation and statistical testing'),
     inputs={'table': FeatureTable[Frequency]},
     parameters={'metadata': MetadataColumn[Categorical],
-                'mc_samples': Int,
+                'mc_samples': Int | Str % Choices(['auto']),
                 'test': Str % Choices(['t', 'glm']),
-                'denom': Str % Choices(['all', 'iqlr'])},
+                'denom': Str % Choices(_denominators),
+                'engine': Str % Choices(['R', 'native']),
+                'seed': Int,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'use_cache': Bool,
+                'reuse_posterior': Bool,
+                'mc_batch_size': Int % Range(1, None),
+                'effect_ci': Bool,
+                'effect_sketch': Int % Range(2, None),
+                'mc_min_samples': Int % Range(2, None),
+                'mc_max_samples': Int % Range(2, None),
+                'mc_tolerance': Float % Range(0, None, inclusive_start=False),
+                'sampling': Str % Choices(['mc', 'antithetic', 'fast']),
+                'fast_threshold': Float % Range(0, None),
+                'denom_features': List[Str]},
     outputs=[('differentials', FeatureData[Differential])],
     input_descriptions={
         'table': 'The feature table of abundances'
@@ -39,15 +59,277 @@ plugin.methods.register_function(
     parameter_descriptions={
         'metadata': 'The "condition": this column will be used as an '
                     'experimental descriptor to group samples',
-        'mc_samples': 'The number of monte carlo samples to be used',
+        'mc_samples': 'The number of monte carlo samples to be used. With '
+                      '`auto` (native engine only), instances are drawn in '
+                      'batches until the expected BH values and effect '
+                      'sizes are settled to mc_tolerance, and the number '
+                      'used is reported in the mc.samples column',
         'test': 'The statistical test to run',
-        'denom': 'The features used to decide a reference frame'
+        'denom': 'The features used to decide a reference frame: `all` '
+                 'features, the features with a clr variance inside the '
+                 'interquartile range (`iqlr`), the features without zeros '
+                 'in each group (`zero`), or the low variance, high '
+                 'abundance features of every group (`lvha`)',
+        'engine': 'Run ALDEx2 through the R package (`R`) or through the '
+                  'NumPy reimplementation (`native`), which avoids starting '
+                  'R and writing the table to disk. With the native engine, '
+                  'the `glm` test (Kruskal-Wallis and glm) also supports '
+                  'conditions with more than two groups',
+        'seed': 'Seed for the Monte Carlo sampling, for reproducible runs',
+        'chunk_size': 'Native engine only: process the features in chunks '
+                      'of about this size to bound memory use. Results are '
+                      'identical to an unchunked run with the same seed. By '
+                      'default the largest chunks predicted to fit in the '
+                      'available memory are used; runs predicted not to fit '
+                      'at all fail before any sampling (R runs only warn, '
+                      'as their footprint is a rough guess). The memory to '
+                      'plan for can be set (in MB) with the '
+                      'Q2_ALDEX2_MEMORY environment variable',
+        'n_jobs': 'Native engine only: number of processes to spread the '
+                  'Monte Carlo sampling and tests over. Results for a '
+                  'given seed do not depend on the number of processes. '
+                  'By default runs predicted to take more than ten '
+                  'seconds use every available CPU the memory allows',
+        'use_cache': 'Reuse the differentials of an earlier run with the '
+                     'same table, condition and parameters, and keep those '
+                     'of this run. Only seeded runs are cached. Cached '
+                     'differentials are written to ~/.cache/q2-aldex2, up '
+                     'to 1024 MB; the directory and its size cap (in MB) '
+                     'are set with the Q2_ALDEX2_CACHE_DIR and '
+                     'Q2_ALDEX2_CACHE_SIZE environment variables',
+        'reuse_posterior': 'Native engine only: keep the Monte Carlo clr '
+                           'instances of this table, mc_samples, denom and '
+                           'seed as a memory-mapped float32 array, and reuse '
+                           'them in later runs with a different test or '
+                           'condition instead of sampling again. The '
+                           'zero and lvha denominators are chosen within '
+                           'every group, so their instances are only reused '
+                           'for the same condition. Stores are '
+                           'kept in Q2_ALDEX2_POSTERIOR_DIR and are not '
+                           'removed automatically',
+        'mc_batch_size': 'Native engine only: test all features this many '
+                         'Monte Carlo instances at a time, keeping running '
+                         'means of the p-values and BH values rather than '
+                         'every instance\'s p-values. Memory for the tests '
+                         'then no longer grows with mc_samples; effect '
+                         'sizes are computed in a second pass unless '
+                         'effect_sketch is set',
+        'effect_ci': 'Native engine only: also report the 2.5% and 97.5% '
+                     'quantiles of the effect size as effect.low and '
+                     'effect.high',
+        'effect_sketch': 'Native engine only, with mc_batch_size: estimate '
+                         'the effect sizes in the same streaming pass as the '
+                         'tests, from quantile sketches holding about this '
+                         'many points per feature. Larger values are more '
+                         'accurate (the rank error is roughly '
+                         '1 / effect_sketch); memory does not grow with '
+                         'mc_samples',
+        'mc_min_samples': 'With mc_samples `auto`: the fewest Monte Carlo '
+                          'instances to draw',
+        'mc_max_samples': 'With mc_samples `auto`: the most Monte Carlo '
+                          'instances to draw',
+        'mc_tolerance': 'With mc_samples `auto`: the Monte Carlo standard '
+                        'error under which an expected BH value or effect '
+                        'size counts as settled. Features whose BH value '
+                        'is clearly on one side of 0.05, or whose absolute '
+                        'effect is clearly on one side of 1, need not reach '
+                        'it',
+        'sampling': 'Native engine only: draw the Monte Carlo instances '
+                    'independently (`mc`) or in antithetic pairs '
+                    '(`antithetic`), which lowers the Monte Carlo error of '
+                    'the expected p-values and BH values for a given '
+                    'mc_samples at about the cost of independent draws. '
+                    'Effects gain less: on small tables (20 samples, 200 '
+                    'features) they are slightly worse than with `mc`, at '
+                    '0.93 to 0.95 times its efficiency. Antithetic runs '
+                    'report the effective sample size of the expected '
+                    'BH values in the mc.ess column. `fast` specialises '
+                    'the draws: all zero counts share one cheap normal '
+                    'draw, and counts above fast_threshold use a normal '
+                    'approximation of the log Gamma draw, so exact Gamma '
+                    'sampling only runs on low non-zero counts',
+        'fast_threshold': 'With sampling `fast`: the count above which the '
+                          'log Gamma draw is approximated by a normal with '
+                          'the exact mean and variance. The largest error '
+                          'in its CDF is about 0.0665 / sqrt(count), e.g. '
+                          '0.0066 at the default of 100',
+        'denom_features': 'IDs of the features to use as the reference '
+                          'frame instead of a denom choice'
     },
     output_descriptions={
         'differentials': 'The estimated per-feature differentials'
     }
 )
 
+plugin.methods.register_function(
+    function=aldex2_denominators,
+    name='Compare ALDEx2 reference frames',
+    description=('Runs the native ALDEx2 engine with several denominators '
+                 'on one set of Monte Carlo instances, to check how robust '
+                 'the differentials are to the choice of reference frame'),
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'metadata': MetadataColumn[Categorical],
+                'denoms': List[Str % Choices(_denominators)],
+                'mc_samples': Int % Range(2, None),
+                'test': Str % Choices(['t', 'glm']),
+                'seed': Int,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'mc_batch_size': Int % Range(1, None)},
+    outputs=[('differentials', Collection[FeatureData[Differential]])],
+    input_descriptions={
+        'table': 'The feature table of abundances'
+    },
+    parameter_descriptions={
+        'metadata': 'The "condition": this column will be used as an '
+                    'experimental descriptor to group samples',
+        'denoms': 'The denominators to compare (default: all and iqlr)',
+        'mc_samples': 'The number of monte carlo samples to be used',
+        'test': 'The statistical test to run',
+        'seed': 'Seed for the Monte Carlo sampling, for reproducible runs',
+        'chunk_size': 'Process the features in chunks of about this size '
+                      'to bound memory use',
+        'n_jobs': 'Number of processes to spread the work over',
+        'mc_batch_size': 'Test all features this many Monte Carlo '
+                         'instances at a time'
+    },
+    output_descriptions={
+        'differentials': 'The differentials of every denominator, keyed '
+                         'by its name'
+    }
+)
+
+plugin.methods.register_function(
+    function=aldex2_batch,
+    name='ALDEx2 of several metadata columns',
+    description=('Runs the native ALDEx2 engine for several categorical '
+                 'metadata columns, drawing and clr transforming the table '
+                 'once and testing every column on the same Monte Carlo '
+                 'instances'),
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'metadata': Metadata,
+                'columns': List[Str],
+                'mc_samples': Int % Range(2, None),
+                'test': Str % Choices(['t', 'glm']),
+                'denom': Str % Choices(_denominators),
+                'seed': Int,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'mc_batch_size': Int % Range(1, None)},
+    outputs=[('differentials', Collection[FeatureData[Differential]])],
+    input_descriptions={
+        'table': 'The feature table of abundances'
+    },
+    parameter_descriptions={
+        'metadata': 'Sample metadata holding the conditions',
+        'columns': 'The categorical columns to test (default: every '
+                   'categorical column with two levels, or with two or '
+                   'more for the glm test). Samples without a value in a '
+                   'column are left out of its tests',
+        'mc_samples': 'The number of monte carlo samples to be used',
+        'test': 'The statistical test to run for every column',
+        'denom': 'The features used to decide a reference frame',
+        'seed': 'Seed for the Monte Carlo sampling, for reproducible runs',
+        'chunk_size': 'Process the features in chunks of about this size '
+                      'to bound memory use',
+        'n_jobs': 'Number of processes to spread the work over',
+        'mc_batch_size': 'Test all features this many Monte Carlo '
+                         'instances at a time'
+    },
+    output_descriptions={
+        'differentials': 'The differentials of every column, keyed by '
+                         'its name'
+    }
+)
+
+plugin.methods.register_function(
+    function=aldex2_contrasts,
+    name='ALDEx2 contrasts of a multi-level condition',
+    description=('Runs the native ALDEx2 engine for every pair of groups of '
+                 'a condition, or every group against all others, on one '
+                 'set of Monte Carlo instances'),
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'metadata': MetadataColumn[Categorical],
+                'contrasts': Str % Choices(['pairwise', 'one-vs-rest']),
+                'mc_samples': Int % Range(2, None),
+                'test': Str % Choices(['t', 'glm']),
+                'denom': Str % Choices(_denominators),
+                'seed': Int,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'mc_batch_size': Int % Range(1, None)},
+    outputs=[('differentials', Collection[FeatureData[Differential]])],
+    input_descriptions={
+        'table': 'The feature table of abundances'
+    },
+    parameter_descriptions={
+        'metadata': 'The "condition": this column will be used as an '
+                    'experimental descriptor to group samples',
+        'contrasts': 'Compare every pair of groups (`pairwise`), leaving '
+                     'out the other samples, or every group against all '
+                     'the others (`one-vs-rest`)',
+        'mc_samples': 'The number of monte carlo samples to be used',
+        'test': 'The statistical test to run for every contrast',
+        'denom': 'The features used to decide a reference frame',
+        'seed': 'Seed for the Monte Carlo sampling, for reproducible runs',
+        'chunk_size': 'Process the features in chunks of about this size '
+                      'to bound memory use',
+        'n_jobs': 'Number of processes to spread the work over',
+        'mc_batch_size': 'Test all features this many Monte Carlo '
+                         'instances at a time'
+    },
+    output_descriptions={
+        'differentials': 'The differentials of every contrast, keyed '
+                         'a-vs-b or a-vs-rest'
+    }
+)
+
+plugin.methods.register_function(
+    function=aldex2_scale_sweep,
+    name='ALDEx2 scale sensitivity',
+    description=('Runs the native ALDEx2 engine under a range of scale '
+                 'uncertainties (gamma) on one set of Monte Carlo '
+                 'instances, to show which differentials survive '
+                 'uncertainty in the total abundance of each sample'),
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'metadata': MetadataColumn[Categorical],
+                'gammas': List[Float % Range(0, None)],
+                'mc_samples': Int % Range(2, None),
+                'test': Str % Choices(['t', 'glm']),
+                'denom': Str % Choices(_denominators),
+                'seed': Int,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'mc_batch_size': Int % Range(1, None)},
+    outputs=[('differentials', Collection[FeatureData[Differential]])],
+    input_descriptions={
+        'table': 'The feature table of abundances'
+    },
+    parameter_descriptions={
+        'metadata': 'The "condition": this column will be used as an '
+                    'experimental descriptor to group samples',
+        'gammas': 'The standard deviations of the log2 scale noise to '
+                  'test (default: 0.001, 0.1, 0.25, 0.5, 0.75, 1, 2, 3, 4 '
+                  'and 5)',
+        'mc_samples': 'The number of monte carlo samples to be used',
+        'test': 'The statistical test to run',
+        'denom': 'The features used to decide a reference frame',
+        'seed': 'Seed for the Monte Carlo sampling, for reproducible runs',
+        'chunk_size': 'Process the features in chunks of about this size '
+                      'to bound memory use',
+        'n_jobs': 'Number of processes to spread the work over',
+        'mc_batch_size': 'Test all features this many Monte Carlo '
+                         'instances at a time'
+    },
+    output_descriptions={
+        'differentials': 'The differentials of every gamma, keyed by its '
+                         'value. In Python, '
+                         'q2_aldex2.scale_sweep_table turns them into one '
+                         'long table of we.eBH and effect per feature and '
+                         'gamma'
+    }
+)
+
 # get choices for test parameter
 effect_statistic_methods = list(q2_aldex2._visualizer._effect_statistic_functions)
 
@@ -71,7 +353,9 @@ plugin.methods.register_function(
         'effect_threshold': 'Effect size cutoff',
         'difference_threshold': 'Size of difference cutoff',
         'test': 'Method of calculating significance, options include '
-        '`welch` for Welchs T test or `wilcox` for Wilcox rank test.'
+        '`welch` for Welchs T test or `wilcox` for Wilcox rank test (from '
+        '`--p-test t`), and `kruskal` for the Kruskal-Wallis test or `glm` '
+        'for the glm (from `--p-test glm`).'
     },
     outputs=[('differentials', FeatureData[Differential])],
     output_descriptions={
@@ -90,7 +374,9 @@ plugin.visualizers.register_function(
     parameter_descriptions={
         'threshold': 'Statistical significance cutoff',
         'test': 'Method of calculating significance; options include '
-        "`welch` for Welch's T test or `wilcox` for Wilcox rank test"
+        "`welch` for Welch's T test or `wilcox` for Wilcox rank test (from "
+        "`--p-test t`), and `kruskal` for the Kruskal-Wallis test or `glm` "
+        "for the glm (from `--p-test glm`)"
     },
     name='Effect plots',
     description=('Visually explore the relationship between difference'
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from q2_aldex2 import _cache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        env = mock.patch.dict(os.environ,
+                              {_cache.CACHE_DIR_ENV: self.cache_dir,
+                               _cache.CACHE_SIZE_ENV: '1'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def summary(self, n_features=10):
+        return pd.DataFrame(
+            np.random.default_rng(n_features).normal(
+                size=(n_features, 2)),
+            index=pd.Index(['F%d' % i for i in range(n_features)],
+                           name='featureid'),
+            columns=['effect', 'we.eBH'])
+
+    def entries(self):
+        return sorted(name[:-len(_cache._SUFFIX)]
+                      for name in os.listdir(self.cache_dir))
+
+    def test_store_load(self):
+        summary = self.summary()
+        self.assertIsNone(_cache.load('a'))
+        _cache.store('a', summary)
+        pd.testing.assert_frame_equal(_cache.load('a'), summary)
+
+    def test_evict(self):
+        for key in ['a', 'b', 'c']:
+            _cache.store(key, self.summary())
+        size = os.path.getsize(_cache._path('a'))
+        self.assertEqual(self.entries(), ['a', 'b', 'c'])
+
+        # loading 'a' makes 'b' the least recently used entry
+        _cache.load('a')
+        _cache.evict(2 * size)
+        self.assertEqual(self.entries(), ['a', 'c'])
+        _cache.evict(size)
+        self.assertEqual(self.entries(), ['a'])
+        _cache.evict(0)
+        self.assertEqual(self.entries(), [])
+
+    def test_evict_on_store(self):
+        # every store keeps the cache within $Q2_ALDEX2_CACHE_SIZE
+        big = self.summary(15000)
+        for key in ['a', 'b', 'c']:
+            _cache.store(key, big)
+        self.assertGreater(os.path.getsize(_cache._path('c')), 2 ** 19)
+        self.assertEqual(self.entries(), ['c'])
+
+
+if __name__ == "__main__":
+    unittest.main()
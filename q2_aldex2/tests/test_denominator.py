@@ -0,0 +1,71 @@
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from q2_aldex2 import _denominator
+
+
+class TestDenominator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.counts = rng.poisson(rng.lognormal(2, 1, size=40),
+                                  size=(12, 40)).astype(float)
+        self.counts[:6, 0] = 0
+        self.counts[6, 1] = 0
+        self.labels = np.repeat([0, 1], 6)
+
+    def select(self, denom):
+        def count_blocks():
+            for start in range(0, 40, 16):
+                cols = slice(start, min(start + 16, 40))
+                yield cols, self.counts[:, cols]
+        return _denominator.select(count_blocks, 12, 40, self.labels, denom,
+                                   0.5)
+
+    def test_all(self):
+        npt.assert_array_equal(self.select('all'), np.ones((1, 40), bool))
+
+    def test_iqlr(self):
+        log = np.log2(self.counts + 0.5)
+        var = (log - log.mean(axis=1, keepdims=True)).var(axis=0, ddof=1)
+        q1, q3 = np.quantile(var, [0.25, 0.75])
+        npt.assert_array_equal(self.select('iqlr')[0], (var > q1) & (var < q3))
+
+    def test_zero(self):
+        mask = self.select('zero')
+        self.assertEqual(mask.shape, (2, 40))
+        npt.assert_array_equal(mask[0], (self.counts[:6] > 0).all(axis=0))
+        npt.assert_array_equal(mask[1], (self.counts[6:] > 0).all(axis=0))
+        self.assertFalse(mask[0, 0])
+        self.assertFalse(mask[1, 1])
+
+    def test_lvha(self):
+        mask = self.select('lvha')
+        self.assertEqual(mask.shape, (1, 40))
+        self.assertTrue(mask.any())
+        self.assertLess(mask.sum(), 10)
+
+    def test_features(self):
+        mask = self.select([3, 5])
+        npt.assert_array_equal(np.flatnonzero(mask[0]), [3, 5])
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.select('median')
+
+    def test_normalisers(self):
+        masks = [self.select('all'), self.select('zero')]
+        weights = _denominator.weights(masks, 2)
+        log = np.random.default_rng(1).normal(size=(3, 12, 40))
+        norm = _denominator.normalisers(log, weights, self.labels)
+        self.assertEqual(norm.shape, (2, 3, 12, 1))
+        npt.assert_allclose(norm[0, ..., 0], log.mean(axis=-1))
+        for s, g in enumerate(self.labels):
+            npt.assert_allclose(norm[1, :, s, 0],
+                                log[:, s, masks[1][g]].mean(axis=-1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from q2_aldex2 import _instrument
+
+
+class TestRecorder(unittest.TestCase):
+
+    def tearDown(self):
+        _instrument.set_sink(None)
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {_instrument.INSTRUMENT_ENV: ''}):
+            recorder = _instrument.recorder('aldex2')
+            with recorder.stage('filter'):
+                pass
+            recorder.checkpoint('plot')
+            self.assertEqual(list(recorder.stages), [])
+            self.assertIsNone(recorder.emit())
+
+    def test_stages(self):
+        records = []
+        _instrument.set_sink(records.append)
+        recorder = _instrument.recorder('aldex2', engine='R')
+        with recorder.stage('export'):
+            sum(range(10000))
+        recorder.checkpoint('plot')
+        with recorder.stage('R'):
+            pass
+        recorder.stages[-1]['wall'] = 2.
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            summary = os.path.join(dir_name, 'output.summary.txt')
+            with open(_instrument.r_stages_path(summary), 'w') as fh:
+                fh.write('stage\twall\tcpu\tchild_cpu\tpeak_rss_mb\n'
+                         'load\t1.25\t1.2\t0\tNA\n'
+                         'aldex\t0.5\t0.5\t0\t812.5\n')
+            recorder.add_r_stages(summary)
+        recorder.emit()
+
+        record, = records
+        self.assertEqual(record['action'], 'aldex2')
+        self.assertEqual(record['params'], {'engine': 'R'})
+        self.assertEqual([stage['stage'] for stage in record['stages']],
+                         ['export', 'plot', 'R', 'R.startup', 'R.load',
+                          'R.aldex'])
+        for stage in record['stages'][:3]:
+            self.assertGreaterEqual(stage['wall'], 0)
+            self.assertGreater(stage['peak_rss_mb'], 0)
+        self.assertAlmostEqual(record['stages'][3]['wall'], 0.25)
+        self.assertIsNone(record['stages'][4]['peak_rss_mb'])
+        self.assertEqual(record['stages'][5]['peak_rss_mb'], 812.5)
+        self.assertGreaterEqual(record['total']['wall'],
+                                record['stages'][0]['wall'])
+        self.assertIn('R.aldex', recorder.summary())
+
+    def test_summary_r_child_cpu(self):
+        # R reports the CPU time of its children but not their peak RSS
+        _instrument.set_sink(lambda record: None)
+        recorder = _instrument.recorder('aldex2', engine='R')
+        with tempfile.TemporaryDirectory() as dir_name:
+            summary = os.path.join(dir_name, 'output.summary.txt')
+            with open(_instrument.r_stages_path(summary), 'w') as fh:
+                fh.write('stage\twall\tcpu\tchild_cpu\tpeak_rss_mb\n'
+                         'aldex\t0.5\t0.5\t0.25\t812.5\n')
+            recorder.add_r_stages(summary)
+        self.assertIn('R.aldex', recorder.summary())
+        self.assertIn('children: 0.250s cpu', recorder.summary())
+
+    def test_env_path(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'stages.jsonl')
+            with mock.patch.dict(os.environ,
+                                 {_instrument.INSTRUMENT_ENV: path}):
+                for _ in range(2):
+                    recorder = _instrument.recorder('effect_plot')
+                    recorder.checkpoint('render')
+                    recorder.emit()
+            with open(path) as fh:
+                records = [json.loads(line) for line in fh]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['stages'][0]['stage'], 'render')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,33 @@
+import biom
 import qiime2
 import numpy as np
 import pandas as pd
+import numpy.testing as npt
+import scipy.sparse
 from sklearn.utils import check_random_state
+from scipy import stats
 from scipy.stats import pearsonr
+import os
+import pickle
+import tempfile
+import functools
+import concurrent.futures
 import unittest
-from q2_aldex2._method import aldex2
+import warnings
+from unittest import mock
+from q2_aldex2 import _instrument, _plan, _profile
+from q2_aldex2._method import (aldex2, aldex2_batch, aldex2_contrasts,
+                              aldex2_denominators, aldex2_plan,
+                              aldex2_scale_sweep, extract_differences,
+                              scale_sweep_table, _engine_version)
+from q2_aldex2._visualizer import effect_plot
+from q2_aldex2._native import (_antithetic_gamma, _ordered_map, _pairing,
+                               _share)
+
+
+# Samples per random stream of the simulated counts; tables are generated a
+# whole number of these at a time
+_SIMULATION_BLOCK = 256
 
 
 def random_block_table(reps, n_species,
@@ -13,7 +36,8 @@ def random_block_table(reps, n_species,
                        effect_size=1,
                        library_size=10000,
                        microbe_total=100000, microbe_kappa=0.3,
-                       microbe_tau=0.1, sigma=0.5, seed=None):
+                       microbe_tau=0.1, sigma=0.5, seed=None,
+                       sparse=False, chunk_size=None):
     """ Differential abundance analysis benchmarks.
 
     The simulation here consists of 3 parts
@@ -22,6 +46,10 @@ def random_block_table(reps, n_species,
     Step 2: generate coefficients from normal distributions
     Step 3: generate counts from species distributions
 
+    The counts are drawn with array operations, one block of samples at a
+    time from a random stream of its own, so they do not depend on
+    `chunk_size`.
+
     Parameters
     ----------
     reps : int
@@ -42,6 +70,14 @@ def random_block_table(reps, n_species,
         A vector specifying the library sizes per sample.
     template : np.array
         A vector specifying feature abundances or relative proportions.
+    seed : int or np.random.RandomState, optional
+        Seed of every draw. By default NumPy's global random state is used.
+    sparse : bool
+        Return the counts as a sparse DataFrame, built a chunk of samples at
+        a time, and no absolute abundances.
+    chunk_size : int, optional
+        Number of samples generated at once, rounded up to a multiple of
+        the random stream block size. By default all of them.
 
     Returns
     -------
@@ -54,37 +90,116 @@ def random_block_table(reps, n_species,
            Species actually differentially abundant.
     """
     state = check_random_state(seed)
-    data = []
+    labels, class_probs, X, B = _block_design(
+        reps, n_species, species_mean, species_var, effect_size, sigma,
+        state)
+    o_ids = ['F%d' % i for i in range(n_species)]
+    s_ids = ['S%d' % i for i in range(len(labels))]
+
+    chunks = _block_counts(X, B, library_size, microbe_total, microbe_kappa,
+                           microbe_tau, state, chunk_size)
+    if sparse:
+        abs_table = None
+        rel_table = pd.DataFrame.sparse.from_spmatrix(
+            scipy.sparse.vstack([scipy.sparse.csr_matrix(counts)
+                                 for _, _, counts in chunks]),
+            index=s_ids, columns=o_ids)
+    else:
+        chunks = list(chunks)
+        abs_table = pd.DataFrame(np.vstack([abs_ for _, abs_, _ in chunks]),
+                                 index=s_ids, columns=o_ids)
+        rel_table = pd.DataFrame(np.vstack([counts
+                                            for _, _, counts in chunks]),
+                                 index=s_ids, columns=o_ids)
+
+    metadata, ground_truth = _block_truth(labels, class_probs, B,
+                                          effect_size, microbe_total, s_ids,
+                                          o_ids)
+    return abs_table, rel_table, metadata, ground_truth
+
+
+def write_block_table(path, reps, n_species,
+                      species_mean=0,
+                      species_var=1.,
+                      effect_size=1,
+                      library_size=10000,
+                      microbe_total=100000, microbe_kappa=0.3,
+                      microbe_tau=0.1, sigma=0.5, seed=None,
+                      chunk_size=1024):
+    """ Simulate a `random_block_table` straight to disk.
+
+    Only `chunk_size` samples are held in memory at a time. The counts are
+    written as a samples x features TSV with a 'sampleid' header, the text
+    layout run_aldex2.R reads, and are the counts `random_block_table`
+    returns for the same arguments. Returns the metadata and the ground
+    truth.
+    """
+    state = check_random_state(seed)
+    labels, class_probs, X, B = _block_design(
+        reps, n_species, species_mean, species_var, effect_size, sigma,
+        state)
+    o_ids = ['F%d' % i for i in range(n_species)]
+    s_ids = ['S%d' % i for i in range(len(labels))]
+
+    chunks = _block_counts(X, B, library_size, microbe_total, microbe_kappa,
+                           microbe_tau, state, chunk_size)
+    with open(path, 'w') as fh:
+        for rows, _, counts in chunks:
+            pd.DataFrame(counts, index=s_ids[rows], columns=o_ids).to_csv(
+                fh, sep='\t', header=rows.start == 0,
+                index_label='sampleid')
 
+    return _block_truth(labels, class_probs, B, effect_size, microbe_total,
+                        s_ids, o_ids)
+
+
+def _block_design(reps, n_species, species_mean, species_var, effect_size,
+                  sigma, state):
+    """ Labels, class probabilities, design and coefficients (steps 1 and
+    2 of `random_block_table`).
+    """
     n = reps * 2
     k = 2
     labels = np.array([-effect_size] * (n // 2) + [effect_size] * (n // 2))
-    eps = np.random.logistic(loc=0, scale=sigma, size=n)
+    eps = state.logistic(loc=0, scale=sigma, size=n)
     class_probs = labels + eps
 
     X = np.hstack((np.ones((n, 1)), class_probs.reshape(-1, 1)))
-    B = np.random.normal(loc=species_mean, scale=species_var, size=(k, n_species))
+    B = state.normal(loc=species_mean, scale=species_var, size=(k, n_species))
+    return labels, class_probs, X, B
 
-    ## Helper functions
-    # Convert microbial abundances to counts
-    def to_counts_f(x):
-        n = state.lognormal(np.log(library_size), microbe_tau)
-        p = x / x.sum()
-        return state.poisson(state.lognormal(np.log(n*p), microbe_kappa))
 
-    o_ids = ['F%d' % i for i in range(n_species)]
-    s_ids = ['S%d' % i for i in range(n)]
-
-    abs_table = pd.DataFrame(np.exp(X @ B) * microbe_total,
-                             index=s_ids,
-                             columns=o_ids)
+def _block_counts(X, B, library_size, microbe_total, microbe_kappa,
+                  microbe_tau, state, chunk_size=None):
+    """ Absolute abundances and counts of `random_block_table` (step 3),
+    yielded as (rows, abundances, counts) chunks of samples.
+    """
+    n = len(X)
+    seed = state.randint(2 ** 31)
+    seeds = np.random.SeedSequence(seed).spawn(-(-n // _SIMULATION_BLOCK))
+    per_chunk = len(seeds)
+    if chunk_size is not None:
+        per_chunk = max(1, -(-chunk_size // _SIMULATION_BLOCK))
 
-    rel_data = np.vstack(abs_table.apply(to_counts_f, axis=1))
+    for first in range(0, len(seeds), per_chunk):
+        rows = slice(first * _SIMULATION_BLOCK,
+                     min(n, (first + per_chunk) * _SIMULATION_BLOCK))
+        abs_ = np.exp(X[rows] @ B) * microbe_total
+        counts = np.empty(abs_.shape, dtype=np.int64)
+        for i, block_seed in enumerate(seeds[first:first + per_chunk]):
+            block = slice(i * _SIMULATION_BLOCK, (i + 1) * _SIMULATION_BLOCK)
+            rng = np.random.default_rng(block_seed)
+            # convert microbial abundances to counts
+            depth = rng.lognormal(np.log(library_size), microbe_tau,
+                                  size=(len(abs_[block]), 1))
+            p = abs_[block] / abs_[block].sum(axis=1, keepdims=True)
+            counts[block] = rng.poisson(rng.lognormal(np.log(depth * p),
+                                                      microbe_kappa))
+        yield rows, abs_, counts
 
-    rel_table = pd.DataFrame(rel_data,
-                             index=s_ids,
-                             columns=o_ids)
 
+def _block_truth(labels, class_probs, B, effect_size, microbe_total, s_ids,
+                 o_ids):
     metadata = pd.DataFrame({'labels': labels})
     metadata['effect_size'] = effect_size
     metadata['microbe_total'] = microbe_total
@@ -96,13 +211,28 @@ def random_block_table(reps, n_species,
         'intercept': B[0, :],
         'categorical': B[1, :]
     }, index=o_ids)
+    return metadata, ground_truth
 
-    return abs_table, rel_table, metadata, ground_truth
+
+def to_biom(table):
+    """ Convert a samples x features DataFrame into a biom.Table. """
+    if hasattr(table, 'sparse'):
+        return biom.Table(table.sparse.to_coo().T.tocsr(),
+                          list(table.columns), list(table.index))
+    return biom.Table(table.values.T, list(table.columns), list(table.index))
 
 
 class TestAldex2(unittest.TestCase):
 
     def setUp(self):
+        # keep cached results out of the user's cache
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        env = mock.patch.dict(os.environ, {
+            'Q2_ALDEX2_CACHE_DIR': cache_dir.name,
+            'XDG_CACHE_HOME': cache_dir.name})
+        env.start()
+        self.addCleanup(env.stop)
 
         np.random.seed(0)
         num_samples = 100
@@ -118,13 +248,20 @@ class TestAldex2(unittest.TestCase):
                                  microbe_total=100000,
                                  effect_size=1)
 
+    def _inputs(self):
+        """ The simulated table and its labels as aldex2 takes them. """
+        _, rel_table, metadata, _ = self.res
+        # the labels are ints, which qiime2 would treat as numeric
+        labels = metadata['labels'].astype(str)
+        return to_biom(rel_table), qiime2.CategoricalMetadataColumn(labels)
+
     def test_aldex2(self):
         abs_table, rel_table, metadata, ground_truth = self.res
 
         rel_table.index.name = 'sampleid'
         metadata.index.name = 'sampleid'
 
-        table = rel_table
+        table = to_biom(rel_table)
         condition = 'labels'
         # Make sure that pandas treats the condition column as categorical, and
         # not numeric (since the "labels" are just ints, pandas infers this as
@@ -150,6 +287,542 @@ class TestAldex2(unittest.TestCase):
         self.assertGreater(res[0], 0.9)
         self.assertLess(res[1], 1e-10)
 
+    def test_aldex2_native(self):
+        table, metadata = self._inputs()
+        ground_truth = self.res[3]
+
+        diff = aldex2(table, metadata, 128, 't', 'all',
+                      engine='native', seed=0, use_cache=False)
+
+        self.assertEqual(list(diff.columns),
+                         ['rab.all', 'rab.win.-1', 'rab.win.1', 'diff.btw',
+                          'diff.win', 'effect', 'overlap', 'we.ep', 'we.eBH',
+                          'wi.ep', 'wi.eBH'])
+        truth = ground_truth.categorical.loc[diff.index]
+        res = pearsonr(diff['diff.btw'], truth)
+        self.assertGreater(res[0], 0.9)
+        self.assertLess(res[1], 1e-10)
+
+        # a fixed seed gives identical differentials
+        again = aldex2(table, metadata, 128, 't', 'all',
+                       engine='native', seed=0, use_cache=False)
+        pd.testing.assert_frame_equal(diff, again)
+
+        # chunking the features does not change the results
+        chunked = aldex2(table, metadata, 128, 't', 'all',
+                         engine='native', seed=0, chunk_size=50,
+                         use_cache=False)
+        pd.testing.assert_frame_equal(diff, chunked)
+
+        # neither does the number of worker processes
+        parallel = aldex2(table, metadata, 128, 't', 'all',
+                          engine='native', seed=0, n_jobs=2, use_cache=False)
+        pd.testing.assert_frame_equal(diff, parallel)
+
+        # streaming the instances in batches only changes the rounding
+        streamed = aldex2(table, metadata, 128, 't', 'all',
+                          engine='native', seed=0, mc_batch_size=10,
+                          use_cache=False)
+        pd.testing.assert_frame_equal(diff, streamed, check_exact=False,
+                                      rtol=1e-10)
+
+        # sketched effect sizes, with their interval, track the exact ones
+        sketched = aldex2(table, metadata, 128, 't', 'all',
+                          engine='native', seed=0, mc_batch_size=16,
+                          effect_ci=True, effect_sketch=256, use_cache=False)
+        self.assertEqual(list(sketched.columns),
+                         ['rab.all', 'rab.win.-1', 'rab.win.1', 'diff.btw',
+                          'diff.win', 'effect', 'effect.low', 'effect.high',
+                          'overlap', 'we.ep', 'we.eBH', 'wi.ep', 'wi.eBH'])
+        pd.testing.assert_frame_equal(diff[['we.ep', 'wi.eBH']],
+                                      sketched[['we.ep', 'wi.eBH']],
+                                      check_exact=False, rtol=1e-10)
+        self.assertGreater(pearsonr(diff['effect'], sketched['effect'])[0],
+                           0.99)
+        self.assertTrue((sketched['effect.low'] <= sketched['effect']).all())
+        self.assertTrue((sketched['effect'] <= sketched['effect.high']).all())
+
+    def test_aldex2_native_auto(self):
+        table, metadata = self._inputs()
+
+        diff = aldex2(table, metadata, 'auto', engine='native', seed=0,
+                      mc_min_samples=32, mc_max_samples=512, use_cache=False)
+        used = diff['mc.samples'].iloc[0]
+        self.assertTrue((diff['mc.samples'] == used).all())
+        self.assertGreaterEqual(used, 32)
+        self.assertLessEqual(used, 512)
+
+        # the same instances as a fixed run of the size it settled on
+        fixed = aldex2(table, metadata, int(used), engine='native', seed=0,
+                       mc_batch_size=16, use_cache=False)
+        pd.testing.assert_frame_equal(diff.drop(columns='mc.samples'), fixed)
+
+        with self.assertRaises(ValueError):
+            aldex2(table, metadata, 'auto', engine='R')
+
+    def test_aldex2_native_only(self):
+        table, metadata = self._inputs()
+
+        for name, value in [('chunk_size', 50), ('n_jobs', 2),
+                            ('reuse_posterior', True),
+                            ('mc_batch_size', 16), ('effect_ci', True),
+                            ('effect_sketch', 64), ('sampling', 'fast')]:
+            with self.assertRaisesRegex(ValueError, '%s requires the '
+                                        'native engine' % name):
+                aldex2(table, metadata, 16, engine='R', **{name: value})
+
+    def test_aldex2_native_pairing(self):
+        # no instance is paired with itself within a group, which would
+        # make the effect's denominator zero wherever both groups do
+        pairing = _pairing(3, 4, 2, np.random.default_rng(0))
+        for key in ['win_x', 'win_y']:
+            i, j = pairing[key]
+            self.assertEqual(len(i), 6)
+            self.assertTrue((i != j).all())
+
+        np.random.seed(0)
+        _, rel_table, metadata, _ = random_block_table(
+            25, 200, microbe_kappa=0.7, microbe_tau=0.7)
+        metadata = qiime2.CategoricalMetadataColumn(
+            metadata['labels'].astype(str))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            diff = aldex2(to_biom(rel_table), metadata, 8, engine='native',
+                          seed=4, use_cache=False)
+        self.assertTrue(np.isfinite(diff['effect']).all())
+
+    def test_aldex2_native_antithetic(self):
+        table, metadata = self._inputs()
+
+        diff = aldex2(table, metadata, 32, engine='native', seed=0,
+                      sampling='antithetic', use_cache=False)
+        self.assertEqual(list(diff.columns)[-1], 'mc.ess')
+        # antithetic pairs are worth more than as many independent draws
+        self.assertGreater(diff['mc.ess'].median(), 32)
+
+        # even batches keep the pairs
+        streamed = aldex2(table, metadata, 32, engine='native', seed=0,
+                          sampling='antithetic', mc_batch_size=8,
+                          use_cache=False)
+        self.assertGreater(streamed['mc.ess'].median(), 32)
+        self.assertGreater(pearsonr(streamed['we.ep'], diff['we.ep'])[0],
+                           0.95)
+
+    def test_aldex2_native_fast(self):
+        table, metadata = self._inputs()
+
+        diff = aldex2(table, metadata, 32, engine='native', seed=0,
+                      use_cache=False)
+        fast = aldex2(table, metadata, 32, engine='native', seed=0,
+                      sampling='fast', fast_threshold=50, use_cache=False)
+        self.assertEqual(list(diff.columns), list(fast.columns))
+        self.assertGreater(pearsonr(diff['diff.btw'], fast['diff.btw'])[0],
+                           0.99)
+
+        # the instances do not depend on how many are drawn at a time
+        streamed = aldex2(table, metadata, 32, engine='native', seed=0,
+                          sampling='fast', fast_threshold=50,
+                          mc_batch_size=5, use_cache=False)
+        pd.testing.assert_frame_equal(fast, streamed, check_exact=False,
+                                      rtol=1e-10)
+
+    def test_aldex2_denominators(self):
+        table, metadata = self._inputs()
+
+        diff = aldex2_denominators(table, metadata, ['all', 'iqlr', 'zero'],
+                                   16, seed=0)
+        self.assertEqual(list(diff), ['all', 'iqlr', 'zero'])
+
+        # the same instances as separate runs with each denominator, each a
+        # set of differentials of its own
+        for denom in ['all', 'iqlr', 'zero']:
+            single = aldex2(table, metadata, 16, denom=denom,
+                            engine='native', seed=0, use_cache=False)
+            pd.testing.assert_index_equal(diff[denom].columns,
+                                          single.columns)
+            pd.testing.assert_frame_equal(diff[denom], single,
+                                          check_exact=False, rtol=1e-10,
+                                          atol=1e-12)
+
+        # a custom reference frame
+        ids = list(table.ids(axis='observation')[:20])
+        custom = aldex2(table, metadata, 16, engine='native', seed=0,
+                        use_cache=False, denom_features=ids)
+        self.assertFalse(np.allclose(custom['diff.btw'],
+                                     diff['all']['diff.btw']))
+        with self.assertRaises(ValueError):
+            aldex2(table, metadata, 16, engine='native',
+                   denom_features=['missing'])
+
+    def test_aldex2_batch(self):
+        abs_table, rel_table, metadata, ground_truth = self.res
+
+        labels = metadata['labels'].astype(str)
+        halves = pd.Series(np.tile(['a', 'b'], 50), index=labels.index)
+        partial = halves.copy()
+        partial.iloc[:10] = np.nan
+        quarters = pd.Series(np.tile(['a', 'b', 'c', 'd'], 25),
+                             index=labels.index)
+        frame = pd.DataFrame({'labels': labels, 'halves': halves,
+                              'partial': partial, 'quarters': quarters,
+                              'depth': 1.0})
+        table = to_biom(rel_table)
+
+        # the t test skips the four-level column, and says so
+        with self.assertWarnsRegex(UserWarning, 'Skipping metadata column '
+                                   'quarters: 4 levels'):
+            diff = aldex2_batch(table, qiime2.Metadata(frame),
+                                mc_samples=16, seed=0)
+        self.assertEqual(list(diff), ['labels', 'halves', 'partial'])
+        self.assertEqual(list(diff['labels'].columns[:2]),
+                         ['rab.all', 'rab.win.-1'])
+
+        # the same instances as a run per column
+        for name in ['labels', 'halves']:
+            column = qiime2.CategoricalMetadataColumn(frame[name])
+            single = aldex2(table, column, 16, engine='native', seed=0,
+                            use_cache=False)
+            pd.testing.assert_frame_equal(diff[name], single,
+                                          check_exact=False, rtol=1e-10,
+                                          atol=1e-12)
+        # only the labelled samples are grouped
+        self.assertFalse(np.allclose(diff['partial']['effect'],
+                                     diff['halves']['effect']))
+
+        # the glm test takes every column
+        diff = aldex2_batch(table, qiime2.Metadata(frame), mc_samples=16,
+                            test='glm', seed=0)
+        self.assertEqual(list(diff),
+                         ['labels', 'halves', 'partial', 'quarters'])
+
+        with self.assertRaises(ValueError):
+            aldex2_batch(table, qiime2.Metadata(frame), ['depth'])
+
+    def test_aldex2_contrasts(self):
+        abs_table, rel_table, metadata, ground_truth = self.res
+
+        groups = pd.Series(np.repeat(['a', 'b', 'c', 'd'], 25),
+                           index=rel_table.index, name='groups')
+        groups.index.name = 'sampleid'
+        table = to_biom(rel_table)
+        column = qiime2.CategoricalMetadataColumn(groups)
+
+        diff = aldex2_contrasts(table, column, mc_samples=16, seed=0)
+        self.assertEqual(list(diff), ['a-vs-b', 'a-vs-c', 'a-vs-d',
+                                      'b-vs-c', 'b-vs-d', 'c-vs-d'])
+        self.assertEqual(list(diff['a-vs-b'].columns[:3]),
+                         ['rab.all', 'rab.win.a', 'rab.win.b'])
+
+        # a pair of groups is the run of those groups alone
+        pair = groups.where(groups.isin(['b', 'd']))
+        single = aldex2(table, qiime2.CategoricalMetadataColumn(pair), 16,
+                        engine='native', seed=0, use_cache=False)
+        pd.testing.assert_frame_equal(diff['b-vs-d'], single,
+                                      check_exact=False, rtol=1e-10,
+                                      atol=1e-12)
+        # b and d hold different labels of the simulation
+        self.assertGreater(diff['b-vs-d']['effect'].abs().max(), 1)
+        # every contrast can be read as a single run's differentials
+        called = extract_differences(diff['b-vs-d'], sig_threshold=1,
+                                     effect_threshold=0,
+                                     difference_threshold=0)
+        self.assertGreater(len(called), 0)
+
+        diff = aldex2_contrasts(table, column, 'one-vs-rest', 16, seed=0)
+        self.assertEqual(list(diff), ['a-vs-rest', 'b-vs-rest',
+                                      'c-vs-rest', 'd-vs-rest'])
+        self.assertEqual(list(diff['a-vs-rest'].columns[:3]),
+                         ['rab.all', 'rab.win.a', 'rab.win.rest'])
+
+    def test_aldex2_scale_sweep(self):
+        table, metadata = self._inputs()
+
+        diff = aldex2_scale_sweep(table, metadata, [0, 0.5, 2], 16, seed=0)
+        self.assertEqual(list(diff), ['0.0', '0.5', '2.0'])
+
+        # without scale noise, the instances of a plain run
+        plain = aldex2(table, metadata, 16, engine='native', seed=0,
+                       use_cache=False)
+        pd.testing.assert_index_equal(diff['0.0'].columns, plain.columns)
+        npt.assert_allclose(diff['0.0']['we.eBH'], plain['we.eBH'])
+        # scale uncertainty shrinks the effects
+        self.assertLess(diff['2.0']['effect'].abs().mean(),
+                        diff['0.0']['effect'].abs().mean())
+
+        # planned for every gamma
+        with mock.patch.dict(os.environ, {_plan.MEMORY_ENV: '0.001'}):
+            with self.assertRaises(MemoryError):
+                aldex2_scale_sweep(table, metadata, [0, 0.5, 2], 16, seed=0)
+
+        # the tidy view: one row per feature and gamma
+        tidy = scale_sweep_table(diff)
+        self.assertEqual(list(tidy.columns),
+                         ['gamma', 'featureid', 'we.eBH', 'effect'])
+        self.assertEqual(len(tidy), 3 * len(plain))
+        row = tidy[(tidy['gamma'] == 2) &
+                   (tidy['featureid'] == plain.index[0])]
+        self.assertEqual(row['effect'].item(),
+                         diff['2.0']['effect'].iloc[0])
+        with self.assertRaisesRegex(ValueError, 'kw.eBH'):
+            scale_sweep_table(diff, ['kw.eBH'])
+
+    def test_aldex2_native_glm(self):
+        abs_table, rel_table, metadata, ground_truth = self.res
+
+        # four groups: the first two hold the '-1' samples, the last two
+        # the '1' samples
+        groups = pd.Series(np.repeat(['a', 'b', 'c', 'd'], 25),
+                           index=rel_table.index, name='groups')
+        groups.index.name = 'sampleid'
+        metadata = qiime2.CategoricalMetadataColumn(groups)
+
+        diff = aldex2(to_biom(rel_table), metadata, 16, 'glm',
+                      engine='native', seed=0, use_cache=False)
+
+        self.assertEqual(list(diff.columns),
+                         ['kw.ep', 'kw.eBH', 'glm.ep', 'glm.eBH'])
+        # features with a large effect separate the groups
+        strong = ground_truth.categorical.loc[diff.index].abs() > 1.5
+        self.assertLess(diff.loc[strong, 'glm.eBH'].max(), 0.05)
+        self.assertLess(diff.loc[strong, 'kw.eBH'].max(), 0.05)
+
+        # without effect sizes, only the q scores are thresholded
+        called = extract_differences(diff, test='glm')
+        self.assertEqual(list(called.index),
+                         list(diff.index[diff['glm.eBH'] <= 0.1]))
+        with self.assertRaisesRegex(ValueError, 'we.eBH.*welch'):
+            extract_differences(diff, test='welch')
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaisesRegex(ValueError,
+                                        'rab.all, diff.btw, diff.win, '
+                                        'effect, which the effect plot'):
+                effect_plot(output_dir, diff, test='glm')
+
+    def test_aldex2_cache(self):
+        table, metadata = self._inputs()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.dict(os.environ,
+                                 {'Q2_ALDEX2_CACHE_DIR': cache_dir}):
+                diff = aldex2(table, metadata, 16, engine='native', seed=1,
+                              use_cache=True)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+                with mock.patch('q2_aldex2._method.aldex2_native') as run:
+                    cached = aldex2(table, metadata, 16, engine='native',
+                                    seed=1, use_cache=True)
+                    run.assert_not_called()
+                pd.testing.assert_frame_equal(diff, cached)
+
+                # the cache is opt-in
+                with mock.patch('q2_aldex2._method.aldex2_native',
+                                return_value=diff) as run:
+                    aldex2(table, metadata, 16, engine='native', seed=1)
+                    run.assert_called_once()
+
+    def test_aldex2_cache_r_version(self):
+        # R results are keyed on the installed ALDEx2, not just the plugin
+        with mock.patch('q2_aldex2._method._aldex2_version',
+                        return_value='1.30.0'):
+            old = _engine_version('R')
+        with mock.patch('q2_aldex2._method._aldex2_version',
+                        return_value='1.32.0') as version:
+            self.assertNotEqual(_engine_version('R'), old)
+            _engine_version('native')
+            version.assert_called_once()
+
+    def test_aldex2_cache_batch_size(self):
+        table, metadata = self._inputs()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.dict(os.environ,
+                                 {'Q2_ALDEX2_CACHE_DIR': cache_dir}):
+                # where 'auto' stops and what the sketches hold depend on
+                # the batches, so every batch size is stored on its own
+                for params in [dict(mc_samples='auto', mc_max_samples=64),
+                               dict(mc_samples=32, effect_sketch=64)]:
+                    for mc_batch_size in [4, 8]:
+                        fresh = aldex2(table, metadata, engine='native',
+                                       seed=1, mc_batch_size=mc_batch_size,
+                                       use_cache=False, **params)
+                        cached = aldex2(table, metadata, engine='native',
+                                        seed=1, mc_batch_size=mc_batch_size,
+                                        use_cache=True, **params)
+                        pd.testing.assert_frame_equal(cached, fresh)
+                self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+                # otherwise batches only bound memory and share an entry
+                aldex2(table, metadata, 16, engine='native', seed=1,
+                       mc_batch_size=4, use_cache=True)
+                with mock.patch('q2_aldex2._method.aldex2_native') as run:
+                    aldex2(table, metadata, 16, engine='native', seed=1,
+                           mc_batch_size=8, use_cache=True)
+                    run.assert_not_called()
+                self.assertEqual(len(os.listdir(cache_dir)), 5)
+
+    def test_aldex2_instrumented(self):
+        table, metadata = self._inputs()
+
+        records = []
+        _instrument.set_sink(records.append)
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                with mock.patch.dict(os.environ,
+                                     {'Q2_ALDEX2_CACHE_DIR': cache_dir}):
+                    for _ in range(2):
+                        aldex2(table, metadata, 16, engine='native', seed=1,
+                               use_cache=True)
+        finally:
+            _instrument.set_sink(None)
+
+        computed, cached = records
+        self.assertEqual(computed['params']['engine'], 'native')
+        self.assertEqual([stage['stage'] for stage in computed['stages']],
+                         ['filter', 'cache.load', 'plan', 'native',
+                          'cache.store'])
+        self.assertEqual([stage['stage'] for stage in cached['stages']],
+                         ['filter', 'cache.load'])
+        self.assertGreater(computed['total']['wall'],
+                           computed['stages'][3]['wall'] * 0.99)
+
+    def test_aldex2_plan(self):
+        table, metadata = self._inputs()
+
+        plan = aldex2_plan(table, 16, engine='native')
+        self.assertTrue(plan.feasible)
+        self.assertEqual(plan.n_jobs, 1)
+        self.assertEqual(plan.n_samples, table.shape[1])
+        self.assertGreater(plan.peak, 0)
+
+        with mock.patch.dict(os.environ, {_plan.MEMORY_ENV: '0.001'}):
+            self.assertFalse(aldex2_plan(table, 16, engine='native').feasible)
+            with self.assertRaisesRegex(MemoryError, 'mc_batch_size'):
+                aldex2(table, metadata, 16, engine='native', seed=1,
+                       use_cache=False)
+
+    def test_aldex2_profiled(self):
+        table, metadata = self._inputs()
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with mock.patch.dict(os.environ,
+                                 {_profile.PROFILE_ENV: profile_dir}):
+                diff = aldex2(table, metadata, 16, engine='native', seed=1,
+                              use_cache=False)
+            names = sorted(os.listdir(profile_dir))
+            with open(os.path.join(profile_dir, names[0])) as fh:
+                collapsed = fh.read()
+
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].startswith('aldex2-'))
+        self.assertTrue(names[0].endswith('.collapsed'))
+        self.assertTrue(names[1].endswith('.prof'))
+        self.assertIn('(aldex2_native)', collapsed)
+        exp = aldex2(table, metadata, 16, engine='native', seed=1,
+                     use_cache=False)
+        pd.testing.assert_frame_equal(diff, exp)
+
+    def test_aldex2_reuse_posterior(self):
+        abs_table, rel_table, metadata, ground_truth = self.res
+
+        labels = metadata['labels'].astype(str)
+        shuffled = pd.Series(
+            np.random.default_rng(0).permutation(labels.values),
+            index=labels.index, name='shuffled')
+        table = to_biom(rel_table)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.dict(os.environ,
+                                 {'Q2_ALDEX2_CACHE_DIR': cache_dir}):
+                diff = aldex2(table, qiime2.CategoricalMetadataColumn(labels),
+                              16, engine='native', seed=1, use_cache=False,
+                              reuse_posterior=True)
+
+                # a new grouping reuses the stored instances
+                with mock.patch('q2_aldex2._native._log_gamma') as draw:
+                    other = aldex2(table,
+                                   qiime2.CategoricalMetadataColumn(shuffled),
+                                   16, engine='native', seed=1,
+                                   use_cache=False, reuse_posterior=True)
+                    draw.assert_not_called()
+                self.assertEqual(list(other.index), list(diff.index))
+                self.assertFalse(np.allclose(other['we.ep'], diff['we.ep']))
+
+                # reused instances give the results of a fresh run, also
+                # with denominators chosen within every group
+                for denom in ['all', 'zero', 'lvha']:
+                    runs = [aldex2(table,
+                                   qiime2.CategoricalMetadataColumn(grouping),
+                                   16, denom=denom, engine='native', seed=1,
+                                   use_cache=False, reuse_posterior=reuse)
+                            for grouping, reuse in [(labels, True),
+                                                    (shuffled, True),
+                                                    (shuffled, False)]]
+                    pd.testing.assert_frame_equal(runs[1], runs[2],
+                                                  check_exact=False,
+                                                  atol=1e-4)
+
+
+def _scaled(task, scale):
+    return task * scale.sum()
+
+
+class TestOrderedMap(unittest.TestCase):
+
+    def test_shared(self):
+        # the bound arrays go to every worker once, not with every task
+        scale = np.ones(10 ** 6)
+        fn = functools.partial(_scaled, scale=scale)
+        with tempfile.TemporaryDirectory() as dir_name:
+            shared = _share(fn, dir_name)
+            self.assertLess(len(pickle.dumps(shared)), 1000)
+            self.assertEqual(shared(2), 2e6)
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            results = list(_ordered_map(executor, fn, range(8), 4))
+        self.assertEqual(results, [i * 1e6 for i in range(8)])
+
+
+class TestAntitheticGamma(unittest.TestCase):
+
+    def test_pairs(self):
+        # zero, fractional, low and high counts
+        alpha = np.array([[0.5, 0.7, 1.5], [3.5, 20.5, 1000.5]])
+        draws = _antithetic_gamma(alpha, 40001, np.random.default_rng(0))
+        self.assertEqual(draws.shape, (40001, 2, 3))
+        for i, j in np.ndindex(alpha.shape):
+            dist = stats.gamma(alpha[i, j])
+            first, second = draws[0::2, i, j], draws[1::2, i, j]
+            # either partner is an exact Gamma draw ...
+            self.assertGreater(stats.kstest(first, dist.cdf).pvalue, 0.001)
+            self.assertGreater(stats.kstest(second, dist.cdf).pvalue, 0.001)
+            # ... moving against the other
+            self.assertLess(pearsonr(np.log(first[:len(second)]),
+                                     np.log(second))[0], -0.6)
+
+
+class TestRandomBlockTable(unittest.TestCase):
+
+    def test_chunks(self):
+        _, dense, metadata, truth = random_block_table(300, 40, seed=3)
+        _, chunked, _, chunked_truth = random_block_table(
+            300, 40, seed=3, chunk_size=100)
+        pd.testing.assert_frame_equal(dense, chunked)
+        pd.testing.assert_frame_equal(truth, chunked_truth)
+
+        abs_table, sparse, _, _ = random_block_table(300, 40, seed=3,
+                                                     sparse=True)
+        self.assertIsNone(abs_table)
+        npt.assert_array_equal(sparse.sparse.to_dense().values,
+                               dense.values)
+
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'table.tsv')
+            written_metadata, written_truth = write_block_table(
+                path, 300, 40, seed=3, chunk_size=256)
+            written = pd.read_csv(path, sep='\t', index_col=0)
+        npt.assert_array_equal(written.values, dense.values)
+        pd.testing.assert_frame_equal(written_metadata, metadata)
+        pd.testing.assert_frame_equal(written_truth, truth)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,116 @@
+import os
+import unittest
+from unittest import mock
+
+from q2_aldex2 import _plan
+
+
+_GB = 2 ** 30
+
+
+class TestPlan(unittest.TestCase):
+
+    def test_available_memory(self):
+        with mock.patch.dict(os.environ, {_plan.MEMORY_ENV: '512'}):
+            self.assertEqual(_plan.available_memory(), 512 * 2 ** 20)
+        with mock.patch.dict(os.environ, {_plan.MEMORY_ENV: ''}):
+            memory = _plan.available_memory()
+        self.assertTrue(memory is None or memory > 0)
+        self.assertGreaterEqual(_plan.available_cpus(), 1)
+
+    def test_estimate(self):
+        shape = (100, 2000, 50000)
+        peak, seconds = _plan.estimate(*shape, 128)
+        self.assertGreater(peak, 100 * 2000 * 128 * 8)
+        self.assertGreater(seconds, 0)
+        more, longer = _plan.estimate(*shape, 256)
+        self.assertGreater(more, peak)
+        self.assertGreater(longer, seconds)
+        chunked, slower = _plan.estimate(*shape, 128, chunk_size=64)
+        self.assertLess(chunked, peak / 4)
+        self.assertGreater(slower, seconds)
+        streamed, _ = _plan.estimate(*shape, 128, chunk_size=64,
+                                     mc_batch_size=16)
+        self.assertLess(streamed, peak)
+        parallel, faster = _plan.estimate(*shape, 128, n_jobs=4, cpus=4)
+        self.assertLess(faster, seconds)
+        self.assertGreater(parallel, chunked)
+
+    def test_plan(self):
+        plan = _plan.plan(20, 200, 2000, 16, memory=8 * _GB, cpus=4)
+        self.assertTrue(plan.feasible)
+        self.assertIsNone(plan.chunk_size)
+        self.assertEqual(plan.n_jobs, 1)
+        self.assertIs(plan.check(), plan)
+        self.assertIn('n_jobs:          1 of 4 CPUs', str(plan))
+
+    def test_plan_given(self):
+        plan = _plan.plan(20, 200, 2000, 16, chunk_size=50, n_jobs=8,
+                          memory=8 * _GB, cpus=4)
+        self.assertEqual((plan.chunk_size, plan.n_jobs), (50, 8))
+
+    def test_plan_chunks(self):
+        whole, _ = _plan.estimate(500, 20000, 10 ** 6, 1024)
+        plan = _plan.plan(500, 20000, 10 ** 6, 1024, memory=whole / 4,
+                          cpus=1)
+        self.assertTrue(plan.feasible)
+        self.assertEqual(plan.n_jobs, 1)
+        self.assertLess(plan.chunk_size, 20000)
+        self.assertEqual(plan.chunk_size % 32, 0)
+        self.assertLessEqual(plan.peak, whole / 4 * _plan._HEADROOM)
+
+    def test_plan_parallel(self):
+        plan = _plan.plan(500, 20000, 10 ** 6, 1024, memory=1024 * _GB,
+                          cpus=4)
+        self.assertEqual(plan.n_jobs, 4)
+        self.assertGreaterEqual(-(-20000 // plan.chunk_size), 4)
+        serial = _plan.plan(500, 20000, 10 ** 6, 1024, memory=1024 * _GB,
+                            cpus=1)
+        self.assertLess(plan.seconds, serial.seconds)
+
+    def test_plan_infeasible(self):
+        plan = _plan.plan(500, 200000, 10 ** 7, 1024, memory=_GB, cpus=4)
+        self.assertFalse(plan.feasible)
+        self.assertIn('mc_batch_size', plan.problem)
+        self.assertIn('1.0 GB is available', plan.problem)
+        with self.assertRaisesRegex(MemoryError, 'mc_samples'):
+            plan.check()
+
+    def test_plan_r(self):
+        plan = _plan.plan(500, 20000, 10 ** 6, 1024, engine='R',
+                          memory=8 * _GB)
+        self.assertFalse(plan.feasible)
+        self.assertIn('engine=\'native\'', plan.problem)
+        self.assertIsNone(plan.seconds)
+        # R's footprint is a guess, so it only warns
+        with self.assertWarnsRegex(UserWarning, 'may need about'):
+            self.assertIs(plan.check(), plan)
+        plan = _plan.plan(20, 200, 2000, 16, engine='R', memory=8 * _GB)
+        self.assertTrue(plan.feasible)
+
+    def test_plan_variants(self):
+        one = _plan.plan(100, 2000, 50000, 128, n_jobs=1, memory=8 * _GB)
+        ten = _plan.plan(100, 2000, 50000, 128, n_jobs=1, n_variants=10,
+                         memory=8 * _GB)
+        self.assertGreater(ten.peak, one.peak)
+        self.assertGreater(ten.seconds, one.seconds)
+
+    def test_plan_quick(self):
+        with mock.patch('q2_aldex2._plan.calibrate') as calibrate:
+            plan = _plan.plan(20, 200, 2000, 16, memory=8 * _GB, quick=True)
+            calibrate.assert_not_called()
+        self.assertEqual((plan.chunk_size, plan.n_jobs), (None, 1))
+        self.assertIsNone(plan.seconds)
+        self.assertGreaterEqual(plan.peak, _plan.plan(
+            20, 200, 2000, 16, memory=8 * _GB).peak)
+
+        # close to the budget or possibly long, the calibrated plan decides
+        tight = _plan.plan(20, 200, 2000, 16, memory=plan.peak * 2,
+                           quick=True)
+        self.assertIsNotNone(tight.seconds)
+        long = _plan.plan(20, 20000, 2000, 16, memory=8 * _GB, quick=True)
+        self.assertIsNotNone(long.seconds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import glob
+import pstats
+import tempfile
+import unittest
+from unittest import mock
+
+from q2_aldex2 import _profile
+
+
+def _leaf(n):
+    return sum(i * i for i in range(n))
+
+
+def _work(n):
+    return _leaf(n) + _leaf(2 * n)
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_disabled(self):
+        profiled = _profile.profiled('work')(_work)
+        with mock.patch.dict(os.environ, {_profile.PROFILE_ENV: ''}):
+            self.assertEqual(profiled(10), _work(10))
+            self.assertIsNone(_profile.r_profile_path())
+
+    def test_profiled(self):
+        paths = []
+
+        def work(n):
+            paths.append(_profile.r_profile_path())
+            return _work(n)
+
+        profiled = _profile.profiled('work')(work)
+        with tempfile.TemporaryDirectory() as dir_name:
+            with mock.patch.dict(os.environ,
+                                 {_profile.PROFILE_ENV: dir_name}):
+                self.assertEqual(profiled(100000), _work(100000))
+            self.assertIsNone(_profile.r_profile_path())
+            prefix = paths[0][:-len('.Rprof')]
+            self.assertTrue(os.path.basename(prefix).startswith('work-'))
+            self.assertEqual(sorted(glob.glob(os.path.join(dir_name, '*'))),
+                             [prefix + '.collapsed', prefix + '.prof'])
+
+            stats = pstats.Stats(prefix + '.prof')
+            with open(prefix + '.collapsed') as fh:
+                stacks = dict(line.rsplit(' ', 1) for line in fh)
+
+        self.assertTrue(any(func[2] == '_leaf' for func in stats.stats))
+        leaf = [stack for stack in stacks if stack.endswith('(_leaf)')]
+        self.assertTrue(leaf)
+        for stack in leaf:
+            frames = stack.split(';')
+            self.assertEqual(frames[0], 'python')
+            self.assertTrue(frames[-2].endswith('(_work)'))
+        self.assertTrue(all(int(value) > 0 for value in stacks.values()))
+
+    def test_unique_names(self):
+        profiled = _profile.profiled('work')(_work)
+        with tempfile.TemporaryDirectory() as dir_name:
+            with mock.patch.dict(os.environ,
+                                 {_profile.PROFILE_ENV: dir_name}), \
+                    mock.patch('time.strftime', return_value='same-second'):
+                profiled(10)
+                profiled(10)
+            names = glob.glob(os.path.join(dir_name, '*.prof'))
+        self.assertEqual(len(names), 2)
+
+    def test_r_stacks(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            prefix = os.path.join(dir_name, 'aldex2-1')
+            _profile.cProfile.runctx('_work(1000)', globals(), {},
+                                     prefix + '.prof')
+            with open(prefix + '.Rprof', 'w') as fh:
+                fh.write('sample.interval=10000\n'
+                         '"aldex.clr" "aldex" "run.aldex2" \n'
+                         '"aldex.clr" "aldex" "run.aldex2" \n'
+                         '"t.fast" "aldex.ttest" "aldex" "run.aldex2" \n')
+            self.assertEqual(_profile.r_stacks(prefix + '.Rprof'), {
+                'run.aldex2;aldex;aldex.clr': 20000,
+                'run.aldex2;aldex;aldex.ttest;t.fast': 10000})
+            with open(_profile.write_collapsed(prefix)) as fh:
+                lines = fh.read().splitlines()
+        self.assertIn('R;run.aldex2;aldex;aldex.clr 20000', lines)
+        self.assertTrue(any(line.startswith('python;') for line in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+from q2_aldex2 import _rworker
+
+
+# Speaks the `run_aldex2.R --worker` protocol. A job is '<action>\t<path>':
+# 'ok' writes the worker's pid to <path>, 'error' reports an error, 'die'
+# exits in the middle of the job and 'die-once' only does so the first
+# time (it leaves <path>.died behind).
+_FAKE_WORKER = '''#!%s
+import os
+import sys
+
+def reply(status):
+    sys.stderr.write('__q2_aldex2__ ' + status + '\\n')
+    sys.stderr.flush()
+
+assert sys.argv[1:] == ['--worker']
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line == 'quit':
+        break
+    if line == 'ping':
+        reply('pong')
+        continue
+    action, path = line.split('\\t')
+    sys.stderr.write('R says hello\\n')
+    if action == 'die-once' and not os.path.exists(path + '.died'):
+        open(path + '.died', 'w').close()
+        action = 'die'
+    if action == 'die':
+        os._exit(1)
+    if action == 'error':
+        reply('error object not found')
+        continue
+    with open(path, 'w') as fh:
+        fh.write(str(os.getpid()))
+    reply('ok')
+''' % sys.executable
+
+
+class TestRWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.script = os.path.join(self.dir_name, 'run_aldex2.R')
+        with open(self.script, 'w') as fh:
+            fh.write(_FAKE_WORKER)
+        os.chmod(self.script, 0o755)
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        shutil.rmtree(self.dir_name)
+
+    def pool(self, size=1):
+        pool = _rworker.RWorkerPool(size, self.script)
+        self.pools.append(pool)
+        return pool
+
+    def job(self, action, name='out'):
+        path = os.path.join(self.dir_name, name)
+        return [action, path], path
+
+    def pid(self, path):
+        with open(path) as fh:
+            return int(fh.read())
+
+    def test_run(self):
+        pool = self.pool()
+        args, path = self.job('ok')
+        pool.run(args)
+        worker, = pool._workers
+        self.assertEqual(self.pid(path), worker.process.pid)
+        self.assertTrue(worker.healthy())
+
+    def test_error(self):
+        pool = self.pool()
+        args, _ = self.job('error')
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            pool.run(args)
+        self.assertEqual(cm.exception.returncode, 1)
+        self.assertEqual(cm.exception.cmd, [self.script] + args)
+        # the worker survives an error in R and takes the next job
+        worker, = pool._workers
+        pid = worker.process.pid
+        args, path = self.job('ok')
+        pool.run(args)
+        self.assertEqual(self.pid(path), pid)
+
+    def test_died(self):
+        pool = self.pool()
+        worker, = pool._workers
+        pid = worker.process.pid
+        # restarted and retried once
+        args, path = self.job('die-once')
+        pool.run(args)
+        self.assertTrue(os.path.exists(path + '.died'))
+        self.assertNotEqual(self.pid(path), pid)
+        self.assertEqual(self.pid(path), worker.process.pid)
+
+        # a job that kills every worker fails after the retry, leaving a
+        # fresh worker behind
+        args, _ = self.job('die')
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            pool.run(args)
+        self.assertEqual(cm.exception.returncode, -1)
+        args, path = self.job('ok')
+        pool.run(args)
+        self.assertEqual(self.pid(path), worker.process.pid)
+
+    def test_unhealthy(self):
+        pool = self.pool()
+        worker, = pool._workers
+        worker.process.kill()
+        worker.process.wait()
+        self.assertFalse(worker.healthy())
+        args, path = self.job('ok')
+        pool.run(args)
+        self.assertEqual(self.pid(path), worker.process.pid)
+
+    def test_reuse(self):
+        pool = self.pool(2)
+        pids = set()
+        for i in range(6):
+            args, path = self.job('ok', 'out%d' % i)
+            pool.run(args)
+            pids.add(self.pid(path))
+        self.assertEqual(pids, {worker.process.pid
+                                for worker in pool._workers})
+
+    def test_get_pool(self):
+        path = self.dir_name + os.pathsep + os.environ.get('PATH', '')
+        with mock.patch.object(_rworker, '_pool', None), \
+                mock.patch.dict(os.environ, {'PATH': path}):
+            with mock.patch.dict(os.environ, {_rworker.WORKERS_ENV: ''}):
+                self.assertIsNone(_rworker.get_pool())
+            with mock.patch.dict(os.environ, {_rworker.WORKERS_ENV: '2'}):
+                pool = _rworker.get_pool()
+                self.pools.append(pool)
+                self.assertEqual(len(pool._workers), 2)
+                self.assertIs(_rworker.get_pool(), pool)
+
+                args, path = self.job('ok')
+                _rworker.run_commands(pool, [['run_aldex2.R'] + args],
+                                      verbose=False)
+                self.assertIn(self.pid(path),
+                              [worker.process.pid
+                               for worker in pool._workers])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from q2_aldex2._sketch import QuantileSketch
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def test_quantiles(self):
+        rng = np.random.default_rng(0)
+        # a symmetric and a skewed feature
+        values = np.column_stack([rng.normal(size=20000),
+                                  rng.exponential(size=20000)])
+        sketch = QuantileSketch(2, size=256)
+        for start in range(0, len(values), 500):
+            sketch.update(values[start:start + 500])
+        self.assertLessEqual(sketch._values.shape[1], 3 * 256)
+
+        q = [0.025, 0.5, 0.975]
+        obs = sketch.quantile(q)
+        self.assertEqual(obs.shape, (3, 2))
+        # the estimates sit within a small rank error of the true quantiles
+        ranks = (values[None] < obs[:, None]).mean(axis=1)
+        npt.assert_allclose(ranks, np.repeat([q], 2, axis=0).T, atol=0.01)
+        npt.assert_allclose(sketch.quantile(0.5), obs[1])
+
+    def test_large_update(self):
+        rng = np.random.default_rng(1)
+        values = rng.normal(size=(5000, 2))
+        sketch = QuantileSketch(2, size=64)
+        held = []
+        compress = sketch._compress
+
+        def _compress():
+            held.append(sketch._values.shape[1])
+            compress()
+
+        sketch._compress = _compress
+        # a single block of many times the size
+        sketch.update(values)
+        self.assertLessEqual(max(held), 3 * 64)
+        self.assertLessEqual(sketch._values.shape[1], 3 * 64)
+        ranks = (values < sketch.quantile(0.5)).mean(axis=0)
+        npt.assert_allclose(ranks, 0.5, atol=0.03)
+
+    def test_exact_below_size(self):
+        values = np.arange(12.).reshape(4, 3)
+        sketch = QuantileSketch(3, size=16)
+        sketch.update(values)
+        npt.assert_allclose(sketch.quantile(0.5), np.median(values, axis=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy import stats
+
+from q2_aldex2._stats import _bh, _design, _glm, _kruskal, _welch, _wilcox
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # (instances, samples, features) blocks of unequal size and spread
+        self.x = rng.normal(0, 1, size=(8, 6, 50))
+        self.y = rng.normal(0.5, 2, size=(8, 9, 50))
+
+    def test_bh(self):
+        p = np.array([0.01, 0.04, 0.03, 0.2, 0.5])
+        # p.adjust(c(0.01, 0.04, 0.03, 0.2, 0.5), method='BH')
+        npt.assert_allclose(_bh(p), [0.05, 0.0666666667, 0.0666666667, 0.25,
+                                     0.5])
+        npt.assert_allclose(_bh(np.vstack([p, p[::-1]]))[1], _bh(p)[::-1])
+
+    def test_welch(self):
+        exp = stats.ttest_ind(self.x, self.y, axis=1, equal_var=False).pvalue
+        npt.assert_allclose(_welch(self.x, self.y), exp, rtol=1e-10)
+
+    def test_wilcox_exact(self):
+        # small groups without ties use the exact null distribution
+        exp = stats.mannwhitneyu(self.x, self.y, axis=1,
+                                 method='exact').pvalue
+        npt.assert_allclose(_wilcox(self.x, self.y), exp, rtol=1e-10)
+
+    def test_wilcox_normal(self):
+        rng = np.random.default_rng(1)
+        x = rng.normal(0, 1, size=(4, 60, 20))
+        y = rng.normal(0.3, 1, size=(4, 55, 20))
+        exp = stats.mannwhitneyu(x, y, axis=1, method='asymptotic').pvalue
+        npt.assert_allclose(_wilcox(x, y), exp, rtol=1e-10)
+
+    def test_wilcox_ties(self):
+        rng = np.random.default_rng(2)
+        x = rng.integers(0, 5, size=(4, 12, 20)).astype(float)
+        y = rng.integers(1, 6, size=(4, 10, 20)).astype(float)
+        exp = stats.mannwhitneyu(x, y, axis=1, method='asymptotic').pvalue
+        npt.assert_allclose(_wilcox(x, y), exp, rtol=1e-10)
+
+    def test_kruskal(self):
+        rng = np.random.default_rng(3)
+        labels = rng.permutation(np.repeat([0, 1, 2], [5, 7, 6]))
+        z = rng.normal(size=(3, 18, 10)) + 0.5 * labels[:, None]
+        # rounding introduces ties
+        for block in (z, np.round(z)):
+            exp = [[stats.kruskal(*[block[i, labels == g, j]
+                                    for g in range(3)]).pvalue
+                    for j in range(10)] for i in range(3)]
+            npt.assert_allclose(_kruskal(block, labels, 3), exp, rtol=1e-10)
+
+    def test_glm(self):
+        labels = np.array([0, 1, 2, 0, 1, 2, 1, 0, 2, 1])
+        z = np.array([
+            [0.12, -0.85, 1.31, 0.47, -1.02, 0.96, -0.33, 0.05, 1.74, -0.61],
+            [2.10, 1.95, 2.42, 1.80, 2.21, 2.05, 1.77, 2.31, 2.60, 1.99],
+            [-0.40, 0.35, 0.90, -1.10, 0.62, 1.48, 0.07, -0.23, 0.51, 0.88]]).T
+        # likelihood ratio tests of the one-way against the intercept-only
+        # fit, from statsmodels' OLSResults.compare_lr_test (as R's
+        # drop1(glm(z ~ labels), test='Chisq'))
+        exp = [4.877792927065973e-06, 0.08012148699859416,
+               0.0010204844385138837]
+        npt.assert_allclose(_glm(z[None], _design(labels, 3))[0], exp,
+                            rtol=1e-10)
+        # shifting and scaling an instance leaves its p-values unchanged
+        block = np.stack([z, 2 * z + 1])
+        obs = _glm(block, _design(labels, 3))
+        npt.assert_allclose(obs, [exp, exp], rtol=1e-10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+import pandas as pd
+
+from q2_aldex2 import _transport
+
+
+def _table(values):
+    # IDs of different lengths, with spaces and non-ASCII characters, in an
+    # order that is not sorted
+    samples = ['s%d' % i + 'x' * (i % 3) for i in range(values.shape[1])]
+    samples[0] = 'sample é 0'
+    features = ['f%d%s' % (i, '_' * i) for i in range(values.shape[0])][::-1]
+    return biom.Table(values, features, samples)
+
+
+def _read_counts(path):
+    """ The binary table as run_aldex2.R reads it, as samples x features. """
+    features = _transport._read_ids(path + '.features')
+    samples = _transport._read_ids(path + '.samples')
+    size = os.path.getsize(path) // (len(features) * len(samples))
+    values = np.fromfile(path, dtype='<i4' if size == 4 else '<f8')
+    # column-major features x samples
+    return pd.DataFrame(values.reshape(len(samples), len(features)),
+                        index=samples, columns=features)
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.counts = rng.poisson(3, size=(7, 5)).astype(float)
+        self.counts[2] = 0
+        self.table = _table(self.counts)
+        self.expected = pd.DataFrame(
+            self.counts.T, index=self.table.ids(axis='sample'),
+            columns=self.table.ids(axis='observation'))
+
+    def tearDown(self):
+        for name in os.listdir(self.dir_name):
+            os.remove(os.path.join(self.dir_name, name))
+        os.rmdir(self.dir_name)
+
+    def test_get_transport(self):
+        for value, expected in [(None, 'text'), ('', 'text'),
+                                ('text', 'text'), ('binary', 'binary')]:
+            env = {} if value is None else {_transport.TRANSPORT_ENV: value}
+            with mock.patch.dict(os.environ, env):
+                if value is None:
+                    os.environ.pop(_transport.TRANSPORT_ENV, None)
+                self.assertEqual(_transport.get_transport(), expected)
+        with mock.patch.dict(os.environ,
+                             {_transport.TRANSPORT_ENV: 'feather'}):
+            with self.assertRaisesRegex(ValueError, 'feather'):
+                _transport.get_transport()
+
+    def test_write_table_text(self):
+        # several chunks of samples, with a single header
+        path = _transport.write_table(self.table, self.dir_name, 'text',
+                                      chunk_size=2)
+        self.assertTrue(path.endswith('.tsv.biom'))
+        written = pd.read_csv(path, sep='\t', index_col=0)
+        self.assertEqual(written.index.name, 'sampleid')
+        written.index.name = None
+        pd.testing.assert_frame_equal(written, self.expected,
+                                      check_dtype=False)
+
+    def test_write_table_binary(self):
+        path = _transport.write_table(self.table, self.dir_name, 'binary',
+                                      chunk_size=2)
+        self.assertTrue(path.endswith('.counts'))
+        # integral counts are written as int32
+        self.assertEqual(os.path.getsize(path), 4 * self.counts.size)
+        written = _read_counts(path)
+        self.assertTrue((written.dtypes == np.int32).all())
+        pd.testing.assert_frame_equal(written, self.expected,
+                                      check_dtype=False)
+
+    def test_write_table_binary_float(self):
+        counts = self.counts + 1 / 3
+        counts[0, 0] = 1e-300
+        table = _table(counts)
+        path = _transport.write_table(table, self.dir_name, 'binary')
+        self.assertEqual(os.path.getsize(path), 8 * counts.size)
+        written = _read_counts(path)
+        # exact, bit for bit
+        np.testing.assert_array_equal(written.values, counts.T)
+        self.assertEqual(list(written.index), list(table.ids(axis='sample')))
+
+    def test_read_summary_text(self):
+        summary = pd.DataFrame({'we.eBH': [0.1, 1 / 3], 'effect': [-1.5, 2.]},
+                               index=['feature b', 'feature_a'])
+        path = _transport.summary_path(self.dir_name, 'text')
+        # as R's write.csv writes it
+        summary.to_csv(path, float_format='%.15g')
+        read = _transport.read_summary(path, 'text')
+        pd.testing.assert_frame_equal(read, summary, check_exact=False,
+                                      rtol=1e-14)
+
+    def test_read_summary_binary(self):
+        rows = ['z', 'feature é', 'a' * 40]
+        columns = ['rab.all', 'diff.btw', 'we.eBH']
+        values = np.array([[1 / 3, -2.5e-300, 1e300],
+                           [np.pi, 0., -1.],
+                           [0.05, 1e-17, np.nan]]).T
+        path = _transport.summary_path(self.dir_name, 'binary')
+        # column-major, as write.summary in run_aldex2.R writes it
+        values.T.astype('<f8').tofile(path)
+        _transport._write_ids(rows, path + '.rows')
+        _transport._write_ids(columns, path + '.columns')
+        read = _transport.read_summary(path, 'binary')
+        self.assertEqual(list(read.index), rows)
+        self.assertEqual(list(read.columns), columns)
+        np.testing.assert_array_equal(read.values, values)
+
+
+if __name__ == "__main__":
+    unittest.main()